@@ -131,9 +131,9 @@ SCRIPT=$(readlink -f "$0")
 SCRIPTPATH=$(dirname "$SCRIPT")
 cd $SCRIPTPATH
 
-SIFFILE="cellpose-cuda-liu-0.0.5.sif"
+SIFFILE="cellpose-cuda-liu-0.0.6.sif"
 if [ ! -f "$SIFFILE" ]; then
-    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/cellpose-cuda-liu:0.0.5
+    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/cellpose-cuda-liu:0.0.6
 fi
 
 echo "$image_path"
@@ -149,7 +149,7 @@ echo singularity run \
         -B "$parent_indir":"$parent_indir" \
         -B "$parent_outdir":"$parent_outdir" \
         --nv \
-        ./cellpose-cuda-liu-0.0.5.sif \
+        ./cellpose-cuda-liu-0.0.6.sif \
         /entrypoint.sh segmentation \
         -i $image_path \
         -o $out \
@@ -166,7 +166,7 @@ singularity run \
         -B "$parent_indir":"$parent_indir" \
         -B "$parent_outdir":"$parent_outdir" \
         --nv \
-        ./cellpose-cuda-liu-0.0.5.sif \
+        ./cellpose-cuda-liu-0.0.6.sif \
         /entrypoint.sh segmentation \
         -i $image_path \
         -o $out \
@@ -13,6 +13,9 @@ import tifffile
 import torch
 from pathlib import Path
 
+# histogram.py is copied from the nd2-to-n5-py image (see the Dockerfile)
+from histogram import matches_chunks
+
 def stitch3D(masks, stitch_threshold=0.25):
     """ new stitch3D function that won't slow down w/ large numbers of masks"""
     mmax = masks[0].max()
@@ -86,20 +89,35 @@ def main():
     print(input)
     print(n5path)
     img = None
+    stats = None
     if Path(input).suffix.lower() in ['.tif', '.tiff']:
         img = tifffile.imread(input)
     else:
         n5input = z5py.File(input, use_zarr_format=False)
         n5_dataset = n5input[n5path]
         img = np.array(n5_dataset)
+        # percentiles cached by intensity_stats.py, unless the chunks were rewritten since
+        if 'intensityStatistics' in n5_dataset.attrs:
+            stats = n5_dataset.attrs['intensityStatistics']
+            if not matches_chunks(stats.get('fingerprint'), os.path.join(input, n5path)):
+                print("cached intensity statistics are older than the chunks, they are ignored")
+                stats = None
 
     print("dapi channel")
     print("\r shape: {0}".format(img.shape))
     print("\r dtype: {0}".format(img.dtype))
-    print("\r min: {0}".format(img.min()))
-    print("\r max: {0}".format(img.max()), "\n")
-
-    img = normalize99(img)
+    if stats is not None:
+        print("\r min: {0}".format(stats['min']))
+        print("\r max: {0}".format(stats['max']), "\n")
+        img = img.astype(np.float32)
+        if stats['p99'] - stats['p1'] > 1e-3:
+            img = (img - stats['p1']) / (stats['p99'] - stats['p1'])
+        else:
+            img[:] = 0
+    else:
+        print("\r min: {0}".format(img.min()))
+        print("\r max: {0}".format(img.max()), "\n")
+        img = normalize99(img)
 
     if model_path is not None:
         model = models.CellposeModel(gpu=True, pretrained_model=model_path)
@@ -6,10 +6,18 @@ usage() {
 	echo
 	echo "Options:"
 	echo "  -i, --input		path to an input csv"
+	echo "  --spotsdir		step-3 output directory, all spot csv files in it are assigned in one call"
 	echo "  -o, --output    path to an output file"
 	echo "  -p, --output2   path to an output file 2 (percentage of assigned spots)"
 	echo "  -v, --voxel     voxel size"
-	echo "  -s, --seg		path to a segmented image"
+	echo "  -s, --seg		path to a segmented image (.tif) or N5/Zarr container"
+	echo "  -d, --seg_dataset	dataset path of the segmentation in an N5/Zarr container (e.g. c0/s2)"
+	echo "  --chunked		read the segmentation chunk by chunk instead of loading it into memory"
+	echo "  -t, --thread	number of spot files processed concurrently"
+	echo "  --shard_dir		directory to write one count matrix per round (optional)"
+	echo "  --max_dist		assign spots within this distance (um) to the nearest segment (no dilation step needed)"
+	echo "  --seg_spacing	voxel spacing of the segmentation (x,y,z) used by --max_dist"
+	echo "  -f, --format	count matrix format: csv (default), npz (sparse CSR) or mtx (Matrix Market)"
 	echo "  -h, --help		display this help and exit"
 	exit 1
 }
@@ -61,6 +69,68 @@ do
 			seg="$2"
 			shift 2
 			;;
+		'-d'|'--seg_dataset' )
+			if [[ -z "$2" ]] || [[ "$2" =~ ^-+ ]]; then
+				echo "$PROGNAME: option requires an argument -- $1" 1>&2
+				exit 1
+			fi
+			extra_args+=( -d "$2" )
+			shift 2
+			;;
+		'--chunked' )
+			extra_args+=( --chunked )
+			shift 1
+			;;
+		'--spotsdir' )
+			if [[ -z "$2" ]] || [[ "$2" =~ ^-+ ]]; then
+				echo "$PROGNAME: option requires an argument -- $1" 1>&2
+				exit 1
+			fi
+			spotsdir="$2"
+			shift 2
+			;;
+		'-t'|'--thread' )
+			if [[ -z "$2" ]] || [[ "$2" =~ ^-+ ]]; then
+				echo "$PROGNAME: option requires an argument -- $1" 1>&2
+				exit 1
+			fi
+			extra_args+=( -t "$2" )
+			shift 2
+			;;
+		'--max_dist' )
+			if [[ -z "$2" ]] || [[ "$2" =~ ^-+ ]]; then
+				echo "$PROGNAME: option requires an argument -- $1" 1>&2
+				exit 1
+			fi
+			extra_args+=( --max_dist "$2" )
+			shift 2
+			;;
+		'--seg_spacing' )
+			if [[ -z "$2" ]] || [[ "$2" =~ ^-+ ]]; then
+				echo "$PROGNAME: option requires an argument -- $1" 1>&2
+				exit 1
+			fi
+			extra_args+=( --seg_spacing "$2" )
+			shift 2
+			;;
+		'-f'|'--format' )
+			if [[ -z "$2" ]] || [[ "$2" =~ ^-+ ]]; then
+				echo "$PROGNAME: option requires an argument -- $1" 1>&2
+				exit 1
+			fi
+			extra_args+=( -f "$2" )
+			shift 2
+			;;
+		'--shard_dir' )
+			if [[ -z "$2" ]] || [[ "$2" =~ ^-+ ]]; then
+				echo "$PROGNAME: option requires an argument -- $1" 1>&2
+				exit 1
+			fi
+			mkdir -p "$2"
+			shard_dir=$(realpath "$2")
+			extra_args+=( --shard_dir "$shard_dir" )
+			shift 2
+			;;
 		'--'|'-' )
 			shift 1
 			param+=( "$@" )
@@ -86,16 +156,24 @@ SCRIPT=$(readlink -f "$0")
 SCRIPTPATH=$(dirname "$SCRIPT")
 cd $SCRIPTPATH
 
-SIFFILE="bigstream-py-0.0.10.sif"
+SIFFILE="bigstream-py-0.0.11.sif"
 if [ ! -f "$SIFFILE" ]; then
-    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/bigstream-py:0.0.10.sif
+    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/bigstream-py:0.0.11.sif
 fi
 
 echo "$input"
 echo "$output"
-IFS=',' read -r -a input_array <<< "$input"
-real_input_path=$(realpath "${input_array[0]}")
-parent_indir=$(dirname "$real_input_path")
+input_args=()
+if [[ -n "$input" ]]; then
+	IFS=',' read -r -a input_array <<< "$input"
+	real_input_path=$(realpath "${input_array[0]}")
+	parent_indir=$(dirname "$real_input_path")
+	input_args+=( -i "$input" )
+fi
+if [[ -n "$spotsdir" ]]; then
+	parent_indir=$(realpath "$spotsdir")
+	input_args+=( --spotsdir "$parent_indir" )
+fi
 real_output_path=$(realpath "$output")
 parent_outdir=$(dirname "$real_output_path")
 mkdir -p "$parent_outdir"
@@ -104,22 +182,24 @@ echo singularity run \
         --env TINI_SUBREAPER=true \
         -B "$parent_indir":"$parent_indir" \
         -B "$parent_outdir":"$parent_outdir" \
-        ./bigstream-py-0.0.10.sif \
+        ./bigstream-py-0.0.11.sif \
         /entrypoint.sh spot_assignment \
-        -i $input \
+        "${input_args[@]}" \
         -o $output \
         -s $seg \
 		-p $output2 \
-		-v $voxel
+		-v $voxel \
+		"${extra_args[@]}"
 
 singularity run \
         --env TINI_SUBREAPER=true \
         -B "$parent_indir":"$parent_indir" \
         -B "$parent_outdir":"$parent_outdir" \
-        ./bigstream-py-0.0.10.sif \
+        ./bigstream-py-0.0.11.sif \
         /entrypoint.sh spot_assignment \
-        -i $input \
+        "${input_args[@]}" \
         -o $output \
         -s $seg \
 		-p $output2 \
-		-v $voxel
\ No newline at end of file
+		-v $voxel \
+		"${extra_args[@]}"
\ No newline at end of file
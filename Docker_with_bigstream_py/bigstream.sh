@@ -43,9 +43,9 @@ SCRIPT=$(readlink -f "$0")
 SCRIPTPATH=$(dirname "$SCRIPT")
 cd $SCRIPTPATH
 
-SIFFILE="bigstream-py-0.0.10.sif"
+SIFFILE="bigstream-py-0.0.11.sif"
 if [ ! -f "$SIFFILE" ]; then
-    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/bigstream-py:0.0.10.sif
+    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/bigstream-py:0.0.11.sif
 fi
 
 # specify 3 things: directory of step1 (stitching), specify fix N5, specify output directory of below process, step2 (registration) #
@@ -92,7 +92,7 @@ do_bigstream() {
             -B "$out":"$out" \
             -B "$fix_mask":"$fix_mask" \
             -B "$mov_mask":"$mov_mask" \
-            ./bigstream-py-0.0.10.sif \
+            ./bigstream-py-0.0.11.sif \
             /entrypoint.sh bigstream_in_memory \
             -f "$fix" \
             -m "$mov" \
@@ -118,7 +118,7 @@ singularity run \
         --env TINI_SUBREAPER=true \
         -B "$fix":"$fix" \
         -B "$step2outdir":"$step2outdir" \
-        ./bigstream-py-0.0.10.sif \
+        ./bigstream-py-0.0.11.sif \
         /entrypoint.sh fix_n5tiff \
         -f "$fix" \
         -o "$step2outdir" \
@@ -79,9 +79,9 @@ SCRIPT=$(readlink -f "$0")
 SCRIPTPATH=$(dirname "$SCRIPT")
 cd $SCRIPTPATH
 
-SIFFILE="bigstream-py-0.0.10.sif"
+SIFFILE="bigstream-py-0.0.11.sif"
 if [ ! -f "$SIFFILE" ]; then
-    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/bigstream-py:0.0.10.sif
+    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/bigstream-py:0.0.11.sif
 fi
 
 fix=${step1dir}/${fix_subpath}
@@ -115,7 +115,7 @@ do_cropping() {
         -B "$transformdir":"$transformdir" \
         -B "$seg":"$seg" \
         -B "$out":"$out" \
-        ./bigstream-py-0.0.10.sif \
+        ./bigstream-py-0.0.11.sif \
         /entrypoint.sh bigstream_segment_s0 \
         -f "$fix" \
         -m "$mov" \
@@ -135,7 +135,7 @@ do_cropping_fix() {
         -B "$fix":"$fix" \
         -B "$seg":"$seg" \
         -B "$out":"$out" \
-        ./bigstream-py-0.0.10.sif \
+        ./bigstream-py-0.0.11.sif \
         /entrypoint.sh fix_segment_s0 \
         -f "$fix" \
         -seg "$seg" \
@@ -5,10 +5,14 @@ usage() {
 	echo "dilate or elode segments"
 	echo
 	echo "Options:"
-	echo "  -i, --input		path to an input csv"
-	echo "  -o, --output    path to an output file"
+	echo "  -i, --input		path to an input segmentation (.tif) or N5/Zarr container"
+	echo "  -o, --output    path to an output file (.tif) or N5 container (.n5)"
+	echo "  -d, --dataset	dataset path in the input N5/Zarr container (e.g. c0/s2)"
+	echo "  --out_dataset	dataset path in the output N5 container"
+	echo "  -c, --chunk		chunk size (z,y,x)"
 	echo "  -t, --thread	number of threads"
 	echo "  -r, --radius	radius of dilation (r > 0) or erosion (r < 0)"
+	echo "  -m, --method	shift (6-neighborhood steps, default) or edt (Euclidean distance transform)"
 	echo "  -h, --help		display this help and exit"
 	exit 1
 }
@@ -48,6 +52,22 @@ do
 			radius="$2"
 			shift 2
 			;;
+		'-m'|'--method' )
+			method="$2"
+			shift 2
+			;;
+		'-d'|'--dataset' )
+			extra_args+=( -d "$2" )
+			shift 2
+			;;
+		'--out_dataset' )
+			extra_args+=( --out_dataset "$2" )
+			shift 2
+			;;
+		'-c'|'--chunk' )
+			extra_args+=( -c "$2" )
+			shift 2
+			;;
 	esac
 done
 
@@ -57,9 +77,13 @@ SCRIPT=$(readlink -f "$0")
 SCRIPTPATH=$(dirname "$SCRIPT")
 cd $SCRIPTPATH
 
-SIFFILE="bigstream-py-0.0.10.sif"
+SIFFILE="bigstream-py-0.0.11.sif"
 if [ ! -f "$SIFFILE" ]; then
-    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/bigstream-py:0.0.10.sif
+    singularity build "$SIFFILE" docker://ghcr.io/janeliascicomp/bigstream-py:0.0.11.sif
+fi
+
+if [ -z "$method" ]; then
+    method="shift"
 fi
 
 echo "$input"
@@ -73,20 +97,24 @@ echo singularity run \
         --env TINI_SUBREAPER=true \
         -B "$parent_indir":"$parent_indir" \
         -B "$parent_outdir":"$parent_outdir" \
-        ./bigstream-py-0.0.10.sif \
+        ./bigstream-py-0.0.11.sif \
         /entrypoint.sh dilate_segments \
         -i $input \
         -o $output \
         -t $thread \
-		-r $radius
+		-r $radius \
+		-m $method \
+		"${extra_args[@]}"
 
 singularity run \
         --env TINI_SUBREAPER=true \
         -B "$parent_indir":"$parent_indir" \
         -B "$parent_outdir":"$parent_outdir" \
-        ./bigstream-py-0.0.10.sif \
+        ./bigstream-py-0.0.11.sif \
         /entrypoint.sh dilate_segments \
         -i $input \
 		-o $output \
         -t $thread \
-		-r $radius
\ No newline at end of file
+		-r $radius \
+		-m $method \
+		"${extra_args[@]}"
@@ -0,0 +1,226 @@
+import numpy as np
+import pandas as pd
+from dask import delayed, compute
+from dask.distributed import Client
+import zarr
+
+import os
+import sys
+import argparse
+
+from center_of_mass import label_stats_in_chunk, merge_label_stats, get_image_shape, read_region
+from fix_segment_s0 import get_channels
+
+def log_bin(values, bins_per_octave):
+    """
+    Log2-spaced intensity bins used to estimate per-cell medians.
+
+    :param values: Intensity array.
+    :param bins_per_octave: Number of bins per doubling of intensity.
+    :return: int array of bin indices.
+    """
+    return np.floor(np.log2(values.astype(np.float64) + 1.0) * bins_per_octave).astype(np.int64)
+
+def log_bin_center(bins, bins_per_octave):
+    return np.power(2.0, (bins + 0.5) / bins_per_octave) - 1.0
+
+def surface_faces(ext, labels, axis):
+    """
+    Count the voxel faces of each label that touch another value along one axis.
+    Only faces of voxels inside the block are counted, so every face is counted
+    by exactly one chunk.
+
+    :param ext: Label block extended by one voxel on both sides (zero outside of the image).
+    :param labels: Sorted labels of the block.
+    :param axis: Axis of the faces.
+    :return: Number of faces per label.
+    """
+    n = ext.shape[axis]
+    lower = [slice(1, -1)] * 3
+    upper = [slice(1, -1)] * 3
+    lower[axis] = slice(0, n - 1)
+    upper[axis] = slice(1, n)
+    a = ext[tuple(lower)]
+    b = ext[tuple(upper)]
+    diff = a != b
+    # a is inside the block except for its first plane, b except for its last plane
+    diff_a = diff.copy()
+    diff_b = diff
+    first = [slice(None)] * 3
+    first[axis] = 0
+    diff_a[tuple(first)] = False
+    first[axis] = -1
+    diff_b[tuple(first)] = False
+    faces = np.concatenate([a[diff_a & (a != 0)], b[diff_b & (b != 0)]])
+    return np.bincount(np.searchsorted(labels, faces), minlength=len(labels))
+
+def features_in_chunk(seg_path, seg_dataset, n5dir, datasets, region, shape, spacing, bins_per_octave, nbins):
+    """
+    Compute per-label morphology and intensity statistics of one chunk.
+
+    :param seg_path: Path to the segmentation (TIFF file or N5/Zarr container).
+    :param seg_dataset: Dataset path of the segmentation in an N5/Zarr container.
+    :param n5dir: Path to the N5 with the intensity channels.
+    :param datasets: Intensity dataset paths (e.g. c0/s2), one per channel.
+    :param region: Tuple of slices (z, y, x) of the chunk.
+    :param shape: Shape of the image (z, y, x).
+    :param spacing: Voxel spacing (z, y, x).
+    :param bins_per_octave: Resolution of the median histograms.
+    :param nbins: Number of median histogram bins.
+    :return: Dictionary of partial statistics, one row per label. The median
+        histograms take labels x channels x nbins x 4 bytes (129 bins for uint16
+        with 8 bins per octave, about 1 KB per label and channel), and every
+        merge level holds eight partial results.
+    """
+    # read the chunk with a one voxel halo for the surface faces
+    outer = tuple(slice(max(r.start - 1, 0), min(r.stop + 1, s)) for r, s in zip(region, shape))
+    ext = read_region(seg_path, seg_dataset, outer)
+    pad = [(int(r.start == o.start), int(r.stop == o.stop)) for r, o in zip(region, outer)]
+    ext = np.pad(ext, pad)
+    block = ext[1:-1, 1:-1, 1:-1]
+
+    stats = {'morph': label_stats_in_chunk(block, tuple(r.start for r in region))}
+    labels = stats['morph']['label']
+    n = len(labels)
+
+    face_area = [spacing[1] * spacing[2], spacing[0] * spacing[2], spacing[0] * spacing[1]]
+    stats['surface'] = np.zeros(n, dtype=np.float64)
+    for axis in range(3):
+        stats['surface'] += surface_faces(ext, labels, axis) * face_area[axis]
+
+    fg = block != 0
+    rows = np.searchsorted(labels, block[fg])
+    stats['intensity_sum'] = np.zeros((n, len(datasets)), dtype=np.float64)
+    stats['intensity_hist'] = np.zeros((n, len(datasets), nbins), dtype=np.uint32)
+    n5 = zarr.open(store=zarr.N5FSStore(n5dir), mode='r')
+    for c, ds in enumerate(datasets):
+        values = n5[ds][region][fg]
+        stats['intensity_sum'][:, c] = np.bincount(rows, weights=values, minlength=n)
+        bins = np.minimum(log_bin(values, bins_per_octave), nbins - 1)
+        stats['intensity_hist'][:, c, :] = np.bincount(rows * nbins + bins, minlength=n * nbins).reshape(n, nbins)
+    return stats
+
+def merge_features(*stats_list):
+    """
+    Merge partial statistics from multiple chunks.
+
+    :param stats_list: Partial statistics dictionaries from different chunks.
+    :return: Merged statistics dictionary, one row per label.
+    """
+    merged = {'morph': merge_label_stats(*[s['morph'] for s in stats_list])}
+    labels = np.concatenate([s['morph']['label'] for s in stats_list])
+    if len(labels) == 0:
+        return stats_list[0]
+    order = np.argsort(labels, kind='stable')
+    starts = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1]])
+    for key in ['surface', 'intensity_sum', 'intensity_hist']:
+        merged[key] = np.add.reduceat(np.concatenate([s[key] for s in stats_list])[order], starts, axis=0)
+    return merged
+
+def median_from_histograms(hist, bins_per_octave):
+    """
+    Estimate per-label medians from log-binned histograms. The estimate is
+    the center of the median bin, within 2^(0.5 / bins_per_octave) of the
+    exact median (about 4% with 8 bins per octave).
+
+    :param hist: (labels, channels, bins) histogram array.
+    :param bins_per_octave: Resolution of the histograms.
+    :return: (labels, channels) array of medians.
+    """
+    cumsum = np.cumsum(hist, axis=2)
+    half = cumsum[:, :, -1:] / 2.0
+    median_bins = np.argmax(cumsum >= half, axis=2)
+    return log_bin_center(median_bins, bins_per_octave)
+
+def build_feature_table(stats, channels, spacing, bins_per_octave):
+    """
+    Build the per-cell feature table.
+
+    :param stats: Merged statistics dictionary.
+    :param channels: Channel names (e.g. c0, c1).
+    :param spacing: Voxel spacing (z, y, x).
+    :param bins_per_octave: Resolution of the median histograms.
+    :return: pandas DataFrame, one row per cell.
+    """
+    morph = stats['morph']
+    count = np.maximum(morph['count'], 1)
+    centers = morph['sum'] / count[:, None]
+    table = {
+        'label': morph['label'],
+        'voxels': morph['count'],
+        'volume': morph['count'] * float(np.prod(spacing)),
+        'surface_area': stats['surface'],
+        'z': centers[:, 0], 'y': centers[:, 1], 'x': centers[:, 2],
+        'z_min': morph['min'][:, 0], 'y_min': morph['min'][:, 1], 'x_min': morph['min'][:, 2],
+        'z_max': morph['max'][:, 0], 'y_max': morph['max'][:, 1], 'x_max': morph['max'][:, 2],
+    }
+    medians = median_from_histograms(stats['intensity_hist'], bins_per_octave)
+    for c, ch in enumerate(channels):
+        table[ch + '_mean'] = stats['intensity_sum'][:, c] / count
+        table[ch + '_median_approx'] = medians[:, c]
+        table[ch + '_integrated'] = stats['intensity_sum'][:, c]
+    return pd.DataFrame(table)
+
+def cell_features():
+    argv = sys.argv
+    argv = argv[1:]
+
+    usage_text = ("Usage:" + "  cell_features.py" + " [options]")
+    parser = argparse.ArgumentParser(description=usage_text)
+    parser.add_argument("-s", "--seg", dest="seg", type=str, default=None, help="segmentation (.tif) or N5/Zarr container")
+    parser.add_argument("-d", "--seg_dataset", dest="seg_dataset", type=str, default=None, help="dataset path of the segmentation in an N5/Zarr container (e.g. c0/s2)")
+    parser.add_argument("-n", "--n5dir", dest="n5dir", type=str, default=None, help="N5 with the intensity channels (e.g. step1/b0/t0)")
+    parser.add_argument("-r", "--res", dest="res", type=str, default="s2", help="scale level of the intensity channels, must match the segmentation (e.g. s2)")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path (.parquet)")
+    parser.add_argument("-t", "--thread", dest="thread", type=int, default=8, help="number of threads")
+    parser.add_argument("-c", "--chunk", dest="chunk", type=str, default="128,256,256", help="chunk size (z,y,x)")
+    parser.add_argument("--bins_per_octave", dest="bins_per_octave", type=int, default=8, help="resolution of the per-cell median estimate <ch>_median_approx (log2 bins per doubling of intensity). The histograms take about 4 bytes per bin, label and channel")
+
+    if not argv:
+        parser.print_help()
+        exit()
+
+    args = parser.parse_args(argv)
+
+    client = Client(n_workers=1, threads_per_worker=args.thread)
+    chunk_size = tuple(int(c) for c in args.chunk.split(','))
+    bins_per_octave = args.bins_per_octave
+
+    shape = get_image_shape(args.seg, args.seg_dataset)
+    channels = sorted(get_channels(args.n5dir))
+    datasets = [ch + '/' + args.res for ch in channels]
+    n5 = zarr.open(store=zarr.N5FSStore(args.n5dir), mode='r')
+    for ds in datasets:
+        if tuple(n5[ds].shape) != shape:
+            raise ValueError("shape of " + ds + " " + str(n5[ds].shape) + " does not match the segmentation " + str(shape))
+    attrs = n5[datasets[0]].attrs.asdict()
+    spacing = np.multiply(attrs.get('pixelResolution', [1, 1, 1]), attrs.get('downsamplingFactors', [1, 1, 1]))[::-1]
+    nbins = int(np.ceil(np.log2(np.iinfo(n5[datasets[0]].dtype).max + 1.0) * bins_per_octave)) + 1 if np.issubdtype(n5[datasets[0]].dtype, np.integer) else 32 * bins_per_octave
+    print('segmentation: ', shape)
+    print('channels: ', datasets)
+    print('spacing: ', spacing)
+
+    partials = []
+    for z in range(0, shape[0], chunk_size[0]):
+        for y in range(0, shape[1], chunk_size[1]):
+            for x in range(0, shape[2], chunk_size[2]):
+                region = (slice(z, min(z + chunk_size[0], shape[0])), slice(y, min(y + chunk_size[1], shape[1])), slice(x, min(x + chunk_size[2], shape[2])))
+                partials.append(delayed(features_in_chunk)(args.seg, args.seg_dataset, args.n5dir, datasets, region, shape, spacing, bins_per_octave, nbins))
+    print("chunks: " + str(len(partials)))
+
+    # label and intensity chunks are streamed together; partial results are merged as a tree
+    while len(partials) > 1:
+        partials = [delayed(merge_features)(*partials[i:i + 8]) for i in range(0, len(partials), 8)]
+    stats = compute(partials[0])[0]
+
+    table = build_feature_table(stats, channels, spacing, bins_per_octave)
+    print("Writing", args.output, "(" + str(len(table)) + " cells)")
+    table.to_parquet(args.output, index=False)
+
+    client.close()
+
+def main():
+    cell_features()
+
+if __name__ == '__main__':
+    main()
@@ -1,131 +1,173 @@
 import numpy as np
-from scipy.ndimage import center_of_mass
-import dask.array as da
+import pandas as pd
 from dask import delayed, compute
 from dask.distributed import LocalCluster, Client
 import tifffile
+import zarr
 
+import os
 import sys
 import argparse
 
-import csv
-
-from scipy.ndimage import find_objects
-
-def find_objects_in_chunk(image_chunk, offset):
+def label_stats_in_chunk(image_chunk, offset):
     """
-    Find bounding boxes for each segment in a chunk of a 3D indexed image.
+    Compute per-label voxel count, coordinate sums and bounding boxes for a chunk of a 3D indexed image.
 
     :param image_chunk: 3D numpy array representing a chunk of the image.
     :param offset: Tuple representing the offset of this chunk in the full image (z, y, x).
-    :return: Dictionary with segment labels as keys and their bounding boxes as values.
-    """
-    bounding_boxes = {}
-
-    z_offset, y_offset, x_offset = offset
-
-    for z in range(image_chunk.shape[0]):
-        for y in range(image_chunk.shape[1]):
-            for x in range(image_chunk.shape[2]):
-                label = image_chunk[z, y, x]
-                if label != 0:  # Skip background
-                    if label not in bounding_boxes:
-                        bounding_boxes[label] = [[np.inf, -np.inf], [np.inf, -np.inf], [np.inf, -np.inf]]
-                    bbox = bounding_boxes[label]
-                    # Update bounding box coordinates with respect to the full image
-                    bbox[0][0] = min(bbox[0][0], z + z_offset)  # Min Z
-                    bbox[0][1] = max(bbox[0][1], z + z_offset)  # Max Z
-                    bbox[1][0] = min(bbox[1][0], y + y_offset)  # Min Y
-                    bbox[1][1] = max(bbox[1][1], y + y_offset)  # Max Y
-                    bbox[2][0] = min(bbox[2][0], x + x_offset)  # Min X
-                    bbox[2][1] = max(bbox[2][1], x + x_offset)  # Max X
-
-    return bounding_boxes
-
-def merge_bounding_boxes(bboxes_list):
-    """
-    Merge bounding boxes from multiple chunks into a single dictionary.
-
-    :param bboxes_list: List of bounding boxes dictionaries from different chunks.
-    :return: Merged dictionary of bounding boxes.
-    """
-    merged_bboxes = {}
-    for bboxes in bboxes_list:
-        for label, bbox in bboxes.items():
-            if label not in merged_bboxes:
-                merged_bboxes[label] = bbox
-            else:
-                for i in range(3):
-                    merged_bboxes[label][i][0] = min(merged_bboxes[label][i][0], bbox[i][0])
-                    merged_bboxes[label][i][1] = max(merged_bboxes[label][i][1], bbox[i][1])
-    return merged_bboxes
-
-def calculate_centers_of_mass(image, bounding_boxes):
-    """
-    Calculate the centers of mass for each segment in a 3D indexed image using bounding boxes.
-
-    :param image: 3D numpy array where each unique integer represents a different segment.
-    :param bounding_boxes: Dictionary of bounding boxes for each segment.
-    :return: Dictionary with segment labels as keys and their centers of mass as values.
-    """
-    centers_of_mass = {}
-
-    for label, bbox in bounding_boxes.items():
-        z_range, y_range, x_range = bbox
-        # Extract the subvolume containing the segment
-        subvolume = image[z_range[0]:z_range[1]+1, y_range[0]:y_range[1]+1, x_range[0]:x_range[1]+1]
-        
-        # Create a mask for the current label within the subvolume
-        mask = subvolume == label
-
-        # Calculate the coordinates of the center of mass
-        total_mass = np.sum(mask)
-        if total_mass > 0:
-            z_coords, y_coords, x_coords = np.nonzero(mask)
-            z_center = np.mean(z_coords) + z_range[0]
-            y_center = np.mean(y_coords) + y_range[0]
-            x_center = np.mean(x_coords) + x_range[0]
-            centers_of_mass[label] = (z_center, y_center, x_center)
-
-    return centers_of_mass
-
-def process_image_in_chunks(image, chunk_size):
-    """
-    Process a 3D image in chunks and calculate the centers of mass for each segment using Dask.
-
-    :param image: 3D numpy array where each unique integer represents a different segment.
-    :param chunk_size: Tuple (z_chunk, y_chunk, x_chunk) indicating the size of each chunk.
-    :return: Dictionary with segment labels as keys and their centers of mass as values.
+    :return: Dictionary of partial statistics ('label', 'count', 'sum', 'min', 'max'), one row per label.
+    """
+    flat = np.asarray(image_chunk).ravel()
+    nz = np.flatnonzero(flat)  # Skip background
+    labels = flat[nz]
+    order = np.argsort(labels, kind='stable')
+    labels = labels[order]
+    coords = np.stack(np.unravel_index(nz[order], image_chunk.shape), axis=1) + np.asarray(offset, dtype=np.int64)
+
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]]) if len(labels) > 0 else np.array([], dtype=np.int64)
+    if len(starts) == 0:
+        return empty_stats(image_chunk.dtype)
+
+    return {
+        'label': labels[starts],
+        'count': np.diff(np.r_[starts, len(labels)]).astype(np.int64),
+        'sum': np.add.reduceat(coords, starts, axis=0).astype(np.float64),
+        'min': np.minimum.reduceat(coords, starts, axis=0),
+        'max': np.maximum.reduceat(coords, starts, axis=0),
+    }
+
+def empty_stats(dtype):
     """
-    z_chunks = range(0, image.shape[0], chunk_size[0])
-    y_chunks = range(0, image.shape[1], chunk_size[1])
-    x_chunks = range(0, image.shape[2], chunk_size[2])
+    Statistics of a chunk without any label.
+    """
+    return {
+        'label': np.array([], dtype=dtype),
+        'count': np.array([], dtype=np.int64),
+        'sum': np.zeros((0, 3), dtype=np.float64),
+        'min': np.zeros((0, 3), dtype=np.int64),
+        'max': np.zeros((0, 3), dtype=np.int64),
+    }
+
+def merge_label_stats(*stats_list):
+    """
+    Merge partial statistics from multiple chunks into a single set of statistics.
 
-    print(z_chunks)
-    print(y_chunks)
-    print(x_chunks)
+    :param stats_list: Partial statistics dictionaries from different chunks.
+    :return: Merged statistics dictionary, one row per label.
+    """
+    labels = np.concatenate([s['label'] for s in stats_list])
+    if len(labels) == 0:
+        return stats_list[0]
+    ids, inverse = np.unique(labels, return_inverse=True)
+    n = len(ids)
+
+    merged = {
+        'label': ids,
+        'count': np.bincount(inverse, weights=np.concatenate([s['count'] for s in stats_list]), minlength=n).astype(np.int64),
+        'sum': np.zeros((n, 3), dtype=np.float64),
+        'min': np.full((n, 3), np.iinfo(np.int64).max, dtype=np.int64),
+        'max': np.full((n, 3), np.iinfo(np.int64).min, dtype=np.int64),
+    }
+    sums = np.concatenate([s['sum'] for s in stats_list])
+    mins = np.concatenate([s['min'] for s in stats_list])
+    maxs = np.concatenate([s['max'] for s in stats_list])
+    for axis in range(3):
+        merged['sum'][:, axis] = np.bincount(inverse, weights=sums[:, axis], minlength=n)
+        np.minimum.at(merged['min'][:, axis], inverse, mins[:, axis])
+        np.maximum.at(merged['max'][:, axis], inverse, maxs[:, axis])
+    return merged
+
+def open_image(input_path, dataset=None):
+    """
+    Open a label image without loading it.
+
+    :param input_path: Path to a TIFF file or an N5/Zarr container.
+    :param dataset: Dataset path inside an N5/Zarr container (e.g. c0/s2).
+    :return: zarr array for N5/Zarr input, tifffile.TiffFile for TIFF input.
+    """
+    if os.path.isdir(input_path):
+        if input_path.rstrip('/').endswith('.zarr'):
+            container = zarr.open(input_path, mode='r')
+        else:
+            container = zarr.open(store=zarr.N5FSStore(input_path), mode='r')
+        return container[dataset] if dataset else container
+    return tifffile.TiffFile(input_path)
+
+def get_image_shape(input_path, dataset=None):
+    """
+    Shape (z, y, x) of a label image.
+    """
+    image = open_image(input_path, dataset)
+    if isinstance(image, tifffile.TiffFile):
+        with image:
+            return tuple(image.series[0].shape)
+    return tuple(image.shape)
 
-    delayed_bounding_boxes = []
+def read_region(input_path, dataset, region):
+    """
+    Read one block of a label image. The image is opened inside the task so
+    that only the path has to be sent to the Dask workers.
 
+    :param input_path: Path to a TIFF file or an N5/Zarr container.
+    :param dataset: Dataset path inside an N5/Zarr container.
+    :param region: Tuple of slices (z, y, x).
+    :return: numpy array.
+    """
+    image = open_image(input_path, dataset)
+    if isinstance(image, tifffile.TiffFile):
+        with image:
+            # the zarr view of a TIFF decodes only the strips or tiles that
+            # overlap the block instead of whole planes
+            with image.series[0].aszarr() as store:
+                return zarr.open(store, mode='r')[region]
+    return image[region]
+
+def process_image_in_chunks(input_path, dataset, shape, chunk_size, fan_in=8):
+    """
+    Process a 3D image in chunks and calculate per-label statistics using Dask.
+
+    :param input_path: Path to a TIFF file or an N5/Zarr container where each unique integer represents a different segment.
+    :param dataset: Dataset path inside an N5/Zarr container.
+    :param shape: Shape of the image (z, y, x).
+    :param chunk_size: Tuple (z_chunk, y_chunk, x_chunk) indicating the size of each chunk.
+    :param fan_in: Number of partial results merged by one task in the tree reduction.
+    :return: Merged statistics dictionary ('label', 'count', 'sum', 'min', 'max').
+    """
+    z_chunks = range(0, shape[0], chunk_size[0])
+    y_chunks = range(0, shape[1], chunk_size[1])
+    x_chunks = range(0, shape[2], chunk_size[2])
+
+    partials = []
     for z in z_chunks:
         for y in y_chunks:
             for x in x_chunks:
-                chunk = image[z:z + chunk_size[0], y:y + chunk_size[1], x:x + chunk_size[2]]
-                offset = (z, y, x)
-                delayed_bounding_boxes.append(delayed(find_objects_in_chunk)(chunk, offset))
+                region = (slice(z, min(z + chunk_size[0], shape[0])), slice(y, min(y + chunk_size[1], shape[1])), slice(x, min(x + chunk_size[2], shape[2])))
+                chunk = delayed(read_region)(input_path, dataset, region)
+                partials.append(delayed(label_stats_in_chunk)(chunk, (z, y, x)))
+    print("chunks: " + str(len(partials)))
 
-    # Compute all bounding boxes in parallel using Dask
-    all_bounding_boxes = compute(*delayed_bounding_boxes)
+    # Merge partial statistics as a tree so no single task holds every chunk's result
+    while len(partials) > 1:
+        partials = [delayed(merge_label_stats)(*partials[i:i + fan_in]) for i in range(0, len(partials), fan_in)]
 
-    # Merge bounding boxes from all chunks
-    #merged_bounding_boxes = merge_bounding_boxes(all_bounding_boxes)
+    return compute(partials[0])[0]
 
-    # Calculate centers of mass based on the merged bounding boxes
-    #centers_of_mass = calculate_centers_of_mass(image, merged_bounding_boxes)
+def save_label_stats(stats, output_file_path):
+    """
+    Write centroid, volume and bounding box CSVs.
 
-    centers_of_mass = {}
+    :param stats: Merged statistics dictionary.
+    :param output_file_path: Path of the centroid CSV; <stem>_volume.csv and <stem>_bbox.csv are written next to it.
+    """
+    stem = os.path.splitext(output_file_path)[0]
+    labels = stats['label']
+    centers = stats['sum'] / np.maximum(stats['count'], 1)[:, None]
 
-    return centers_of_mass
+    pd.DataFrame({'label': labels, 'z': centers[:, 0], 'y': centers[:, 1], 'x': centers[:, 2]}).to_csv(output_file_path, index=False)
+    pd.DataFrame({'label': labels, 'volume': stats['count']}).to_csv(stem + '_volume.csv', index=False)
+    pd.DataFrame({'label': labels,
+                  'z_min': stats['min'][:, 0], 'y_min': stats['min'][:, 1], 'x_min': stats['min'][:, 2],
+                  'z_max': stats['max'][:, 0], 'y_max': stats['max'][:, 1], 'x_max': stats['max'][:, 2]}).to_csv(stem + '_bbox.csv', index=False)
 
 
 def calc_and_save_center_of_mass():
@@ -134,9 +176,11 @@ def calc_and_save_center_of_mass():
 
     usage_text = ("Usage:" + "  center_of_mass.py" + " [options]")
     parser = argparse.ArgumentParser(description=usage_text)
-    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input file path")
-    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path")
+    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input file path (.tif) or N5/Zarr container")
+    parser.add_argument("-d", "--dataset", dest="dataset", type=str, default=None, help="dataset path in an N5/Zarr container (e.g. c0/s2)")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path (centroid csv; _volume.csv and _bbox.csv are written next to it)")
     parser.add_argument("-t", "--thread", dest="thread", type=int, default=8, help="number of threads")
+    parser.add_argument("-c", "--chunk", dest="chunk", type=str, default="256,256,256", help="chunk size (z,y,x)")
 
     if not argv:
         parser.print_help()
@@ -147,19 +191,18 @@ def calc_and_save_center_of_mass():
     client = Client(n_workers=1, threads_per_worker=args.thread)
     input_file_path = args.input
     output_file_path = args.output
-    
-    # Load the TIFF file as a NumPy array
-    with tifffile.TiffFile(input_file_path) as tif:
-        image = tif.asarray()
-
-    chunk_size = (256, 256, 256)
-    # Process the image in chunks and calculate centers of mass using Dask
-    results = process_image_in_chunks(image, chunk_size)
-
-    with open(output_file_path, 'w') as csv_file:  
-        writer = csv.writer(csv_file)
-        for key, value in results.items():
-            writer.writerow([key, value])
+    chunk_size = tuple(int(c) for c in args.chunk.split(','))
+
+    shape = get_image_shape(input_file_path, args.dataset)
+    print(shape)
+
+    # Process the image in chunks and calculate per-label statistics using Dask
+    results = process_image_in_chunks(input_file_path, args.dataset, shape, chunk_size)
+    print("labels: " + str(len(results['label'])))
+
+    save_label_stats(results, output_file_path)
+
+    client.close()
 
 def main():
     calc_and_save_center_of_mass()
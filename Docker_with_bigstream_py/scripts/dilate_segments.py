@@ -5,103 +5,233 @@ import dask.array as da
 import dask
 from dask.distributed import LocalCluster, Client
 import tifffile
+import zarr
+from numcodecs import GZip
+from scipy import ndimage
+
+import os
 
 import sys
 import argparse
 
-def custom_filter_max(block):
+from center_of_mass import get_image_shape, read_region
+
+def neighbor_max(padded):
+    """
+    Maximum of the 6-neighborhood of every voxel.
+
+    Parameters:
+    - padded: 3D numpy array padded by one voxel on every side.
+
+    Returns:
+    - 3D numpy array with the shape of the unpadded block.
+    """
+    out = np.maximum(padded[:-2, 1:-1, 1:-1], padded[2:, 1:-1, 1:-1])
+    np.maximum(out, padded[1:-1, :-2, 1:-1], out=out)
+    np.maximum(out, padded[1:-1, 2:, 1:-1], out=out)
+    np.maximum(out, padded[1:-1, 1:-1, :-2], out=out)
+    np.maximum(out, padded[1:-1, 1:-1, 2:], out=out)
+    return out
+
+def neighbor_min(padded):
+    """
+    Minimum of the 6-neighborhood of every voxel.
+
+    Parameters:
+    - padded: 3D numpy array padded by one voxel on every side.
+
+    Returns:
+    - 3D numpy array with the shape of the unpadded block.
+    """
+    out = np.minimum(padded[:-2, 1:-1, 1:-1], padded[2:, 1:-1, 1:-1])
+    np.minimum(out, padded[1:-1, :-2, 1:-1], out=out)
+    np.minimum(out, padded[1:-1, 2:, 1:-1], out=out)
+    np.minimum(out, padded[1:-1, 1:-1, :-2], out=out)
+    np.minimum(out, padded[1:-1, 1:-1, 2:], out=out)
+    return out
+
+def custom_filter_max(block, iteration=1):
+    """
+    Grow segments into the background, one voxel of the 6-neighborhood per iteration.
+    Background voxels take the maximum label of their neighbors, labeled voxels are kept.
+
+    Parameters:
+    - block: 3D numpy array, a block of the image with an overlap of at least iteration voxels.
+    - iteration: number of dilation steps.
+
+    Returns:
+    - filtered_block: 3D numpy array, the filtered block.
+    """
+    filtered_block = block.copy()
+    for i in range(iteration):
+        # edge padding reproduces boundary='nearest' at the image border;
+        # at the block border the error moves in by one voxel per step and is trimmed away
+        neighbors = neighbor_max(np.pad(filtered_block, 1, mode='edge'))
+        background = filtered_block == 0
+        filtered_block[background] = neighbors[background]
+    return filtered_block
+
+def custom_filter_min(block, iteration=1):
+    """
+    Shrink segments, one voxel of the 6-neighborhood per iteration.
+    Labeled voxels take the minimum value of their neighbors, background voxels are kept.
+
+    Parameters:
+    - block: 3D numpy array, a block of the image with an overlap of at least iteration voxels.
+    - iteration: number of erosion steps.
+
+    Returns:
+    - filtered_block: 3D numpy array, the filtered block.
+    """
+    filtered_block = block.copy()
+    for i in range(iteration):
+        neighbors = neighbor_min(np.pad(filtered_block, 1, mode='edge'))
+        foreground = filtered_block != 0
+        filtered_block[foreground] = neighbors[foreground]
+    return filtered_block
+
+def edt_filter_max(block, iteration=1):
     """
-    Apply a custom filter to a 3D block.
-    
+    Grow segments into the background by a Euclidean distance.
+    Background voxels within the distance take the label of the nearest segment.
+
     Parameters:
-    - block: 3D numpy array, a small block of the image with padding.
-    
+    - block: 3D numpy array, a block of the image with an overlap of at least iteration voxels.
+    - iteration: dilation radius in voxels.
+
     Returns:
     - filtered_block: 3D numpy array, the filtered block.
     """
-    # Initialize the output block with zeros
-    filtered_block = np.zeros(block.shape, dtype=block.dtype)
-    
-    # Iterate through each voxel in the block (excluding the border voxels due to padding)
-    for z in range(1, block.shape[0] - 1):
-        for y in range(1, block.shape[1] - 1):
-            for x in range(1, block.shape[2] - 1):
-                val = block[z, y, x]
-                if val == 0:
-                    neighbors = [block[z-1, y, x], block[z+1, y, x], block[z, y-1, x], block[z, y+1, x], block[z, y, x-1], block[z, y, x+1]]
-                    array_1d = np.array(neighbors)
-                    max_val = array_1d.max()
-                    filtered_block[z, y, x] = max_val
-                else:
-                    filtered_block[z, y, x] = val
-    
-    # Return the filtered block, excluding the padding
+    distance, indices = ndimage.distance_transform_edt(block == 0, return_indices=True)
+    filtered_block = block[tuple(indices)]
+    filtered_block[distance > iteration] = 0
     return filtered_block
 
-def custom_filter_min(block):
+def edt_filter_min(block, iteration=1):
     """
-    Apply a custom filter to a 3D block.
-    
+    Shrink segments by a Euclidean distance.
+    Labeled voxels within the distance of another value (background or another segment) are cleared.
+
     Parameters:
-    - block: 3D numpy array, a small block of the image with padding.
-    
+    - block: 3D numpy array, a block of the image with an overlap of at least iteration voxels.
+    - iteration: erosion radius in voxels.
+
     Returns:
     - filtered_block: 3D numpy array, the filtered block.
     """
-    # Initialize the output block with zeros
-    filtered_block = np.zeros(block.shape, dtype=block.dtype)
-    
-    # Iterate through each voxel in the block (excluding the border voxels due to padding)
-    for z in range(1, block.shape[0] - 1):
-        for y in range(1, block.shape[1] - 1):
-            for x in range(1, block.shape[2] - 1):
-                val = block[z, y, x]
-                if val != 0:
-                    neighbors = [block[z-1, y, x], block[z+1, y, x], block[z, y-1, x], block[z, y+1, x], block[z, y, x-1], block[z, y, x+1]]
-                    array_1d = np.array(neighbors)
-                    min_val = array_1d.min()
-                    filtered_block[z, y, x] = min_val
-                else:
-                    filtered_block[z, y, x] = val
-    
-    # Return the filtered block, excluding the padding
+    padded = np.pad(block, 1, mode='edge')
+    border = (neighbor_max(padded) != block) | (neighbor_min(padded) != block)
+    distance = ndimage.distance_transform_edt(~border)
+    filtered_block = block.copy()
+    filtered_block[(distance < iteration) & (block != 0)] = 0
     return filtered_block
 
-def apply_custom_filter_dask(image, chunk_size=(100, 100, 100), iteration=1):
+def open_lazy_image(input_path, dataset=None, chunk_size=(100, 100, 100)):
     """
-    Apply a custom 3x3x3 filter to a 3D image using Dask.
-    
+    Open a 3D label image as a lazy Dask array. Every block is read inside its
+    own task, so the image is never loaded whole by the driver.
+
     Parameters:
-    - image: 3D numpy array, the input image.
+    - input_path: path to a TIFF file or an N5/Zarr container.
+    - dataset: dataset path inside an N5/Zarr container (e.g. c0/s2).
     - chunk_size: tuple, the size of the chunks for the Dask array.
-    - iteration: iteration number of filtering.
-    
+
+    Returns:
+    - image_da: 3D Dask array.
+    """
+    shape = get_image_shape(input_path, dataset)
+    dtype = read_region(input_path, dataset, (slice(0, 1), slice(0, 1), slice(0, 1))).dtype
+    blocks = []
+    for z in range(0, shape[0], chunk_size[0]):
+        rows = []
+        for y in range(0, shape[1], chunk_size[1]):
+            cols = []
+            for x in range(0, shape[2], chunk_size[2]):
+                region = (slice(z, min(z + chunk_size[0], shape[0])), slice(y, min(y + chunk_size[1], shape[1])), slice(x, min(x + chunk_size[2], shape[2])))
+                block_shape = tuple(r.stop - r.start for r in region)
+                cols.append(da.from_delayed(dask.delayed(read_region)(input_path, dataset, region), shape=block_shape, dtype=dtype))
+            rows.append(cols)
+        blocks.append(rows)
+    return da.block(blocks)
+
+def apply_custom_filter_dask(image, chunk_size=(100, 100, 100), iteration=1, method='shift'):
+    """
+    Dilate (iteration > 0) or erode (iteration < 0) a 3D label image using Dask.
+    All iterations run in a single lazy map_overlap pass with an overlap depth equal to the radius.
+
+    Parameters:
+    - image: 3D numpy or Dask array, the input image.
+    - chunk_size: tuple, the size of the chunks for the Dask array.
+    - iteration: radius of dilation (> 0) or erosion (< 0).
+    - method: 'shift' for 6-neighborhood steps, 'edt' for a Euclidean distance transform.
+
     Returns:
-    - filtered_image: 3D numpy array, the filtered image.
+    - filtered_da: 3D Dask array, the filtered image (not computed).
     """
-    # Convert the input image to a Dask array with specified chunks
-    image_da = da.from_array(image, chunks=chunk_size)
+    dilate = iteration > 0
+    iteration = abs(iteration)
+
+    if method == 'edt':
+        filter = edt_filter_max if dilate else edt_filter_min
+    else:
+        filter = custom_filter_max if dilate else custom_filter_min
+
+    # blocks must be at least as large as the overlap
+    chunk_size = tuple(max(c, iteration) for c in chunk_size)
+    if isinstance(image, da.Array):
+        image_da = image.rechunk(chunk_size)
+    else:
+        image_da = da.from_array(image, chunks=chunk_size)
 
     print(image_da.shape)
+    if iteration == 0:
+        return image_da
+    print(("dilation" if dilate else "erosion") + " radius " + str(iteration) + " (" + method + ")")
 
-    dilate = True;
-    filter = custom_filter_max
-    if iteration < 0:
-        dilate = False
-        iteration = abs(iteration)
-        filter = custom_filter_min
-    
-    for i in range(iteration):
-        print("iteration " + str(i))
-        # Apply the custom filter using map_overlap
-        tmp_da = image_da.map_overlap(filter,
-                                      depth=1,
-                                      boundary='nearest')
-        filtered_image = tmp_da.compute()
-        print(filtered_image.shape)
-        image_da = da.from_array(filtered_image, chunks=chunk_size)
-    
-    return filtered_image
+    # no padding at the image border, the filters pad with the nearest value themselves
+    filtered_da = image_da.map_overlap(filter,
+                                       depth=iteration,
+                                       boundary='none',
+                                       dtype=image_da.dtype,
+                                       iteration=iteration)
+    return filtered_da
+
+def write_tiff(filtered_da, output_file_path):
+    """
+    Write a Dask array to a zlib-compressed TIFF, one row of blocks at a time.
+
+    Parameters:
+    - filtered_da: 3D Dask array.
+    - output_file_path: path of the output TIFF.
+    """
+    def planes():
+        z_start = 0
+        for z_size in filtered_da.chunks[0]:
+            print("writing z " + str(z_start) + "-" + str(z_start + z_size))
+            slab = filtered_da[z_start:z_start + z_size].compute()
+            for plane in slab:
+                yield plane
+            z_start += z_size
+
+    bigtiff = filtered_da.nbytes > 2**32 - 2**25
+    with tifffile.TiffWriter(output_file_path, bigtiff=bigtiff) as tif:
+        tif.write(planes(), shape=filtered_da.shape, dtype=filtered_da.dtype, compression='zlib', compressionargs={'level': 6})
+
+def write_n5(filtered_da, output_path, dataset, attributes=None):
+    """
+    Write a Dask array to a gzip-compressed N5 dataset. Every block is written by the worker that computed it.
+
+    Parameters:
+    - filtered_da: 3D Dask array.
+    - output_path: path of the output N5 container.
+    - dataset: dataset path inside the container (e.g. c0/s2).
+    - attributes: attributes of the dataset (e.g. pixelResolution, downsamplingFactors).
+    """
+    n5 = zarr.open(store=zarr.N5FSStore(output_path), mode='a')
+    out = n5.create_dataset(dataset, shape=filtered_da.shape, chunks=filtered_da.chunksize, dtype=filtered_da.dtype, compressor=GZip(level=6), overwrite=True)
+    if attributes:
+        out.attrs.update(attributes)
+    da.store(filtered_da, out, lock=False)
 
 def dilate_segments():
     argv = sys.argv
@@ -109,10 +239,14 @@ def dilate_segments():
 
     usage_text = ("Usage:" + "  dilate_segments.py" + " [options]")
     parser = argparse.ArgumentParser(description=usage_text)
-    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input spot csv files")
-    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path")
+    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input segmentation (.tif) or N5/Zarr container")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path (.tif) or N5 container (.n5)")
+    parser.add_argument("-d", "--dataset", dest="dataset", type=str, default=None, help="dataset path in the input N5/Zarr container (e.g. c0/s2)")
+    parser.add_argument("--out_dataset", dest="out_dataset", type=str, default=None, help="dataset path in the output N5 container (default: same as --dataset, or c0/s0)")
     parser.add_argument("-t", "--thread", dest="thread", type=int, default=8, help="number of threads")
     parser.add_argument("-r", "--radius", dest="radius", type=int, default=10, help="radius of dilation (r > 0) or elosion (r < 0)")
+    parser.add_argument("-m", "--method", dest="method", type=str, default="shift", choices=["shift", "edt"], help="shift: 6-neighborhood steps (default), edt: Euclidean distance transform (faster for large radii, grows to the nearest segment)")
+    parser.add_argument("-c", "--chunk", dest="chunk", type=str, default="100,100,100", help="chunk size (z,y,x)")
 
     if not argv:
         parser.print_help()
@@ -124,14 +258,23 @@ def dilate_segments():
     input_file_path = args.input
     output_file_path = args.output
     iteration = args.radius
-    
-    # Load the TIFF file as a NumPy array
-    with tifffile.TiffFile(input_file_path) as tif:
-        image = tif.asarray()
+    chunk_size = tuple(int(c) for c in args.chunk.split(','))
+
+    # Open the input lazily; blocks are read, filtered and written by the workers
+    image_da = open_lazy_image(input_file_path, args.dataset, chunk_size=chunk_size)
+
+    filtered_da = apply_custom_filter_dask(image_da, chunk_size=chunk_size, iteration=iteration, method=args.method)
 
-    filtered_image = apply_custom_filter_dask(image, chunk_size=(100, 100, 100), iteration=iteration)
+    if output_file_path.rstrip('/').endswith('.n5'):
+        out_dataset = args.out_dataset or args.dataset or 'c0/s0'
+        attributes = None
+        if os.path.isdir(input_file_path) and args.dataset:
+            attributes = zarr.open(store=zarr.N5FSStore(input_file_path), mode='r')[args.dataset].attrs.asdict()
+        write_n5(filtered_da, output_file_path, out_dataset, attributes)
+    else:
+        write_tiff(filtered_da, output_file_path)
 
-    tifffile.imsave(output_file_path, filtered_image, compression=("ZLIB", 6))    
+    client.close()
 
 def main():
     dilate_segments()
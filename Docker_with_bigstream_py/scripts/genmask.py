@@ -1,6 +1,7 @@
 import zarr
 import numpy as np
 import tifffile
+import os
 
 from bigstream.level_set import foreground_segmentation
 from scipy.ndimage import zoom, binary_closing, binary_dilation
@@ -9,6 +10,9 @@ from skimage.filters import threshold_triangle, gaussian
 from skimage import io, transform, measure, morphology
 from scipy.ndimage import maximum_filter, minimum_filter, generate_binary_structure
 
+# histogram.py is copied from the nd2-to-n5-py image (see the Dockerfile)
+from histogram import load_histogram, matches_chunks, triangle_threshold_with_zeros
+
 def padding(data_chunk, median, amp):
     mm = median
 
@@ -34,8 +38,19 @@ print('fix:',fix.shape)
 print('spacing:',spacing)
 
 fix_np = fix[:]
-max_intensity = np.max(fix_np)
-bg_val = threshold_triangle(fix_np, nbins=max_intensity)
+# reuse the statistics cached by intensity_stats.py / histogram.py if they are
+# not older than the chunks
+stats = fix.attrs.asdict().get('intensityStatistics')
+if stats is not None and not matches_chunks(stats.get('fingerprint'), os.path.join(fixdir, 'c3/s2')):
+    stats = None
+hist = load_histogram(os.path.join(fixdir, 'c3/s2'), fix) if stats is None else None
+if stats is not None:
+    bg_val = stats['triangleWithZeros']
+elif hist is not None:
+    bg_val = triangle_threshold_with_zeros(hist)
+else:
+    max_intensity = np.max(fix_np)
+    bg_val = threshold_triangle(fix_np, nbins=max_intensity)
 fix_np[fix_np < bg_val] = 0
 
 print('background: ', bg_val)
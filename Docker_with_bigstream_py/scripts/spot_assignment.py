@@ -2,12 +2,21 @@ import pandas as pd
 import numpy as np
 import math
 import tifffile
+import zarr
+import scipy.sparse
+import scipy.io
+from scipy.ndimage import distance_transform_edt
 
 import sys
 import os
 import re
+import glob
 import argparse
 import platform
+import shutil
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
 
 
 def read_3d_coordinates_from_csv(file_path):
@@ -26,6 +35,353 @@ def read_3d_coordinates_from_csv(file_path):
     else:
         raise ValueError("CSV file must contain 'x', 'y', 'z' columns")
 
+def scale_spots(spots, voxelsize):
+    """
+    Scales spot coordinates into the voxel grid of the segmentation.
+
+    :param spots: (N, 3) array of spot coordinates in z, y, x order.
+    :param voxelsize: Relative voxel ratio in x, y, z order.
+    :return: (N, 3) float array of scaled coordinates.
+    """
+    return np.asarray(spots, dtype=np.float64) * np.array([voxelsize[2], voxelsize[1], voxelsize[0]], dtype=np.float64)
+
+def open_segmentation(seg_path, dataset=None, chunked=False):
+    """
+    Opens a segmentation image either in memory or as a chunked array.
+
+    :param seg_path: Path to a TIFF file or an N5/Zarr container.
+    :param dataset: Dataset path inside an N5/Zarr container (e.g. c0/s2).
+    :param chunked: If True, a TIFF file is opened lazily plane by plane.
+    :return: numpy array (in memory) or zarr array (read chunk by chunk).
+    """
+    if os.path.isdir(seg_path):
+        if seg_path.rstrip('/').endswith('.zarr'):
+            container = zarr.open(seg_path, mode='r')
+        else:
+            container = zarr.open(store=zarr.N5FSStore(seg_path), mode='r')
+        return container[dataset] if dataset else container
+    if chunked:
+        return zarr.open(tifffile.imread(seg_path, aszarr=True), mode='r')
+    return tifffile.imread(seg_path)
+
+def iter_chunk_slices(lb):
+    """
+    Iterates over the chunk grid of a chunked array.
+
+    :param lb: zarr array.
+    :return: Generator of tuples of slices, one per chunk.
+    """
+    grid = [int(math.ceil(s / c)) for s, c in zip(lb.shape, lb.chunks)]
+    for idx in np.ndindex(*grid):
+        yield tuple(slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(idx, lb.chunks, lb.shape))
+
+def unique_labels(lb):
+    """
+    Collects the sorted non-zero labels of a segmentation.
+
+    :param lb: 3D label image (numpy or zarr array).
+    :return: Sorted array of labels without background.
+    """
+    if isinstance(lb, np.ndarray):
+        return np.unique(lb[lb != 0])
+    lb_id = np.array([], dtype=lb.dtype)
+    for region in iter_chunk_slices(lb):
+        block = lb[region]
+        lb_id = np.union1d(lb_id, np.unique(block[block != 0]))
+    return lb_id
+
+def read_labels_by_chunk(lb, coords):
+    """
+    Reads the labels at integer coordinates chunk by chunk.
+
+    Spots are sorted by the chunk they fall into so that each chunk of the
+    label image is read once and released before the next one is loaded.
+
+    :param lb: zarr array.
+    :param coords: (N, 3) int array of in-bounds coordinates in z, y, x order.
+    :return: Array of labels under each coordinate.
+    """
+    labels = np.zeros(len(coords), dtype=lb.dtype)
+    if len(coords) == 0:
+        return labels
+    chunks = np.array(lb.chunks, dtype=np.int64)
+    grid = [int(math.ceil(s / c)) for s, c in zip(lb.shape, lb.chunks)]
+    chunk_coords = coords // chunks
+    chunk_ids = np.ravel_multi_index(tuple(chunk_coords.T), grid)
+    order = np.argsort(chunk_ids, kind='stable')
+    sorted_ids = chunk_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    for st, ed in zip(starts, ends):
+        idx = order[st:ed]
+        origin = chunk_coords[idx[0]] * chunks
+        block = lb[tuple(slice(o, o + c) for o, c in zip(origin, chunks))]
+        local = coords[idx] - origin
+        labels[idx] = block[local[:, 0], local[:, 1], local[:, 2]]
+        del block
+    return labels
+
+def get_seg_spacing(lb, seg_spacing=None):
+    """
+    Returns the physical voxel spacing of the segmentation in z, y, x order.
+
+    :param lb: 3D label image (numpy or zarr array).
+    :param seg_spacing: Spacing in x, y, z order given on the command line, or None.
+    :return: numpy array of spacing in z, y, x order.
+    """
+    if seg_spacing is not None:
+        return np.array(seg_spacing, dtype=np.float64)[::-1]
+    attrs = lb.attrs.asdict() if hasattr(lb, 'attrs') else {}
+    if 'pixelResolution' in attrs:
+        res = attrs['pixelResolution']
+        if isinstance(res, dict):
+            res = res['dimensions']
+        factors = attrs.get('downsamplingFactors', [1, 1, 1])
+        return np.multiply(res, factors)[::-1].astype(np.float64)
+    return np.ones(3, dtype=np.float64)
+
+def expand_labels_block(lb, region, halo, max_dist, spacing):
+    """
+    Assigns every background voxel of one block to its nearest segment within max_dist.
+
+    :param lb: 3D label image (numpy or zarr array).
+    :param region: Tuple of slices of the block.
+    :param halo: Halo width in voxels (z, y, x) read around the block.
+    :param max_dist: Maximum distance to a segment in physical units.
+    :param spacing: Voxel spacing in z, y, x order.
+    :return: Expanded labels of the block (without halo).
+    """
+    outer = tuple(slice(max(r.start - h, 0), min(r.stop + h, s)) for r, h, s in zip(region, halo, lb.shape))
+    block = np.asarray(lb[outer])
+    inner = tuple(slice(r.start - o.start, r.stop - o.start) for r, o in zip(region, outer))
+    if not block.any() or block.all():
+        return block[inner]
+    dist, inds = distance_transform_edt(block == 0, sampling=spacing, return_indices=True)
+    expanded = block[tuple(inds)]
+    expanded[dist > max_dist] = 0
+    return expanded[inner]
+
+def expand_labels(lb, max_dist, spacing, workdir, thread=1, block_size=(128, 256, 256)):
+    """
+    Precomputes a nearest-segment label image so that spots within max_dist
+    of a segment are assigned to it.
+
+    The volume is processed block by block with a halo of max_dist, so
+    memory follows the block size. An in-memory segmentation gives an
+    in-memory result; a chunked segmentation is expanded into a temporary
+    zarr store under workdir.
+
+    :param lb: 3D label image (numpy or zarr array).
+    :param max_dist: Maximum distance to a segment in physical units.
+    :param spacing: Voxel spacing in z, y, x order.
+    :param workdir: Directory for the temporary zarr store.
+    :param thread: Number of blocks processed concurrently.
+    :param block_size: Block size in voxels (z, y, x).
+    :return: Tuple of (expanded label image, temporary directory or None).
+    """
+    halo = [int(math.ceil(max_dist / sp)) for sp in spacing]
+    block_size = tuple(min(b, s) for b, s in zip(block_size, lb.shape))
+    tmpdir = None
+    if isinstance(lb, np.ndarray):
+        out = np.zeros(lb.shape, dtype=lb.dtype)
+    else:
+        tmpdir = tempfile.mkdtemp(prefix='expanded_labels_', dir=workdir)
+        out = zarr.open(os.path.join(tmpdir, 'labels.zarr'), mode='w', shape=lb.shape, chunks=block_size, dtype=lb.dtype)
+
+    grid = [int(math.ceil(s / c)) for s, c in zip(lb.shape, block_size)]
+    regions = [tuple(slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(idx, block_size, lb.shape)) for idx in np.ndindex(*grid)]
+
+    def run(region):
+        out[region] = expand_labels_block(lb, region, halo, max_dist, spacing)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, thread)) as executor:
+            list(executor.map(run, regions))
+    except BaseException:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    return out, tmpdir
+
+def lookup_labels(lb, spots):
+    """
+    Looks up the segment label under every spot in one pass.
+
+    :param lb: 3D label image (numpy array, or zarr array read chunk by chunk).
+    :param spots: (N, 3) array of scaled spot coordinates in z, y, x order.
+    :return: Tuple of (labels, nan_mask, outside_mask). labels is 0 for spots
+             that are NaN or fall outside of the label image.
+    """
+    nan_mask = np.isnan(spots).any(axis=1)
+    rounded = np.zeros(spots.shape, dtype=np.int64)
+    rounded[~nan_mask] = np.round(spots[~nan_mask]).astype(np.int64)
+    outside_mask = ~nan_mask & ((rounded < 0).any(axis=1) | (rounded >= np.array(lb.shape)).any(axis=1))
+    inside = ~nan_mask & ~outside_mask
+
+    labels = np.zeros(len(spots), dtype=lb.dtype)
+    if isinstance(lb, np.ndarray):
+        labels[inside] = lb[rounded[inside, 0], rounded[inside, 1], rounded[inside, 2]]
+    else:
+        labels[inside] = read_labels_by_chunk(lb, rounded[inside])
+    return labels, nan_mask, outside_mask
+
+def build_label_index(lb_id, max_dense_size=2**27):
+    """
+    Builds a label -> row lookup for the count matrix.
+
+    Labels do not need to be contiguous. A dense lookup table is used when
+    the largest label is small enough, otherwise rows are found with a
+    binary search over the sorted labels.
+
+    :param lb_id: Sorted array of segment labels (without background).
+    :param max_dense_size: Largest label for which a dense table is built.
+    :return: Dense int32 lookup table (-1 for unknown labels), or None.
+    """
+    if len(lb_id) == 0 or int(lb_id[-1]) >= max_dense_size:
+        return None
+    lut = np.full(int(lb_id[-1]) + 1, -1, dtype=np.int32)
+    lut[lb_id.astype(np.int64)] = np.arange(len(lb_id), dtype=np.int32)
+    return lut
+
+def labels_to_rows(labels, lb_id, lut):
+    """
+    Maps labels to rows of the count matrix at O(1) cost per spot.
+
+    :param labels: Label under each spot (0 for unassigned spots).
+    :param lb_id: Sorted array of segment labels (without background).
+    :param lut: Dense lookup table from build_label_index, or None.
+    :return: int64 array of rows, -1 for spots that are not on a segment.
+    """
+    rows = np.full(len(labels), -1, dtype=np.int64)
+    if len(lb_id) == 0:
+        return rows
+    if lut is not None:
+        known = (labels > 0) & (labels < len(lut))
+        rows[known] = lut[labels[known].astype(np.int64)]
+    else:
+        pos = np.searchsorted(lb_id, labels)
+        pos[pos >= len(lb_id)] = 0
+        known = (labels > 0) & (lb_id[pos] == labels)
+        rows[known] = pos[known]
+    return rows
+
+def count_labels(labels, lb_id, lut):
+    """
+    Counts spots per segment with a bincount reduction.
+
+    :param labels: Label under each spot (0 for unassigned spots).
+    :param lb_id: Sorted array of segment labels (without background).
+    :param lut: Dense lookup table from build_label_index, or None.
+    :return: Tuple of (uint32 counts aligned with lb_id, number of assigned spots).
+    """
+    rows = labels_to_rows(labels, lb_id, lut)
+    rows = rows[rows >= 0]
+    counts = np.bincount(rows, minlength=len(lb_id)).astype(np.uint32)
+    return counts, len(rows)
+
+def print_skipped_spots(mask, message):
+    """
+    Reports skipped spots once per file instead of once per spot.
+
+    :param mask: Boolean mask of skipped spots.
+    :param message: Reason the spots were skipped.
+    """
+    lines = np.flatnonzero(mask) + 1
+    if len(lines) > 0:
+        print('{} on {} line(s), e.g. line# {}'.format(message, len(lines), ', '.join(str(l) for l in lines[:10])))
+
+def find_spot_files(spotsdir):
+    """
+    Lists every round/channel spot CSV produced by step 3.
+
+    :param spotsdir: step-3 output directory or its spots_registered subdirectory.
+    :return: Sorted list of spot CSV paths.
+    """
+    registered = os.path.join(spotsdir, 'spots_registered')
+    if os.path.isdir(registered):
+        spotsdir = registered
+    return sorted(glob.glob(os.path.join(spotsdir, '*spot*.csv')))
+
+def get_round(name):
+    """
+    Extracts the round (batch_time) from a spot file name, e.g. reg_spots_b1_t3_c0_s2 -> b1_t3.
+
+    :param name: Spot file name without extension.
+    :return: Round name, or the file name itself if it has no batch/time tag.
+    """
+    m = re.search(r'(?:^|_)(b\d+_t\d+)(?:_|$)', name)
+    return m.group(1) if m else name
+
+def assign_spot_file(f, lb, lb_id, lut, voxelsize):
+    """
+    Assigns the spots of one CSV file to segments.
+
+    :param f: Path to the spot CSV file.
+    :param lb: 3D label image (numpy or zarr array), shared between files.
+    :param lb_id: Sorted array of segment labels, shared between files.
+    :param lut: Label -> row lookup table from build_label_index, shared between files.
+    :param voxelsize: Relative voxel ratio in x, y, z order.
+    :return: Tuple of (counts aligned with lb_id, percentage of assigned spots).
+    """
+    r = os.path.basename(f).split('.')[0]
+    spots = scale_spots(read_3d_coordinates_from_csv(f).to_numpy(), voxelsize)
+    spot_labels, nan_mask, outside_mask = lookup_labels(lb, spots)
+    print_skipped_spots(nan_mask, r + ': NaN found')
+    print_skipped_spots(outside_mask, r + ': Point outside of fixed image found')
+
+    counts, assigned_spot_num = count_labels(spot_labels, lb_id, lut)
+    percentage = assigned_spot_num / len(spots) * 100.0 if len(spots) > 0 else 0.0
+    return counts, percentage
+
+def build_count_matrix(results, n_cells):
+    """
+    Builds a sparse cells x spot-files count matrix from per-file counts.
+
+    :param results: List of per-file uint32 counts aligned with lb_id.
+    :param n_cells: Number of segments.
+    :return: scipy.sparse CSC matrix (uint32).
+    """
+    data = []
+    indices = []
+    indptr = [0]
+    for counts in results:
+        nz = np.flatnonzero(counts)
+        data.append(counts[nz])
+        indices.append(nz)
+        indptr.append(indptr[-1] + len(nz))
+    data = np.concatenate(data) if data else np.array([], dtype=np.uint32)
+    indices = np.concatenate(indices) if indices else np.array([], dtype=np.int64)
+    return scipy.sparse.csc_matrix((data.astype(np.uint32), indices, np.array(indptr)), shape=(n_cells, len(results)))
+
+def write_count_matrix(path, count, lb_id, columns, fmt):
+    """
+    Writes a cells x spot-files count matrix.
+
+    csv writes a dense table. npz (scipy.sparse CSR, loadable with
+    scipy.sparse.load_npz / anndata) and mtx (Matrix Market) write only the
+    non-zero entries, plus <stem>_rows.csv (cell labels) and <stem>_cols.csv
+    (spot file names) next to the matrix.
+
+    :param path: Output file path.
+    :param count: scipy.sparse count matrix.
+    :param lb_id: Segment labels (rows).
+    :param columns: Spot file names (columns).
+    :param fmt: csv, npz or mtx.
+    """
+    print("Writing", path)
+    if fmt == 'csv':
+        pd.DataFrame(count.toarray(), index=lb_id, columns=columns).to_csv(path)
+        return
+    if fmt == 'npz':
+        scipy.sparse.save_npz(path, count.tocsr(), compressed=True)
+    elif fmt == 'mtx':
+        scipy.io.mmwrite(path, count.tocoo(), field='integer')
+    else:
+        raise ValueError("unknown output format: " + fmt)
+    stem = os.path.splitext(path)[0]
+    pd.DataFrame({'cell': lb_id}).to_csv(stem + '_rows.csv', index=False)
+    pd.DataFrame({'gene': columns}).to_csv(stem + '_cols.csv', index=False)
+
 def spot_assignment():
 
     argv = sys.argv
@@ -34,10 +390,18 @@ def spot_assignment():
     usage_text = ("Usage:" + "  spot_assignment.py" + " [options]")
     parser = argparse.ArgumentParser(description=usage_text)
     parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input spot csv files")
-    parser.add_argument("-s", "--seg", dest="seg", type=str, default=None, help="input segmented image file")
+    parser.add_argument("--spotsdir", dest="spotsdir", type=str, default=None, help="step-3 output directory; every *spot*.csv in it (or in its spots_registered subdirectory) is assigned")
+    parser.add_argument("-s", "--seg", dest="seg", type=str, default=None, help="input segmented image file (.tif) or N5/Zarr container")
+    parser.add_argument("-d", "--seg_dataset", dest="seg_dataset", type=str, default=None, help="dataset path of the segmentation in an N5/Zarr container (e.g. c0/s2)")
+    parser.add_argument("--chunked", dest="chunked", default=False, action="store_true", help="read the segmentation chunk by chunk instead of loading it into memory (always on for N5/Zarr)")
     parser.add_argument("-v", "--voxel", dest="voxel", type=str, default="1.0,1.0,1.0", help="voxel size")
     parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path")
     parser.add_argument("-p", "--output2", dest="output2", type=str, default=None, help="output file path 2 (percentage of assigned spots)")
+    parser.add_argument("-t", "--thread", dest="thread", type=int, default=1, help="number of spot files processed concurrently")
+    parser.add_argument("--shard_dir", dest="shard_dir", type=str, default=None, help="if set, also write one count matrix per round (batch_time) to this directory")
+    parser.add_argument("--max_dist", dest="max_dist", type=float, default=0.0, help="assign spots within this distance (in segmentation spacing units, e.g. um) to the nearest segment")
+    parser.add_argument("--seg_spacing", dest="seg_spacing", type=str, default=None, help="voxel spacing of the segmentation (x,y,z) used by --max_dist (default: N5 attributes or 1,1,1)")
+    parser.add_argument("-f", "--format", dest="format", type=str, default="csv", choices=["csv", "npz", "mtx"], help="count matrix format: csv (dense), npz (sparse CSR) or mtx (Matrix Market)")
 
     if not argv:
         parser.print_help()
@@ -45,70 +409,65 @@ def spot_assignment():
 
     args = parser.parse_args(argv)
 
-    input = args.input.split(",")
+    input = []
+    if args.input is not None:
+        input += args.input.split(",")
+    if args.spotsdir is not None:
+        input += find_spot_files(args.spotsdir)
+    if len(input) == 0:
+        print("no spot files found")
+        exit(1)
     output = args.output
     output2 = args.output2
     voxelsize = [float(num) if '.' in num else int(num) for num in args.voxel.split(',')]
     seg_file_path = args.seg
     
-    lb = tifffile.imread(seg_file_path)
-
-    lb_id = np.unique(lb[lb != 0])
-    z, y, x = lb.shape
+    # the label volume and its label-ID index are built once and shared by all spot files
+    lb = open_segmentation(seg_file_path, args.seg_dataset, args.chunked)
 
-    count = pd.DataFrame(np.empty([len(lb_id), 0]), index=lb_id)
+    lb_id = unique_labels(lb)
+    lut = build_label_index(lb_id)
 
     labels = []
     for f in input:
         r = os.path.basename(f).split('/')[-1]
         r = r.split('.')[0]
         labels.append(r)
-    percentages = pd.DataFrame(np.zeros([len(input), 1]), index=labels, columns=['percentage'])
 
-    file_count = 0
-    for f in input:
-        r = os.path.basename(f).split('/')[-1]
-        r = r.split('.')[0]
+    # the expanded labels are a temporary zarr store next to the output; it is
+    # removed whether or not the assignment succeeds
+    tmpdir = None
+    try:
+        if args.max_dist > 0:
+            seg_spacing = [float(num) for num in args.seg_spacing.split(',')] if args.seg_spacing is not None else None
+            spacing = get_seg_spacing(lb, seg_spacing)
+            print("expanding segments by " + str(args.max_dist) + " (spacing zyx: " + str(spacing) + ")")
+            lb, tmpdir = expand_labels(lb, args.max_dist, spacing, os.path.dirname(os.path.abspath(output)), args.thread)
+
+        print("assigning " + str(len(input)) + " spot file(s) to " + str(len(lb_id)) + " segments")
+        with ThreadPoolExecutor(max_workers=max(1, args.thread)) as executor:
+            results = list(executor.map(lambda f: assign_spot_file(f, lb, lb_id, lut, voxelsize), input))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
-        df = pd.DataFrame(np.zeros([len(lb_id), 1]), index=lb_id, columns=['count'])
-
-        spots = read_3d_coordinates_from_csv(f).to_numpy()
-        rounded_spots = np.round(spots).astype('int')
-
-        spot_id = 0
-        assigned_spot_num = 0
-        for spot in spots:
-            spot[0] = spot[0] * voxelsize[2]
-            spot[1] = spot[1] * voxelsize[1]
-            spot[2] = spot[2] * voxelsize[0]
-            #print("Z:", spot[0], "Y:", spot[1], "X:", spot[2])
-            rounded_spot = np.round(spot).astype('int')
-            if np.any(np.isnan(spot)):
-                print('NaN found on line# {}'.format(spot_id+1))
-            else:
-                if np.any(rounded_spot<0) or rounded_spot[0] >= z or rounded_spot[1] >= y or rounded_spot[2] >= x:
-                    print('Point outside of fixed image found on line# {}'.format(spot_id+1))
-                else:
-                    try:
-                        idx = lb[rounded_spot[0], rounded_spot[1], rounded_spot[2]]
-                        if idx > 0 and idx <= len(lb_id):
-                            # increment counter
-                            df.loc[idx, 'count'] = df.loc[idx, 'count']+1
-                            assigned_spot_num = assigned_spot_num + 1
-                    except Exception as e:
-                        print('Unexpected error on line# {}: {}'.format(spot_id+1, e))
-            spot_id += 1
-        count.loc[:, r] = df.to_numpy()
-        percentages.loc[r, 'percentage'] = assigned_spot_num / len(spots) * 100.0
-
-    count = count.astype(int)
-    print("Writing", output)
-    count.to_csv(output)
+    count = build_count_matrix([counts for counts, _ in results], len(lb_id))
+    percentages = pd.DataFrame([[percentage] for _, percentage in results], index=labels, columns=['percentage'])
+
+    write_count_matrix(output, count, lb_id, labels, args.format)
     percentages.to_csv(output2)
 
+    if args.shard_dir is not None:
+        os.makedirs(args.shard_dir, exist_ok=True)
+        rounds = [get_round(r) for r in labels]
+        for rd in sorted(set(rounds)):
+            cols = [i for i, x in enumerate(rounds) if x == rd]
+            shard_path = os.path.join(args.shard_dir, rd + '.' + args.format)
+            write_count_matrix(shard_path, count[:, cols], lb_id, [labels[i] for i in cols], args.format)
+
 def main():
     spot_assignment()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -16,22 +16,27 @@ import copy
 
 import json
 
+import shutil
+
+from fiji_worker import submit_job
+from stitch_cache import get_layout, layout_key, transform_counts, get_link_stats, extract_solution, seed_solution, max_correction, find_solution, save_solution, acquire_reference, release_reference, wait_for_reference
+
 
 # https://kevinmccarthy.org/2016/07/25/streaming-subprocess-stdin-and-stdout-with-asyncio-in-python/
 async def _read_stream(stream, cb):  
     while True:
-        ch = await stream.read(1)
-        if ch:
+        line = await stream.readline()
+        if line:
             try:
-                cb(ch.decode("utf-8"))
+                cb(line.decode("utf-8"))
             except UnicodeDecodeError:
-                print(ch)
+                print(line)
         else:
             break
 
 async def _stream_subprocess(cmd, stdout_cb, stderr_cb):  
     process = await asyncio.create_subprocess_exec(*cmd,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=1 << 20)
 
     await asyncio.wait([
         asyncio.create_task(_read_stream(process.stdout, stdout_cb)),
@@ -52,6 +57,82 @@ def execute(cmd, stdout_cb, stderr_cb):
     return rc
 ##################
 
+def run_macro(ij, memory, macro_path, kind, arg, worker=None, timeout=None):
+    """
+    Run a stitching macro in a new headless Fiji, or as a job on a running worker.
+
+    :param timeout: Seconds to wait for a job on the worker.
+    :return: Exit code.
+    """
+    if worker is not None:
+        print("running on the Fiji worker " + worker + "...")
+        return submit_job(worker, kind, arg, timeout=timeout)
+
+    commands = []
+    commands.append(f"{ij}")
+    if memory is not None:
+        commands.append("--mem")
+        commands.append(memory)
+    commands.append("--headless")
+    commands.append("-macro")
+    commands.append(macro_path)
+    commands.append(arg)
+
+    print("running imagej...")
+    logging.info(commands)
+    return execute(
+        commands,
+        lambda x: print("%s" % x, end=''),
+       lambda x: print("%s" % x, end=''),
+    )
+
+def pairwise_args(input, downsample):
+    return "select=" + input + " process_angle=[All angles] process_channel=[All channels] process_illumination=[All illuminations] process_tile=[All tiles] process_timepoint=[All Timepoints] method=[Phase Correlation] downsample_in_x=" + downsample[0] + " downsample_in_y=" + downsample[1] + " downsample_in_z=" + downsample[2]
+
+def filter_args(input, minr):
+    return "select=" + input + " filter_by_link_quality min_r="+ str(minr) +" max_r=1 filter_by_shift_in_each_dimension max_shift_in_x=100 max_shift_in_y=100 max_shift_in_z=100 max_displacement=0"
+
+def optimize_args(input):
+    return "select=" + input + " process_angle=[All angles] process_channel=[All channels] process_illumination=[All illuminations] process_tile=[All tiles] process_timepoint=[All Timepoints] relative=2.500 absolute=3.500 global_optimization_strategy=[Two-Round using Metadata to align unconnected Tiles and iterative dropping of bad links] fix_group_0-0"
+
+def verify_cached_solution(args, ij, macro_dir, input, cached, downsample):
+    """
+    Seed the XML with a cached solution and check it with a coarse pairwise
+    shift calculation and global optimization (no ICP).
+    The XML is restored if the solution is rejected.
+
+    :return: True if the cached solution is kept.
+    """
+    backup = input + ".nocache"
+    shutil.copyfile(input, backup)
+
+    seeded = ET.parse(input)
+    if not seed_solution(seeded, cached['solution']):
+        print("cached solution does not contain every view")
+        os.remove(backup)
+        return False
+    seeded.write(input)
+    seeded_counts = transform_counts(seeded)
+
+    verify_downsample = [str(int(downsample[0]) * 2), str(int(downsample[1]) * 2), downsample[2]]
+    ijargs = pairwise_args(input, verify_downsample) + ";" + filter_args(input, args.minr) + ";" + optimize_args(input) + ";" + str(args.thread)
+    rc = run_macro(ij, args.memory, os.path.join(macro_dir, "run_verify.ijm"), "verify", ijargs, args.worker, args.job_timeout or None)
+
+    verified = ET.parse(input)
+    links, mean_r = get_link_stats(verified)
+    correction = max_correction(verified, seeded_counts)
+    print("verification: links " + str(links) + " (cached " + str(cached['links']) + "), mean r " + str(mean_r) + " (cached " + str(cached['mean_r']) + "), max correction " + str(correction))
+    ok = rc == 0 and mean_r is not None \
+        and links >= cached['links'] * args.min_links \
+        and mean_r >= cached['mean_r'] - args.max_r_drop \
+        and correction <= args.max_correction
+    if ok:
+        os.remove(backup)
+    else:
+        print("cached solution rejected, running full stitching")
+        os.replace(backup, input)
+    return ok
+
 def main():
 
     argv = sys.argv
@@ -61,10 +142,18 @@ def main():
     parser = argparse.ArgumentParser(description=usage_text)
     parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input files")
     parser.add_argument("-j", "--imagej", dest="imagej", type=str, default=None, help="path to imagej")
+    parser.add_argument("-w", "--worker", dest="worker", type=str, default=None, help="queue directory of a running Fiji worker (fiji_worker.py start), instead of starting imagej")
+    parser.add_argument("--job_timeout", dest="job_timeout", type=float, default=43200, help="seconds after which a hanging job on the Fiji worker is given up and the worker is killed (0: wait forever); failed jobs return at once")
     parser.add_argument("-m", "--memory", dest="memory", type=str, default=None, help="amount of heap memory")
     parser.add_argument("-d", "--downsample", dest="downsample", type=str, default="2,2,1", help="downsampling factors")
     parser.add_argument("-r", "--minr", dest="minr", type=float, default=0.1, help="lower threshold of the filter")
     parser.add_argument("-t", "--thread", dest="thread", type=int, default=1, help="number of threads")
+    parser.add_argument("-c", "--cache", dest="cache", type=str, default=None, help="directory of cached stitching solutions shared by timepoints and batches with the same tile layout")
+    parser.add_argument("--cache_wait", dest="cache_wait", type=float, default=14400, help="seconds a timepoint waits for the reference timepoint of its layout to stitch and cache a solution")
+    parser.add_argument("--cache_tolerance", dest="cache_tolerance", type=float, default=5.0, help="largest difference of the tile locations and registrations (units of the XML) at which a cached layout is reused")
+    parser.add_argument("--max_correction", dest="max_correction", type=float, default=5.0, help="largest shift of a tile (global units) at which a cached solution is accepted")
+    parser.add_argument("--min_links", dest="min_links", type=float, default=0.9, help="fraction of the cached links that has to pass the filter")
+    parser.add_argument("--max_r_drop", dest="max_r_drop", type=float, default=0.1, help="largest drop of the mean link correlation compared to the cached solution")
     parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
 
     if not argv:
@@ -101,33 +190,59 @@ def main():
         json.dump(data, f, indent=4)
         f.truncate() 
 
-    ijargs2 = "select=" + input + " process_angle=[All angles] process_channel=[All channels] process_illumination=[All illuminations] process_tile=[All tiles] process_timepoint=[All Timepoints] method=[Phase Correlation] downsample_in_x=" + downsample[0] + " downsample_in_y=" + downsample[1] + " downsample_in_z=" + downsample[2]
-    ijargs2 += ";"
-    ijargs2 += "select=" + input + " filter_by_link_quality min_r="+ str(minr) +" max_r=1 filter_by_shift_in_each_dimension max_shift_in_x=100 max_shift_in_y=100 max_shift_in_z=100 max_displacement=0"
-    ijargs2 += ";"
-    ijargs2 += "select=" + input + " process_angle=[All angles] process_channel=[All channels] process_illumination=[All illuminations] process_tile=[All tiles] process_timepoint=[All Timepoints] relative=2.500 absolute=3.500 global_optimization_strategy=[Two-Round using Metadata to align unconnected Tiles and iterative dropping of bad links] fix_group_0-0"
-    ijargs2 += ";"
-    ijargs2 += "select=" + input +  " process_angle=[All angles] process_channel=[All channels] process_illumination=[All illuminations] process_tile=[All tiles] process_timepoint=[All Timepoints] icp_refinement_type=[Expert ...] global_optimization_strategy=[Two-Round: Handle unconnected tiles, remove wrong links RELAXED (5.0x / 7.0px)] interest_points=forICP_2_1 icp_maximum_error=5 transformation=Affine regularize_model model_to_regularize_with=Translation lambda=0.10 group_channels=[Group all]"
-
-    ijargs2 += ";"
-    ijargs2 += str(threadnum)
-    commands = []
-    commands.append(f"{ij}")
-    if args.memory is not None:
-        commands.append("--mem")
-        commands.append(args.memory)
-    commands.append("--headless")
-    commands.append("-macro")
-    commands.append(os.path.join(macro_dir, "run_stitch.ijm"))
-    commands.append(ijargs2)
-
-    print("running imagej...")
-    logging.info(commands)
-    print(execute(
-        commands,
-        lambda x: print("%s" % x, end=''),
-       lambda x: print("%s" % x, end=''),
-    ))
+    layout = None
+    reference = False
+    if args.cache is not None:
+        layout = get_layout(xml)
+        counts = transform_counts(xml)
+        found = find_solution(args.cache, layout, args.cache_tolerance)
+        if found is None:
+            # parallel timepoints: one stitches fully, the others reuse its solution
+            reference = acquire_reference(args.cache, layout)
+            if not reference:
+                print("waiting for the reference timepoint of layout " + layout_key(layout))
+                found = wait_for_reference(args.cache, layout, args.cache_tolerance, args.cache_wait)
+                if found is None:
+                    reference = acquire_reference(args.cache, layout)
+        if found is not None:
+            cached, distance = found
+            print("cached stitching solution " + cached['key'] + " from " + cached['source'] + ", layout distance " + str(distance))
+            if verify_cached_solution(args, ij, macro_dir, input, cached, downsample):
+                print("cached stitching solution verified")
+                print(0)
+                return
+        else:
+            print("no cached stitching solution for " + layout_key(layout))
+
+    try:
+        ijargs2 = pairwise_args(input, downsample)
+        ijargs2 += ";"
+        ijargs2 += filter_args(input, minr)
+        ijargs2 += ";"
+        ijargs2 += optimize_args(input)
+        ijargs2 += ";"
+        ijargs2 += "select=" + input +  " process_angle=[All angles] process_channel=[All channels] process_illumination=[All illuminations] process_tile=[All tiles] process_timepoint=[All Timepoints] icp_refinement_type=[Expert ...] global_optimization_strategy=[Two-Round: Handle unconnected tiles, remove wrong links RELAXED (5.0x / 7.0px)] interest_points=forICP_2_1 icp_maximum_error=5 transformation=Affine regularize_model model_to_regularize_with=Translation lambda=0.10 group_channels=[Group all]"
+
+        ijargs2 += ";"
+        ijargs2 += str(threadnum)
+        rc = run_macro(ij, args.memory, os.path.join(macro_dir, "run_stitch.ijm"), "stitch", ijargs2, args.worker, args.job_timeout or None)
+        print(rc)
+
+        if layout is not None and rc == 0:
+            stitched = ET.parse(input)
+            links, mean_r = get_link_stats(stitched)
+            if mean_r is None:
+                print("no pairwise links in " + input + ", the solution is not cached")
+            else:
+                save_solution(args.cache, layout, extract_solution(stitched, counts), links, mean_r, input)
+                print("stitching solution cached: " + layout_key(layout))
+    finally:
+        if reference:
+            release_reference(args.cache, layout)
+
+    # a failed job on the worker is reported, so that a batch of timepoints stops
+    if args.worker is not None and rc != 0:
+        sys.exit(rc)
 
 if __name__ == '__main__':
     main()
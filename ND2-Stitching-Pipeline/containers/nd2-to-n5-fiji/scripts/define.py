@@ -14,22 +14,24 @@ import asyncio
 import xml.etree.ElementTree as ET
 import copy
 
+from fiji_worker import submit_job
+
 
 # https://kevinmccarthy.org/2016/07/25/streaming-subprocess-stdin-and-stdout-with-asyncio-in-python/
 async def _read_stream(stream, cb):  
     while True:
-        ch = await stream.read(1)
-        if ch:
+        line = await stream.readline()
+        if line:
             try:
-                cb(ch.decode("utf-8"))
+                cb(line.decode("utf-8"))
             except UnicodeDecodeError:
-                print(ch)
+                print(line)
         else:
             break
 
 async def _stream_subprocess(cmd, stdout_cb, stderr_cb):  
     process = await asyncio.create_subprocess_exec(*cmd,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=1 << 20)
 
     await asyncio.wait([
         asyncio.create_task(_read_stream(process.stdout, stdout_cb)),
@@ -60,6 +62,8 @@ def main():
     parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input files")
     parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path (.xml)")
     parser.add_argument("-j", "--imagej", dest="imagej", type=str, default=None, help="path to imagej")
+    parser.add_argument("-w", "--worker", dest="worker", type=str, default=None, help="queue directory of a running Fiji worker (fiji_worker.py start), instead of starting imagej")
+    parser.add_argument("--job_timeout", dest="job_timeout", type=float, default=43200, help="seconds after which a hanging job on the Fiji worker is given up and the worker is killed (0: wait forever); failed jobs return at once")
     parser.add_argument("-t", "--thread", dest="thread", type=int, default=0, help="number of threads")
     parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
 
@@ -87,6 +91,12 @@ def main():
 
     imagej_arg = "define_dataset=[Automatic Loader (Bioformats based)] project_filename=" + dataname + " path=" + input + " exclude=10 bioformats_series_are?=Tiles move_tiles_to_grid_(per_angle)?=[Do not move Tiles to Grid (use Metadata if available)] how_to_load_images=[Load raw data directly] load_raw_data_virtually dataset_save_path=" + outdirpath
 
+    if args.worker is not None:
+        print("running on the Fiji worker " + args.worker + "...")
+        rc = submit_job(args.worker, "define", imagej_arg, timeout=args.job_timeout or None)
+        print(rc)
+        sys.exit(rc)
+
     commands = []
     commands.append(f"{ij}")
     commands.append("--headless")
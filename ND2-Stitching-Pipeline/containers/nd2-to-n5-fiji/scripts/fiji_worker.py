@@ -0,0 +1,219 @@
+import os
+import sys
+import argparse
+
+import subprocess
+
+import logging
+
+import time
+
+import signal
+
+# A long-lived headless Fiji that runs define/stitch macro jobs from a queue
+# directory (run_worker.ijm). Jobs are files <name>.job with the job type
+# (define, stitch, verify or stop) on the first line and the macro arguments on
+# the second; the worker writes <name>.done when the job is finished, preceded
+# by <name>.failed if a command of the job failed.
+# Its output goes to worker.log in the queue directory.
+# The job timeout is only a last resort for a worker that hangs; clients kill
+# the worker when it expires.
+# nd2n5.nf uses one worker per run for calc_stitching_batch (--stitchWorker).
+
+def worker_pid(queue_dir):
+    """
+    Process id of the worker of a queue, or None if it is not running.
+    """
+    pid_path = os.path.join(queue_dir, "worker.pid")
+    if not os.path.exists(pid_path):
+        return None
+    with open(pid_path, 'r') as f:
+        pid = int(f.read().strip())
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return None
+    return pid
+
+def start_worker(queue_dir, ij="/app/fiji/Fiji.app/ImageJ-linux64", memory=None, timeout=600):
+    """
+    Start a headless Fiji worker for a queue directory and wait until it is ready.
+    Does nothing if a worker is already running.
+
+    :param queue_dir: Queue directory shared with the clients.
+    :param ij: Path to the ImageJ launcher.
+    :param memory: Heap size (e.g. 500G).
+    :param timeout: Seconds to wait for the worker to start.
+    :return: Process id of the worker.
+    """
+    os.makedirs(queue_dir, exist_ok=True)
+    pid = worker_pid(queue_dir)
+    if pid is not None:
+        print("Fiji worker is already running: " + str(pid))
+        return pid
+
+    ready_path = os.path.join(queue_dir, "worker.ready")
+    if os.path.exists(ready_path):
+        os.remove(ready_path)
+
+    macro_dir = os.path.dirname(os.path.realpath(__file__))
+    commands = [ij]
+    if memory is not None:
+        commands.append("--mem")
+        commands.append(memory)
+    commands.append("--headless")
+    commands.append("-macro")
+    commands.append(os.path.join(macro_dir, "run_worker.ijm"))
+    commands.append(os.path.abspath(queue_dir))
+    logging.info(commands)
+
+    log = open(os.path.join(queue_dir, "worker.log"), 'ab')
+    process = subprocess.Popen(commands, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+    with open(os.path.join(queue_dir, "worker.pid"), 'w') as f:
+        f.write(str(process.pid))
+
+    start = time.time()
+    while not os.path.exists(ready_path):
+        if process.poll() is not None:
+            raise RuntimeError("Fiji worker exited with " + str(process.returncode) + ", see " + os.path.join(queue_dir, "worker.log"))
+        if time.time() - start > timeout:
+            raise RuntimeError("Fiji worker did not start in " + str(timeout) + " seconds")
+        time.sleep(0.5)
+    print("Fiji worker started: " + str(process.pid) + " (" + str(int(time.time() - start)) + " s)")
+    return process.pid
+
+def kill_worker(queue_dir):
+    """
+    Kill the worker of a queue and the JVM started by its launcher.
+    """
+    pid = worker_pid(queue_dir)
+    if pid is not None:
+        # the worker runs in its own session, its process group holds the JVM
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            os.kill(pid, signal.SIGKILL)
+    for name in ["worker.pid", "worker.ready"]:
+        if os.path.exists(os.path.join(queue_dir, name)):
+            os.remove(os.path.join(queue_dir, name))
+
+def submit_job(queue_dir, kind, arg, stdout_cb=None, poll=0.2, timeout=None):
+    """
+    Run a job on the worker of a queue and wait for it to finish. The worker
+    output written while the job runs is passed to stdout_cb line by line.
+
+    :param kind: Job type (define, stitch, verify or stop).
+    :param arg: Macro arguments of the job.
+    :param stdout_cb: Called with every output line.
+    :param timeout: Seconds after which the worker is killed, e.g. when it hangs
+        and the job will never finish. None waits forever.
+    :return: 0 if the job finished, 1 if it failed or the worker exited or was killed.
+    """
+    if stdout_cb is None:
+        stdout_cb = lambda x: print("%s" % x, end='')
+    if worker_pid(queue_dir) is None:
+        print("no Fiji worker is running for " + queue_dir)
+        return 1
+
+    # names sort in submission order, the worker takes the first job
+    name = str(time.time_ns()) + "_" + str(os.getpid())
+    job_path = os.path.join(queue_dir, name + ".job")
+    done_path = os.path.join(queue_dir, name + ".done")
+    failed_path = os.path.join(queue_dir, name + ".failed")
+    log_path = os.path.join(queue_dir, "worker.log")
+
+    with open(job_path + ".tmp", 'w') as f:
+        f.write(kind + "\n" + arg.replace("\n", " ") + "\n")
+    offset = os.path.getsize(log_path)
+    os.replace(job_path + ".tmp", job_path)
+
+    rc = 0
+    start = time.time()
+    with open(log_path, 'r', errors='replace') as log:
+        log.seek(offset)
+        started = False
+        pending = ""
+        while True:
+            finished = os.path.exists(done_path)
+            pending += log.read()
+            lines = pending.split("\n")
+            pending = lines.pop()
+            for line in lines:
+                # only print the output of this job
+                if line.startswith("JOB_START " + name):
+                    started = True
+                if started:
+                    stdout_cb(line + "\n")
+                if line.startswith("JOB_DONE " + name):
+                    started = False
+            if finished:
+                break
+            if kind != "stop" and worker_pid(queue_dir) is None:
+                print("Fiji worker exited while running " + name)
+                rc = 1
+                break
+            if timeout is not None and time.time() - start > timeout:
+                print("job " + name + " did not finish in " + str(timeout) + " seconds, killing the Fiji worker")
+                kill_worker(queue_dir)
+                if os.path.exists(job_path):
+                    os.remove(job_path)
+                rc = 1
+                break
+            time.sleep(poll)
+
+    if os.path.exists(failed_path):
+        with open(failed_path, 'r') as f:
+            print("job " + name + " " + f.read().strip())
+        os.remove(failed_path)
+        rc = 1
+    if os.path.exists(done_path):
+        os.remove(done_path)
+    return rc
+
+def stop_worker(queue_dir, timeout=60):
+    pid = worker_pid(queue_dir)
+    if pid is None:
+        print("no Fiji worker is running for " + queue_dir)
+        return
+    submit_job(queue_dir, "stop", "")
+    start = time.time()
+    while worker_pid(queue_dir) is not None and time.time() - start < timeout:
+        time.sleep(0.5)
+    if worker_pid(queue_dir) is not None:
+        os.kill(pid, 15)
+    os.remove(os.path.join(queue_dir, "worker.pid"))
+    print("Fiji worker stopped: " + str(pid))
+
+def main():
+
+    argv = sys.argv
+    argv = argv[1:]
+
+    usage_text = ("Usage:" + "  fiji_worker.py" + " start|stop [options]")
+    parser = argparse.ArgumentParser(description=usage_text)
+    parser.add_argument("command", type=str, choices=["start", "stop"], help="start or stop the worker")
+    parser.add_argument("-q", "--queue", dest="queue", type=str, default=None, help="queue directory, passed to define.py and calc_stitch.py with --worker")
+    parser.add_argument("-j", "--imagej", dest="imagej", type=str, default=None, help="path to imagej")
+    parser.add_argument("-m", "--memory", dest="memory", type=str, default=None, help="amount of heap memory")
+    parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
+
+    if not argv:
+        parser.print_help()
+        exit()
+
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    ij = "/app/fiji/Fiji.app/ImageJ-linux64"
+    if args.imagej is not None:
+        ij = args.imagej
+
+    if args.command == "start":
+        start_worker(args.queue, ij=ij, memory=args.memory)
+    else:
+        stop_worker(args.queue)
+
+if __name__ == '__main__':
+    main()
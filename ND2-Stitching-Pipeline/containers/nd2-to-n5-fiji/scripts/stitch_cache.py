@@ -0,0 +1,218 @@
+import os
+
+import xml.etree.ElementTree as ET
+
+import json
+
+import hashlib
+
+import glob
+
+import time
+
+import socket
+
+# Stitching solutions are cached per tile layout. A layout is the view setups
+# (size, voxel size), the tile locations and the registrations before
+# stitching. Cached layouts are matched by structure (same setups, tiles and
+# number of transforms) and then by position within a tolerance, so that the
+# stage jitter between rounds does not prevent reuse. A cached entry holds the
+# transforms that stitching prepended to every ViewRegistration, plus the link
+# statistics of the full stitching run.
+# Timepoints of one run are stitched in parallel. The first of them without a
+# cached solution becomes the reference of its layout structure (a <key>.lock
+# file in the cache directory) and stitches fully; the others wait for it and
+# then verify its solution instead of stitching from scratch.
+
+def get_layout(xml):
+    """
+    Tile-grid metadata of a BigStitcher XML.
+
+    :param xml: Parsed XML (ElementTree) before stitching.
+    :return: JSON-serializable layout.
+    """
+    setups = []
+    for item in xml.findall(".//ViewSetup"):
+        setups.append([item.find("./id").text, item.find("./size").text.split(), item.find("./voxelSize/size").text.split()])
+    tiles = {}
+    for item in xml.findall(".//Tile"):
+        id_item = item.find("./id")
+        location = item.find("./location")
+        if id_item is None or location is None:
+            continue
+        tiles[id_item.text] = [float(v) for v in location.text.split()]
+    registrations = {}
+    for item in xml.findall(".//ViewRegistration"):
+        registrations[item.attrib['setup']] = [[float(v) for v in vt.find("affine").text.split()] for vt in item.findall("./ViewTransform")]
+    return {'setups': sorted(setups), 'tiles': tiles, 'registrations': registrations}
+
+def layout_key(layout):
+    """
+    Hash of the structure of a layout: setups, tile ids and number of transforms
+    per view. Layouts with the same key are compared by layout_distance.
+    """
+    structure = [layout['setups'], sorted(layout['tiles']), sorted([s, len(a)] for s, a in layout['registrations'].items())]
+    return hashlib.sha1(json.dumps(structure, sort_keys=True).encode("utf-8")).hexdigest()
+
+def layout_distance(a, b):
+    """
+    Largest difference of the tile locations and registration affines of two layouts.
+
+    :return: Distance, or None if the layouts do not have the same structure.
+    """
+    if layout_key(a) != layout_key(b):
+        return None
+    distance = 0.0
+    for tile_id, location in a['tiles'].items():
+        distance = max([distance] + [abs(u - v) for u, v in zip(location, b['tiles'][tile_id])])
+    for setup_id, affines in a['registrations'].items():
+        for affine_a, affine_b in zip(affines, b['registrations'][setup_id]):
+            distance = max([distance] + [abs(u - v) for u, v in zip(affine_a, affine_b)])
+    return distance
+
+def transform_counts(xml):
+    """
+    Number of ViewTransforms of each ViewRegistration (setup id -> count).
+    """
+    return {item.attrib['setup']: len(item.findall("./ViewTransform")) for item in xml.findall(".//ViewRegistration")}
+
+def get_link_stats(xml):
+    """
+    Number and mean correlation of the pairwise links kept in the StitchingResults.
+
+    :return: (number of links, mean correlation or None)
+    """
+    correlations = []
+    for item in xml.findall(".//PairwiseResult"):
+        r = item.find("./correlation")
+        if r is not None:
+            correlations.append(float(r.text))
+    if not correlations:
+        return 0, None
+    return len(correlations), sum(correlations) / len(correlations)
+
+def extract_solution(xml, counts):
+    """
+    Transforms prepended by stitching to each ViewRegistration.
+
+    :param xml: Parsed XML after stitching.
+    :param counts: transform_counts of the XML before stitching.
+    :return: Dictionary setup id -> list of (name, affine text), outermost first.
+    """
+    solution = {}
+    for item in xml.findall(".//ViewRegistration"):
+        transforms = item.findall("./ViewTransform")
+        added = transforms[:len(transforms) - counts[item.attrib['setup']]]
+        solution[item.attrib['setup']] = [(vt.find("./Name").text, vt.find("affine").text) for vt in added]
+    return solution
+
+def seed_solution(xml, solution):
+    """
+    Prepend the cached transforms to the ViewRegistrations of an XML.
+
+    :return: False if a view of the XML is not in the solution.
+    """
+    registrations = xml.findall(".//ViewRegistration")
+    if any(item.attrib['setup'] not in solution for item in registrations):
+        return False
+    for item in registrations:
+        for i, (name, affine) in enumerate(solution[item.attrib['setup']]):
+            vt = ET.Element("ViewTransform", {'type': 'affine'})
+            ET.SubElement(vt, "Name").text = name
+            ET.SubElement(vt, "affine").text = affine
+            item.insert(i, vt)
+    return True
+
+def max_correction(xml, counts):
+    """
+    Largest translation of the transforms prepended since counts was taken.
+    """
+    largest = 0.0
+    for item in xml.findall(".//ViewRegistration"):
+        transforms = item.findall("./ViewTransform")
+        for vt in transforms[:len(transforms) - counts[item.attrib['setup']]]:
+            a = [float(v) for v in vt.find("affine").text.split()]
+            largest = max(largest, (a[3] ** 2 + a[7] ** 2 + a[11] ** 2) ** 0.5)
+    return largest
+
+def cache_path(cache_dir, layout):
+    """
+    One file per cached layout, named by its structure key and a hash of its positions.
+    """
+    positions = hashlib.sha1(json.dumps(layout, sort_keys=True).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, layout_key(layout) + "-" + positions[:16] + ".json")
+
+def find_solution(cache_dir, layout, tolerance):
+    """
+    Cached solution of the closest layout with the same structure.
+
+    :param tolerance: Largest accepted layout_distance (units of the XML).
+    :return: (cached entry, distance) or None.
+    """
+    best = None
+    for path in sorted(glob.glob(os.path.join(cache_dir, layout_key(layout) + "-*.json"))):
+        with open(path, 'r') as f:
+            cached = json.load(f)
+        distance = layout_distance(layout, cached['layout'])
+        if distance is not None and distance <= tolerance and (best is None or distance < best[1]):
+            best = (cached, distance)
+    return best
+
+def save_solution(cache_dir, layout, solution, links, mean_r, source):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, layout)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'key': layout_key(layout), 'source': source, 'links': links, 'mean_r': mean_r, 'layout': layout, 'solution': solution}, f, indent=4)
+    os.replace(tmp_path, path)
+
+def lock_path(cache_dir, layout):
+    return os.path.join(cache_dir, layout_key(layout) + ".lock")
+
+def acquire_reference(cache_dir, layout):
+    """
+    Become the reference of a layout structure, unless another run already is.
+
+    :return: True if this run holds the lock and has to call release_reference.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        fd = os.open(lock_path(cache_dir, layout), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(socket.gethostname() + " " + str(os.getpid()) + "\n")
+    return True
+
+def release_reference(cache_dir, layout):
+    try:
+        os.remove(lock_path(cache_dir, layout))
+    except FileNotFoundError:
+        # another run removed it as stale
+        pass
+
+def wait_for_reference(cache_dir, layout, tolerance, timeout, poll=10):
+    """
+    Wait until the reference of the layout structure has finished, then look for
+    its solution. A lock older than timeout is treated as left over by a killed run.
+
+    :param timeout: Seconds to wait at most.
+    :return: (cached entry, distance) or None, as find_solution.
+    """
+    path = lock_path(cache_dir, layout)
+    start = time.time()
+    while os.path.exists(path):
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except OSError:
+            # released in the meantime
+            break
+        if age > timeout:
+            print("removing the stale reference lock " + path)
+            release_reference(cache_dir, layout)
+            break
+        if time.time() - start > timeout:
+            print("gave up waiting for the reference timepoint (" + path + ")")
+            break
+        time.sleep(poll)
+    return find_solution(cache_dir, layout, tolerance)
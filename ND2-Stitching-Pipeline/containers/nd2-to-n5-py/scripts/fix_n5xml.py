@@ -16,6 +16,8 @@ import copy
 
 import json
 
+from xml_transform import get_affines, set_affines, flip_translations
+
 def main():
 
     argv = sys.argv
@@ -44,30 +46,14 @@ def main():
     stem = os.path.splitext(dataname)[0]
 
     xml = ET.parse(input)
-    for item in xml.findall(".//ViewTransform"):
-        name = item.find("./Name").text
-        if name == "Translation":
-            str_mat = item.find("affine")
-            print(str_mat.text)
-            mat_str_array = str_mat.text.split(" ")
-            out_str_mat = ""
-            count = 0
-            for elem in mat_str_array:
-                if count == 7:
-                    fval = float(elem)
-                    fval *= -1.0
-                    out_str_mat += " " + str(fval)
-                else:
-                    if count > 0:
-                        out_str_mat += " "
-                    out_str_mat += elem
-                count += 1
-            print(out_str_mat)
-            str_mat.text = out_str_mat
+    # the y axis of the stage is flipped
+    elements, affines = get_affines(xml.findall(".//ViewRegistration"), name="Translation")
+    set_affines(elements, flip_translations(affines, 1))
+    print(str(len(elements)) + " translations flipped")
 
     xml.write(output)
 
-    
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,266 @@
+import numpy as np
+
+import os
+import sys
+import argparse
+
+import dask
+from distributed import LocalCluster, Client
+
+# This module is also copied into the bigstream-py (genmask.py) and cellpose-cuda
+# (segmentation.py) images, which do not all have z5py; z5py is only imported
+# by main().
+
+HISTOGRAM_FILE = "histogram.npz"
+
+def histogram_length(dtype):
+    """
+    Number of bins of an exact per-value histogram (65536 for uint16).
+
+    :param dtype: Integer dtype of the dataset.
+    :return: Number of bins.
+    """
+    return int(np.iinfo(dtype).max) + 1
+
+def compute_chunk_histogram(dataset, idx, minlength):
+    """
+    Exact histogram of one chunk with one bin per intensity value.
+
+    :param dataset: z5py dataset.
+    :param idx: Chunk position.
+    :param minlength: Number of bins.
+    :return: int64 histogram, or zeros if the chunk is missing or unreadable.
+    """
+    try:
+        # Attempt to read the chunk
+        data_chunk = dataset.read_chunk(idx)
+        if data_chunk is None:
+            print(f"Chunk {idx} is missing. It will be ignored.")
+            return np.zeros(minlength, dtype=np.int64)
+
+        return np.bincount(data_chunk.ravel(), minlength=minlength)
+
+    except Exception as e:
+        print(f"Error reading chunk {idx}: {e}")
+        return np.zeros(minlength, dtype=np.int64)
+
+def sum_histograms(*histograms):
+    return np.sum(histograms, axis=0)
+
+def compute_histogram(dataset, fan_in=16):
+    """
+    Exact histogram of a whole dataset. Chunks are counted in parallel and the
+    partial histograms are summed as a tree.
+
+    :param dataset: z5py dataset (unsigned integer).
+    :param fan_in: Number of partial histograms summed by one task.
+    :return: int64 histogram with one bin per intensity value.
+    """
+    minlength = histogram_length(dataset.dtype)
+    num_chunks = [int(np.ceil(s / c)) for s, c in zip(dataset.shape, dataset.chunks)]
+    partials = [dask.delayed(compute_chunk_histogram)(dataset=dataset, idx=idx, minlength=minlength) for idx in np.ndindex(*num_chunks)]
+    while len(partials) > 1:
+        partials = [dask.delayed(sum_histograms)(*partials[i:i + fan_in]) for i in range(0, len(partials), fan_in)]
+    return dask.compute(partials[0])[0]
+
+def histogram_path(dataset_path):
+    return os.path.join(dataset_path, HISTOGRAM_FILE)
+
+def chunk_fingerprint(dataset_path):
+    """
+    Number, total size and latest modification time of the chunk files of a
+    dataset. Rewriting any chunk changes it, also when the shape stays the same.
+    Only the numbered chunk directories are scanned, so attributes.json and the
+    other files next to the chunks are ignored.
+
+    :param dataset_path: Path of the dataset directory.
+    :return: int64 array [count, bytes, max mtime in ns].
+    """
+    count = 0
+    size = 0
+    mtime = 0
+    stack = [entry.path for entry in os.scandir(dataset_path) if entry.is_dir() and entry.name.isdigit()]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            if entry.is_dir():
+                stack.append(entry.path)
+            elif entry.name.isdigit():
+                st = entry.stat()
+                count += 1
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime_ns)
+    return np.array([count, size, mtime], dtype=np.int64)
+
+def matches_chunks(fingerprint, dataset_path):
+    """
+    Whether a stored chunk_fingerprint still describes the chunks of a dataset.
+
+    :param fingerprint: Stored fingerprint (array or list), None if there is none.
+    :param dataset_path: Path of the dataset directory.
+    :return: bool.
+    """
+    if fingerprint is None:
+        return False
+    return np.array_equal(np.asarray(fingerprint, dtype=np.int64), chunk_fingerprint(dataset_path))
+
+def save_histogram(dataset_path, hist, dataset, fingerprint=None):
+    """
+    Write the histogram next to the chunks of the dataset.
+    The shape, chunk size, dtype and the chunk fingerprint are stored to detect
+    a stale file.
+
+    :param fingerprint: chunk_fingerprint taken before the histogram was computed (taken now if None).
+    """
+    if fingerprint is None:
+        fingerprint = chunk_fingerprint(dataset_path)
+    tmp_path = histogram_path(dataset_path) + ".tmp.npz"
+    np.savez(tmp_path, hist=hist, shape=np.asarray(dataset.shape), chunks=np.asarray(dataset.chunks), dtype=str(np.dtype(dataset.dtype)), fingerprint=fingerprint)
+    os.replace(tmp_path, histogram_path(dataset_path))
+
+def load_histogram(dataset_path, dataset=None):
+    """
+    Read a cached histogram.
+
+    :param dataset_path: Path of the dataset directory (e.g. xxx.n5/setup0/timepoint0/s0).
+    :param dataset: z5py or zarr dataset used to check that the cache matches, optional.
+    :return: Histogram, or None if there is no valid cache.
+    """
+    path = histogram_path(dataset_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as f:
+            if dataset is not None:
+                if tuple(f['shape']) != tuple(dataset.shape) or tuple(f['chunks']) != tuple(dataset.chunks) or str(f['dtype']) != str(np.dtype(dataset.dtype)):
+                    print("Histogram cache " + path + " does not match the dataset. It will be recomputed.")
+                    return None
+            # the chunks were rewritten after the histogram was computed
+            if not matches_chunks(f['fingerprint'] if 'fingerprint' in f.files else None, dataset_path):
+                print("Histogram cache " + path + " is older than the chunks. It will be recomputed.")
+                return None
+            return f['hist']
+    except Exception as e:
+        print(f"Error reading {path}: {e}")
+        return None
+
+def invalidate_histogram(dataset_path):
+    """
+    Remove the cached histogram, e.g. after the chunks of the dataset were rewritten.
+    """
+    if os.path.exists(histogram_path(dataset_path)):
+        os.remove(histogram_path(dataset_path))
+
+def get_histogram(n5input, base_path, group_path):
+    """
+    Cached histogram of a dataset; it is computed and cached on the first call.
+    Needs a running Dask client for parallel computation.
+
+    :param n5input: z5py file.
+    :param base_path: Path of the N5 container.
+    :param group_path: Dataset path inside the container.
+    :return: int64 histogram with one bin per intensity value.
+    """
+    dataset = n5input[group_path]
+    dataset_path = os.path.join(base_path, group_path)
+    hist = load_histogram(dataset_path, dataset)
+    if hist is not None:
+        print("Histogram of " + group_path + " loaded from cache")
+        return hist
+    fingerprint = chunk_fingerprint(dataset_path)
+    hist = compute_histogram(dataset)
+    save_histogram(dataset_path, hist, dataset, fingerprint)
+    print("Histogram of " + group_path + " cached")
+    return hist
+
+def find_median(hist):
+    """
+    Median of the non-zero voxels.
+
+    :param hist: Histogram with one bin per intensity value.
+    :return: int median.
+    """
+    cumulative_sum = np.cumsum(hist[1:])
+    return int(np.searchsorted(cumulative_sum, cumulative_sum[-1] / 2)) + 1
+
+def triangle_threshold_with_zeros(hist):
+    """
+    Triangle threshold of all voxels including zeros, as skimage threshold_triangle
+    computes it for an integer image (used by genmask.py).
+
+    :param hist: Histogram with one bin per intensity value.
+    :return: int threshold.
+    """
+    values = np.flatnonzero(hist)
+    offset = values[0]
+    hist = np.asarray(hist[offset:values[-1] + 1], dtype=np.float64)
+    nbins = len(hist)
+
+    arg_peak_height = np.argmax(hist)
+    peak_height = hist[arg_peak_height]
+    arg_low_level, arg_high_level = np.flatnonzero(hist)[[0, -1]]
+    if arg_low_level == arg_high_level:
+        return int(offset)
+
+    # Flip if the left tail is shorter
+    flip = arg_peak_height - arg_low_level < arg_high_level - arg_peak_height
+    if flip:
+        hist = hist[::-1]
+        arg_low_level = nbins - arg_high_level - 1
+        arg_peak_height = nbins - arg_peak_height - 1
+
+    width = arg_peak_height - arg_low_level
+    x1 = np.arange(width)
+    y1 = hist[x1 + arg_low_level]
+    norm = np.sqrt(peak_height**2 + width**2)
+    length = peak_height / norm * x1 - width / norm * y1
+    arg_level = np.argmax(length) + arg_low_level
+    if flip:
+        arg_level = nbins - arg_level - 1
+
+    return int(offset + arg_level)
+
+def legacy_bins(hist):
+    """
+    The histogram in the layout of np.histogram(bins=65534, range=(1, 65535)),
+    i.e. zeros dropped and the two highest values in the last bin.
+    """
+    bins = np.array(hist[1:-1], dtype=np.int64)
+    bins[-1] += hist[-1]
+    return bins
+
+def main():
+
+    argv = sys.argv
+    argv = argv[1:]
+
+    usage_text = ("Usage:" + "  histogram.py" + " [options]")
+    parser = argparse.ArgumentParser(description=usage_text)
+    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input file path (.n5)")
+    parser.add_argument("-d", "--dataset", dest="dataset", type=str, default=None, help="comma separated dataset paths (e.g. setup0/timepoint0/s0,setup1/timepoint0/s0)")
+    parser.add_argument("-t", "--thread", dest="thread", type=int, default=0, help="number of threads")
+    parser.add_argument("--force", dest="force", default=False, action="store_true", help="recompute cached histograms")
+
+    if not argv:
+        parser.print_help()
+        exit()
+
+    args = parser.parse_args(argv)
+
+    import z5py
+    n5input = z5py.File(args.input, use_zarr_format=False)
+
+    cluster = LocalCluster(n_workers=args.thread, threads_per_worker=1)
+    client = Client(cluster)
+
+    for group_path in args.dataset.split(","):
+        if args.force:
+            invalidate_histogram(os.path.join(args.input, group_path))
+        hist = get_histogram(n5input, args.input, group_path)
+        print(group_path + " median: " + str(find_median(hist)))
+
+    client.close()
+    cluster.close()
+
+
+if __name__ == '__main__':
+    main()
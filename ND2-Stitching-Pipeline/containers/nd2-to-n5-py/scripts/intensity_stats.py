@@ -0,0 +1,193 @@
+import numpy as np
+
+import os
+import sys
+import argparse
+
+import z5py
+from distributed import LocalCluster, Client
+
+import json
+
+from histogram import get_histogram, find_median, legacy_bins, invalidate_histogram, triangle_threshold_with_zeros, chunk_fingerprint, matches_chunks
+
+STATS_KEY = "intensityStatistics"
+
+def triangle_threshold(data):
+    """
+    Calculate the threshold value using the triangle method.
+
+    Parameters:
+    data (numpy array): Histogram data of the image.
+
+    Returns:
+    int: Calculated threshold value.
+    """
+    # Find the first and last non-zero bins in the histogram
+    min_val = np.nonzero(data)[0][0]
+    min2 = np.nonzero(data)[0][-1]
+    max_index = np.argmax(data)
+    dmax = data[max_index]
+
+    # Determine if we need to invert the histogram
+    inverted = False
+    if (max_index - min_val) < (min2 - max_index):
+        # Invert histogram by flipping it
+        data = data[::-1]
+        min_val, max_index = len(data) - min2 - 1, len(data) - max_index - 1
+        inverted = True
+
+    # Edge case: if min_val equals max_index, return min_val
+    if min_val == max_index:
+        return min_val
+
+    # Calculate normalized line parameters for the triangle
+    nx = dmax  # max value at the peak
+    ny = min_val - max_index
+    norm = np.sqrt(nx**2 + ny**2)
+    nx /= norm
+    ny /= norm
+    d = nx * min_val + ny * data[min_val]
+
+    # Compute distances from each histogram point to the line and find max distance
+    x_indices = np.arange(min_val, max_index + 1)
+    distances = nx * x_indices + ny * data[min_val:max_index + 1] - d
+    split = x_indices[np.argmax(distances)] - 1
+
+    # Adjust if inverted
+    if inverted:
+        return len(data) - split - 1
+    else:
+        return split
+
+def percentile_from_histogram(hist, q):
+    """
+    Percentile of all voxels with the linear interpolation of np.percentile.
+
+    :param hist: Histogram with one bin per intensity value.
+    :param q: Percentile (0-100).
+    :return: float percentile.
+    """
+    cumulative_sum = np.cumsum(hist)
+    pos = q / 100.0 * (cumulative_sum[-1] - 1)
+    lower = np.searchsorted(cumulative_sum, np.floor(pos), side='right')
+    upper = np.searchsorted(cumulative_sum, np.ceil(pos), side='right')
+    return float(lower + (upper - lower) * (pos - np.floor(pos)))
+
+def compute_intensity_stats(hist):
+    """
+    Intensity statistics of a dataset from its histogram.
+
+    median and triangle are computed from the non-zero voxels (padding.py, padding_mask.py),
+    min, max, p1, p99 and triangleWithZeros from all voxels (cellpose normalize99, genmask.py).
+
+    :param hist: Histogram with one bin per intensity value.
+    :return: Dictionary of statistics.
+    """
+    values = np.flatnonzero(hist)
+    return {
+        "count": int(np.sum(hist)),
+        "min": int(values[0]),
+        "max": int(values[-1]),
+        "median": find_median(hist),
+        "triangle": int(triangle_threshold(legacy_bins(hist))),
+        "triangleWithZeros": triangle_threshold_with_zeros(hist),
+        "p1": percentile_from_histogram(hist, 1),
+        "p99": percentile_from_histogram(hist, 99),
+    }
+
+def read_intensity_stats(dataset_path):
+    """
+    Cached statistics from the attributes.json of a dataset, or None if there
+    are none or the chunks were rewritten after they were computed.
+    """
+    s_attr = os.path.join(dataset_path, "attributes.json")
+    if not os.path.exists(s_attr):
+        return None
+    with open(s_attr, 'r') as f:
+        data = json.load(f)
+    stats = data.get(STATS_KEY)
+    if stats is not None and not matches_chunks(stats.get("fingerprint"), dataset_path):
+        print("Statistics in " + s_attr + " are older than the chunks. They will be recomputed.")
+        return None
+    return stats
+
+def write_intensity_stats(dataset_path, stats):
+    s_attr = os.path.join(dataset_path, "attributes.json")
+    with open(s_attr, 'r+') as f:
+        data = json.load(f)
+        data[STATS_KEY] = stats
+        f.seek(0)
+        json.dump(data, f, indent=4)
+        f.truncate()
+
+def update_intensity_stats(n5input, base_path, group_path):
+    """
+    Compute the statistics of a dataset from its histogram and write them to its
+    attributes.json together with the chunk_fingerprint they belong to.
+    """
+    dataset_path = os.path.join(base_path, group_path)
+    # taken before the histogram is read, so that a concurrent rewrite of the chunks
+    # makes the statistics stale instead of being missed
+    fingerprint = chunk_fingerprint(dataset_path)
+    stats = compute_intensity_stats(get_histogram(n5input, base_path, group_path))
+    stats["fingerprint"] = [int(v) for v in fingerprint]
+    write_intensity_stats(dataset_path, stats)
+    return stats
+
+def get_intensity_stats(n5input, base_path, group_path):
+    """
+    Cached statistics of a dataset; they are computed from the histogram and
+    written to its attributes.json on the first call, and again whenever the
+    chunks have changed since.
+    Needs a running Dask client if the histogram is not cached either.
+
+    :param n5input: z5py file.
+    :param base_path: Path of the N5 container.
+    :param group_path: Dataset path inside the container.
+    :return: Dictionary of statistics.
+    """
+    dataset_path = os.path.join(base_path, group_path)
+    stats = read_intensity_stats(dataset_path)
+    if stats is not None:
+        print("Statistics of " + group_path + " loaded from attributes.json")
+        return stats
+    return update_intensity_stats(n5input, base_path, group_path)
+
+def main():
+
+    argv = sys.argv
+    argv = argv[1:]
+
+    usage_text = ("Usage:" + "  intensity_stats.py" + " [options]")
+    parser = argparse.ArgumentParser(description=usage_text)
+    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input file path (.n5)")
+    parser.add_argument("-d", "--dataset", dest="dataset", type=str, default=None, help="comma separated dataset paths (e.g. c0/s2,c1/s2)")
+    parser.add_argument("-t", "--thread", dest="thread", type=int, default=0, help="number of threads")
+    parser.add_argument("--force", dest="force", default=False, action="store_true", help="recompute cached statistics")
+
+    if not argv:
+        parser.print_help()
+        exit()
+
+    args = parser.parse_args(argv)
+
+    n5input = z5py.File(args.input, use_zarr_format=False)
+
+    cluster = LocalCluster(n_workers=args.thread, threads_per_worker=1)
+    client = Client(cluster)
+
+    for group_path in args.dataset.split(","):
+        dataset_path = os.path.join(args.input, group_path)
+        if args.force:
+            invalidate_histogram(dataset_path)
+            update_intensity_stats(n5input, args.input, group_path)
+        stats = get_intensity_stats(n5input, args.input, group_path)
+        print(group_path + ": " + json.dumps(stats))
+
+    client.close()
+    cluster.close()
+
+
+if __name__ == '__main__':
+    main()
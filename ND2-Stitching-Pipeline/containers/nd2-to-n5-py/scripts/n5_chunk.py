@@ -0,0 +1,202 @@
+import numpy as np
+
+import os
+import json
+import gzip
+import zlib
+import bz2
+import lzma
+import struct
+
+SUPPORTED_COMPRESSION = ['raw', 'gzip', 'bzip2', 'xz']
+
+MANIFEST_FILE = "checksums.tsv"
+
+def read_dataset_attributes(dataset_path):
+    with open(os.path.join(dataset_path, "attributes.json"), 'r') as f:
+        return json.load(f)
+
+def get_compression(attributes):
+    """
+    Compression settings of an N5 dataset.
+
+    :param attributes: Contents of the attributes.json of the dataset.
+    :return: Dictionary with at least 'type' (raw, gzip, bzip2, xz, ...).
+    """
+    if 'compression' in attributes:
+        return attributes['compression']
+    # N5 < 1.0
+    return {'type': attributes.get('compressionType', 'raw')}
+
+DTYPES = {'uint8': 'u1', 'uint16': 'u2', 'uint32': 'u4', 'uint64': 'u8',
+          'int8': 'i1', 'int16': 'i2', 'int32': 'i4', 'int64': 'i8',
+          'float32': 'f4', 'float64': 'f8'}
+
+def parse_chunk_header(f):
+    """
+    Read the header of an N5 chunk file.
+
+    :param f: File object positioned at the start of the chunk.
+    :return: (mode, dims in x/y/z order, number of elements or None). The file is left at the start of the data.
+    """
+    mode, ndim = struct.unpack('>HH', f.read(4))
+    if mode == 2:
+        # object mode has no dimensions
+        return mode, None, None
+    if mode not in (0, 1):
+        raise ValueError("unknown chunk mode " + str(mode))
+    dims = struct.unpack('>' + 'I' * ndim, f.read(4 * ndim))
+    num_elements = None
+    if mode == 1:
+        num_elements = struct.unpack('>I', f.read(4))[0]
+    return mode, dims, num_elements
+
+def chunk_path(dataset_path, idx):
+    """
+    Path of a chunk file. idx is in z5py (C) order, N5 stores chunks in x/y/z order.
+    """
+    return os.path.join(dataset_path, *[str(i) for i in reversed(idx)])
+
+def compress(data, compression):
+    ctype = compression['type']
+    if ctype == 'raw':
+        return data
+    if ctype == 'gzip':
+        level = compression.get('level', -1)
+        level = 6 if level is None or level < 0 else level
+        if compression.get('useZlib', False):
+            return zlib.compress(data, level)
+        return gzip.compress(data, compresslevel=level)
+    if ctype == 'bzip2':
+        return bz2.compress(data, compression.get('blockSize', 9))
+    if ctype == 'xz':
+        return lzma.compress(data, preset=compression.get('preset', 6))
+    raise ValueError("unsupported N5 compression: " + ctype)
+
+def encode_chunk(data, compression):
+    """
+    Serialize a chunk in the N5 format: mode (uint16), number of dimensions (uint16),
+    chunk size per dimension (uint32) in x/y/z order, then the compressed big-endian data.
+
+    :param data: numpy array in z/y/x order.
+    :param compression: Compression settings of the dataset.
+    :return: bytes.
+    """
+    header = struct.pack('>HH', 0, data.ndim) + struct.pack('>' + 'I' * data.ndim, *reversed(data.shape))
+    payload = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('>')).tobytes()
+    return header + compress(payload, compression)
+
+def write_encoded(path, encoded):
+    """
+    Write encoded chunk bytes and read the file back to check its size and CRC-32.
+
+    :return: (crc32, size) of the bytes written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(encoded)
+        f.flush()
+        os.fsync(f.fileno())
+    crc = zlib.crc32(encoded)
+    error = verify_file(path, crc, len(encoded))
+    if error is not None:
+        raise IOError(path + " does not match the bytes written (" + error + ")")
+    return crc, len(encoded)
+
+def write_chunk(dataset_path, idx, data, compression):
+    """
+    Write a chunk directly to its final location.
+
+    :return: (crc32, size) of the chunk file.
+    """
+    return write_encoded(chunk_path(dataset_path, idx), encode_chunk(data, compression))
+
+def write_chunk_tmp(dataset_path, idx, data, compression):
+    """
+    Write an encoded chunk next to its final location. The chunk becomes visible
+    only when commit_chunk renames it.
+
+    :return: (crc32, size) of the chunk file.
+    """
+    return write_encoded(chunk_path(dataset_path, idx) + ".tmp", encode_chunk(data, compression))
+
+def commit_chunk(dataset_path, idx):
+    """
+    Atomically replace a chunk with its temporary file. Does nothing if there is no temporary file.
+    """
+    path = chunk_path(dataset_path, idx)
+    if os.path.exists(path + ".tmp"):
+        os.replace(path + ".tmp", path)
+
+def discard_chunk_tmp(dataset_path, idx):
+    path = chunk_path(dataset_path, idx) + ".tmp"
+    if os.path.exists(path):
+        os.remove(path)
+
+def chunk_key(idx):
+    """
+    Chunk path relative to the dataset (x/y/z), used as key in the checksum manifest.
+    """
+    return "/".join(str(i) for i in reversed(idx))
+
+def write_manifest(dataset_path, checksums):
+    """
+    Write the checksum manifest of a dataset: one line per chunk file with its
+    relative path, CRC-32 (hex) and size of the encoded bytes.
+
+    :param checksums: Dictionary chunk index (z5py order) -> (crc32, size).
+    """
+    tmp_path = os.path.join(dataset_path, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, 'w') as f:
+        f.write("chunk\tcrc32\tsize\n")
+        for idx in sorted(checksums):
+            crc, size = checksums[idx]
+            f.write(chunk_key(idx) + "\t" + format(crc, '08x') + "\t" + str(size) + "\n")
+    os.replace(tmp_path, os.path.join(dataset_path, MANIFEST_FILE))
+
+def read_manifest(dataset_path):
+    """
+    Read the checksum manifest of a dataset.
+
+    :return: Dictionary relative chunk path (x/y/z) -> (crc32, size), or None if there is no manifest.
+    """
+    path = os.path.join(dataset_path, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    checksums = {}
+    with open(path, 'r') as f:
+        f.readline()
+        for line in f:
+            key, crc, size = line.rstrip("\n").split("\t")
+            checksums[key] = (int(crc, 16), int(size))
+    return checksums
+
+def backoff(wait, attempt, max_wait=60):
+    """
+    Wait time before a retry: wait, 2 * wait, 4 * wait, ... up to max_wait seconds.
+    """
+    return min(wait * (2 ** attempt), max_wait)
+
+def verify_chunk_file(dataset_path, key, crc, size):
+    """
+    Compare a chunk file with its manifest entry without decompressing it.
+
+    :param key: Relative chunk path (x/y/z).
+    :return: None if the file matches, otherwise 'missing', 'size' or 'crc'.
+    """
+    return verify_file(os.path.join(dataset_path, *key.split("/")), crc, size)
+
+def verify_file(path, crc, size):
+    """
+    Compare a file with an expected CRC-32 and size.
+
+    :return: None if the file matches, otherwise 'missing', 'size' or 'crc'.
+    """
+    if not os.path.exists(path):
+        return 'missing'
+    if os.path.getsize(path) != size:
+        return 'size'
+    with open(path, 'rb') as f:
+        if zlib.crc32(f.read()) != crc:
+            return 'crc'
+    return None
@@ -0,0 +1,164 @@
+import numpy as np
+
+import os
+import sys
+import argparse
+
+import nd2
+
+import xml.etree.ElementTree as ET
+
+import json
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from nd2tiff import get_tile_ids, extract_stack
+from n5_chunk import write_chunk, write_manifest
+
+def get_views(xml):
+    """
+    View setups of a per-timepoint XML written by nd2tiffxml.py.
+
+    :param xml: Parsed XML (ElementTree).
+    :return: List of (setup id, (tile, channel, timepoint) in the ND2, size (z, y, x)).
+    """
+    sizes = {}
+    for item in xml.findall(".//ViewSetup"):
+        size = [int(v) for v in item.find("./size").text.split(" ")]
+        sizes[int(item.find("./id").text)] = tuple(reversed(size))
+    views = []
+    for item in xml.findall(".//FileMapping"):
+        setup_id = int(item.attrib['view_setup'])
+        views.append((setup_id, get_tile_ids(item.find("./file").text), sizes[setup_id]))
+    return sorted(views)
+
+def create_setup(base_path, setup_id, shape, block_size, dtype, compression):
+    """
+    Create setup<id>/timepoint0/s0 in the layout written by SparkResaveN5.
+
+    :param shape: Image size (z, y, x).
+    :param block_size: Chunk size (z, y, x).
+    :return: Path of the s0 dataset.
+    """
+    setup_path = os.path.join(base_path, "setup" + str(setup_id))
+    dataset_path = os.path.join(setup_path, "timepoint0", "s0")
+    os.makedirs(dataset_path, exist_ok=True)
+    with open(os.path.join(setup_path, "attributes.json"), 'w') as f:
+        json.dump({'downsamplingFactors': [[1, 1, 1]], 'dataType': dtype}, f, indent=4)
+    with open(os.path.join(setup_path, "timepoint0", "attributes.json"), 'w') as f:
+        json.dump({}, f, indent=4)
+    with open(os.path.join(dataset_path, "attributes.json"), 'w') as f:
+        json.dump({
+            'dimensions': list(reversed(shape)),
+            'blockSize': list(reversed(block_size)),
+            'dataType': dtype,
+            'compression': compression,
+            'downsamplingFactors': [1, 1, 1],
+        }, f, indent=4)
+    return dataset_path
+
+def convert_slab(darray, sizes, dataset_path, ids, shape, crop_percentages, z, block_size, compression):
+    """
+    Read one z-slab of a tile from the ND2 and write its chunks.
+
+    :param ids: (tile, channel, timepoint) in the ND2.
+    :param shape: Image size (z, y, x) of the view in the XML.
+    :param z: Chunk index of the slab along z.
+    :return: Dictionary chunk index (z, y, x) -> (crc32, size).
+    """
+    tile_id, ch_id, time_id = ids
+    z_slice = slice(z * block_size[0], min((z + 1) * block_size[0], shape[0]))
+    slab = extract_stack(darray, sizes, tile_id, ch_id, time_id, crop_percentages, z_slice=z_slice)
+    if slab.shape != (z_slice.stop - z_slice.start, shape[1], shape[2]):
+        raise ValueError("tile " + str(ids) + ": slab " + str(slab.shape) + " does not match the view size " + str(shape) + " in the XML. Check the crop.")
+    checksums = {}
+    for y in range(0, int(np.ceil(slab.shape[1] / block_size[1]))):
+        for x in range(0, int(np.ceil(slab.shape[2] / block_size[2]))):
+            block = slab[:, y * block_size[1]:(y + 1) * block_size[1], x * block_size[2]:(x + 1) * block_size[2]]
+            checksums[(z, y, x)] = write_chunk(dataset_path, (z, y, x), block, compression)
+    return checksums
+
+def write_n5_xml(xml, output, n5path):
+    """
+    Point the ImageLoader of the XML to the N5, as SparkResaveN5 does.
+    """
+    loader = xml.find(".//SequenceDescription/ImageLoader")
+    for child in list(loader):
+        loader.remove(child)
+    loader.attrib.clear()
+    loader.set('format', 'bdv.n5')
+    loader.set('version', '1.0')
+    n5 = ET.SubElement(loader, 'n5')
+    n5.set('type', 'relative')
+    n5.text = os.path.relpath(n5path, os.path.dirname(os.path.abspath(output)))
+    xml.write(output)
+
+def main():
+
+    argv = sys.argv
+    argv = argv[1:]
+
+    usage_text = ("Usage:" + "  nd2n5_direct.py" + " [options]")
+    parser = argparse.ArgumentParser(description=usage_text)
+    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input ND2 file")
+    parser.add_argument("-x", "--xml", dest="xml", type=str, default=None, help="per-timepoint XML written by nd2tiffxml.py")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path (.xml), the N5 is written next to it")
+    parser.add_argument("-c", "--crop", dest="crop", type=str, default="0,0,0,0", help="cropping percentage (top,bottom,left,right)")
+    parser.add_argument("-b", "--blocksize", dest="blocksize", type=str, default="512,512,128", help="chunk size (x,y,z)")
+    parser.add_argument("-t", "--thread", dest="thread", type=int, default=4, help="number of z-slabs converted concurrently")
+    parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
+
+    if not argv:
+        parser.print_help()
+        exit()
+
+    args = parser.parse_args(argv)
+
+    output = args.output
+    crop_percentages = [float(num) if '.' in num else int(num) for num in args.crop.split(',')]
+    block_size = tuple(reversed([int(v) for v in args.blocksize.split(',')]))
+    compression = {'type': 'gzip', 'useZlib': False, 'level': -1}
+
+    stem = os.path.splitext(os.path.basename(output))[0]
+    base_path = os.path.join(os.path.dirname(output), stem + ".n5")
+    os.makedirs(base_path, exist_ok=True)
+    with open(os.path.join(base_path, "attributes.json"), 'w') as f:
+        json.dump({'n5': "2.2.0"}, f, indent=4)
+
+    xml = ET.parse(args.xml)
+    views = get_views(xml)
+
+    with nd2.ND2File(args.input) as nd2file:
+        print(nd2file.sizes)
+        sizes = dict(nd2file.sizes)
+        darray = nd2file.to_dask()
+        dtype = np.dtype(darray.dtype).name
+
+        dataset_paths = {}
+        checksums = {}
+        tasks = []
+        for setup_id, ids, shape in views:
+            dataset_paths[setup_id] = create_setup(base_path, setup_id, shape, block_size, dtype, compression)
+            checksums[setup_id] = {}
+            for z in range(0, int(np.ceil(shape[0] / block_size[0]))):
+                tasks.append((setup_id, ids, shape, z))
+        print(str(len(views)) + " views, " + str(len(tasks)) + " slabs")
+
+        # at most thread slabs are held in memory
+        with ThreadPoolExecutor(max_workers=max(1, args.thread)) as executor:
+            futures = {executor.submit(convert_slab, darray, sizes, dataset_paths[setup_id], ids, shape, crop_percentages, z, block_size, compression): setup_id for setup_id, ids, shape, z in tasks}
+            for future in as_completed(futures):
+                setup_id = futures[future]
+                checksums[setup_id].update(future.result())
+                if args.verbose:
+                    print("setup" + str(setup_id) + ": " + str(len(checksums[setup_id])) + " chunks")
+
+    for setup_id in dataset_paths:
+        write_manifest(dataset_paths[setup_id], checksums[setup_id])
+
+    write_n5_xml(xml, output, base_path)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
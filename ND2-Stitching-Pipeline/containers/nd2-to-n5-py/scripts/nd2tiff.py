@@ -20,13 +20,96 @@ from dask.diagnostics import ProgressBar, Profiler, ResourceProfiler, CacheProfi
 
 from pathlib import Path
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import tifffile
 
-def get_key_index(dictionary, key):
-    for i, k in enumerate(dictionary.keys()):
-        if k == key:
-            return i
-    return -1
+def get_crop_bounds(w, h, crop_percentages):
+    """
+    Crop window of a tile.
+
+    :param crop_percentages: Cropping percentage (top, bottom, left, right).
+    :return: (st_x, ed_x, st_y, ed_y)
+    """
+    st_x = int(crop_percentages[2] * 0.01 * w + 0.5)
+    ed_x = int( (1.0 - crop_percentages[3] * 0.01) * w + 0.5)
+    st_y = int(crop_percentages[0] * 0.01 * h + 0.5)
+    ed_y = int( (1.0 - crop_percentages[1] * 0.01) * h + 0.5)
+    return st_x, ed_x, st_y, ed_y
+
+def get_tile_ids(outpath):
+    """
+    Tile, channel and timepoint of an output file (tiff_<tile>_<ch>_<time>.tif).
+    """
+    numbers = re.findall(r'\d+', outpath)
+    time_id = int(numbers[len(numbers)-1])
+    ch_id = int(numbers[len(numbers)-2])
+    tile_id = int(numbers[len(numbers)-3])
+    return tile_id, ch_id, time_id
+
+def extract_stack(darray, sizes, tile_id, ch_id, time_id, crop_percentages, z_slice=slice(None)):
+    """
+    Extract the cropped 3D stack of one tile, channel and timepoint.
+
+    :param darray: Dask array of the ND2 file.
+    :param sizes: Dimension sizes of the ND2 file (ND2File.sizes), in the axis order of darray.
+    :param z_slice: Planes to extract, all by default.
+    :return: numpy array (z, y, x).
+    """
+    keys = list(sizes.keys())
+    h = darray.shape[keys.index('Y')]
+    w = darray.shape[keys.index('X')]
+    st_x, ed_x, st_y, ed_y = get_crop_bounds(w, h, crop_percentages)
+
+    index = []
+    for key in keys:
+        if key == 'T':
+            index.append(time_id)
+        elif key == 'P':
+            index.append(tile_id)
+        elif key == 'C':
+            index.append(ch_id)
+        elif key == 'Y':
+            index.append(slice(st_y, ed_y))
+        elif key == 'X':
+            index.append(slice(st_x, ed_x))
+        elif key == 'Z':
+            index.append(z_slice)
+        else:
+            index.append(0)
+
+    # each stack is computed by the calling thread
+    output = darray[tuple(index)].compute(scheduler='synchronous')
+    if 'Z' not in sizes:
+        output = output[np.newaxis]
+    return output
+
+def iter_planes(darray, sizes, tile_id, ch_id, time_id, crop_percentages, d):
+    for z in range(d):
+        yield extract_stack(darray, sizes, tile_id, ch_id, time_id, crop_percentages, z_slice=slice(z, z + 1))[0]
+
+def write_stack(darray, sizes, outpath, crop_percentages, compress_threads=4):
+    """
+    Write the cropped stack of one tile, channel and timepoint plane by plane.
+    Only the planes being compressed are held in memory; the strips of each
+    plane are compressed on compress_threads threads.
+
+    :return: (outpath, shape of the stack)
+    """
+    tile_id, ch_id, time_id = get_tile_ids(outpath)
+    keys = list(sizes.keys())
+    st_x, ed_x, st_y, ed_y = get_crop_bounds(darray.shape[keys.index('X')], darray.shape[keys.index('Y')], crop_percentages)
+    d = darray.shape[keys.index('Z')] if 'Z' in sizes else 1
+    shape = (d, ed_y - st_y, ed_x - st_x)
+    dtype = np.dtype(darray.dtype)
+
+    # about 1 MB per strip, so that every plane is split across the compression threads
+    rowsperstrip = max(1, min(shape[1], (1 << 20) // (shape[2] * dtype.itemsize)))
+    bigtiff = int(np.prod(shape)) * dtype.itemsize > 2**32 - 2**25
+    with tifffile.TiffWriter(outpath, bigtiff=bigtiff) as tif:
+        tif.write(iter_planes(darray, sizes, tile_id, ch_id, time_id, crop_percentages, d), shape=shape, dtype=dtype,
+                  compression='zlib', compressionargs={'level': 6}, rowsperstrip=rowsperstrip, maxworkers=compress_threads)
+    return outpath, shape
 
 def nd2tiff():
 
@@ -37,6 +120,9 @@ def nd2tiff():
     parser = argparse.ArgumentParser(description=usage_text)
     parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input files")
     parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="output file path (.xml)")
+    parser.add_argument("-l", "--list", dest="list", type=str, default=None, help="list of output files written by nd2tiffcsv.py (.csv), instead of -o. The ND2 is opened once and all stacks are extracted")
+    parser.add_argument("-t", "--thread", dest="thread", type=int, default=4, help="number of stacks extracted concurrently with -l")
+    parser.add_argument("-w", "--compress_threads", dest="compress_threads", type=int, default=4, help="number of compression threads per stack")
     parser.add_argument("-b", "--bg", dest="bg", type=str, default=None, help="background file path (.xml)")
     parser.add_argument("-c", "--crop", dest="crop", type=str, default="0,0,0,0", help="cropping percentage (top,bottom,left,right)")
     parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
@@ -48,94 +134,30 @@ def nd2tiff():
     args = parser.parse_args(argv)
 
     input = args.input
-    outpath = args.output
-    outdir = os.path.dirname(outpath)
     bg = args.bg
     crop_percentages = [float(num) if '.' in num else int(num) for num in args.crop.split(',')]
 
-    numbers = re.findall(r'\d+', outpath)
-    time_id = int(numbers[len(numbers)-1])
-    ch_id = int(numbers[len(numbers)-2])
-    tile_id = int(numbers[len(numbers)-3])
-    print(time_id)
-    print(ch_id)
-    print(tile_id)
-
-    Path(outdir).mkdir(parents=True, exist_ok=True)
-
-    darray = nd2.imread(input, dask=True)
+    if args.list is not None:
+        with open(args.list, 'r') as f:
+            outpaths = [line.strip() for line in f if line.strip()]
+    else:
+        outpaths = [args.output]
 
-    print(darray.shape)
+    for outdir in set(os.path.dirname(p) for p in outpaths):
+        Path(outdir).mkdir(parents=True, exist_ok=True)
 
-    timepoints = 1
-    tiles = 1
-    channels = 1
-    timepoints_idx = -1
-    tiles_idx = -1
-    channels_idx = -1
-    z_idx = 0
-    y_idx = 1
-    x_idx = 2
     with nd2.ND2File(input) as nd2file:
         print(nd2file.sizes)
-        if 'T' in nd2file.sizes:
-            timepoints = nd2file.sizes['T']
-            timepoints_idx = get_key_index(nd2file.sizes, 'T')
-        if 'P' in nd2file.sizes:
-            tiles = nd2file.sizes['P']
-            tiles_idx = get_key_index(nd2file.sizes, 'P')
-        if 'C' in nd2file.sizes:
-            channels = nd2file.sizes['C']
-            channels_idx = get_key_index(nd2file.sizes, 'C')
-        if 'X' in nd2file.sizes:
-            w = nd2file.sizes['X']
-            x_idx = get_key_index(nd2file.sizes, 'X')
-        if 'Y' in nd2file.sizes:
-            h = nd2file.sizes['Y']
-            y_idx = get_key_index(nd2file.sizes, 'Y')
-        if 'Z' in nd2file.sizes:
-            d = nd2file.sizes['Z']
-            z_idx = get_key_index(nd2file.sizes, 'Z')
-
-    d = darray.shape[z_idx]
-    h = darray.shape[y_idx]
-    w = darray.shape[x_idx]
-
-    st_x = int(crop_percentages[2] * 0.01 * w + 0.5)
-    ed_x = int( (1.0 - crop_percentages[3] * 0.01) * w + 0.5)
-    st_y = int(crop_percentages[0] * 0.01 * h + 0.5)
-    ed_y = int( (1.0 - crop_percentages[1] * 0.01) * h + 0.5)
-
-    w = ed_x - st_x
-    h = ed_y - st_y
-
-    output = np.zeros((d, h, w), dtype=darray.dtype)
-    if timepoints_idx >= 0:
-        if tiles_idx >= 0:
-            if channels_idx >= 0:
-                output[:d, :h, :w] = darray[time_id, tile_id, :d, ch_id, st_y:ed_y, st_x:ed_x]
-            else:
-                output[:d, :h, :w] = darray[time_id, tile_id, :d, st_y:ed_y, st_x:ed_x]
-        else:
-            if channels_idx >= 0:
-                output[:d, :h, :w] = darray[time_id, :d, ch_id, st_y:ed_y, st_x:ed_x]
-            else:
-                output[:d, :h, :w] = darray[time_id, :d, st_y:ed_y, st_x:ed_x]
-    else:
-        if tiles_idx >= 0:
-            if channels_idx >= 0:
-                output[:d, :h, :w] = darray[tile_id, :d, ch_id, st_y:ed_y, st_x:ed_x]
-            else:
-                output[:d, :h, :w] = darray[tile_id, :d, st_y:ed_y, st_x:ed_x]
-        else:
-            if channels_idx >= 0:
-                output[:d, :h, :w] = darray[:d, ch_id, st_y:ed_y, st_x:ed_x]
-            else:
-                output[:d, :h, :w] = darray[:d, st_y:ed_y, st_x:ed_x]
-
-    print(output.shape)
-    
-    tifffile.imsave(outpath, output, compression=("ZLIB", 6))
+        sizes = dict(nd2file.sizes)
+        darray = nd2file.to_dask()
+        print(darray.shape)
+
+        # stacks are streamed plane by plane, so memory is bounded by thread planes
+        with ThreadPoolExecutor(max_workers=max(1, args.thread)) as executor:
+            futures = [executor.submit(write_stack, darray, sizes, outpath, crop_percentages, args.compress_threads) for outpath in outpaths]
+            for future in as_completed(futures):
+                outpath, shape = future.result()
+                print(outpath + " " + str(shape))
 
 def main():
     nd2tiff()
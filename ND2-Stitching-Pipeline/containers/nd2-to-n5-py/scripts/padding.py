@@ -9,7 +9,7 @@ import argparse
 import z5py
 import dask
 import dask.array as da
-from distributed import LocalCluster, Client, Variable
+from distributed import LocalCluster, Client, Variable, as_completed
 
 from pathlib import Path
 
@@ -19,6 +19,10 @@ import shutil
 
 import time
 
+from intensity_stats import get_intensity_stats, STATS_KEY
+from histogram import invalidate_histogram
+from n5_chunk import read_dataset_attributes, get_compression, write_chunk, write_chunk_tmp, commit_chunk, discard_chunk_tmp, write_manifest, backoff, chunk_key, verify_chunk_file, SUPPORTED_COMPRESSION
+
 def get_chunk_size_at_position(position, chunk_size, dataset_shape):
     """
     Calculate the actual chunk size at a specific position in the dataset.
@@ -36,7 +40,16 @@ def get_chunk_size_at_position(position, chunk_size, dataset_shape):
     actual_chunk_size = [end - start for start, end in zip(chunk_start, chunk_end)]
     return tuple(actual_chunk_size)
 
-def padding(data_chunk, median, amp):
+def padding(data_chunk, median, amp, seed=None):
+    """
+    Replace low intensity voxels with Gaussian noise around the median, in place.
+
+    :param data_chunk: Chunk (numpy array), modified in place.
+    :param median: Median intensity of the dataset.
+    :param amp: The noise standard deviation is median // amp and voxels below median - median // amp are replaced.
+    :param seed: Seed of the noise, e.g. [seed, *chunk index] for reproducible chunks.
+    :return: The padded chunk.
+    """
     mm = median
 
     # Calculate vv
@@ -44,17 +57,27 @@ def padding(data_chunk, median, amp):
 
     # Generate masks for low intensity pixels
     masks = (data_chunk < mm - vv)
-
-    # Set all low intensity pixels to zero
-    data_chunk = data_chunk * (~masks).astype(np.uint16)
-
-    white_noise = np.random.normal(0, 1.0, data_chunk.shape) * vv + mm
-    data_chunk += (white_noise * masks).astype(np.uint16)
+    count = np.count_nonzero(masks)
+    if count == 0:
+        return data_chunk
+
+    # Draw noise only for the masked voxels
+    rng = np.random.default_rng(seed)
+    white_noise = rng.standard_normal(count, dtype=np.float32)
+    white_noise *= vv
+    white_noise += mm
+    np.clip(white_noise, 0, np.iinfo(data_chunk.dtype).max, out=white_noise)
+    data_chunk[masks] = white_noise
 
     return data_chunk
 
 
-def padding2(in_dataset, out_dataset, idx, median, amp, retry, wait):
+def padding2(in_dataset, out_path, compression, idx, median, amp, retry, wait, seed=0):
+    """
+    Pad one chunk and write it to the output dataset.
+
+    :return: (idx, crc32, size) of the written chunk file, None on failure.
+    """
 
     try:
         # Attempt to read the chunk
@@ -77,93 +100,189 @@ def padding2(in_dataset, out_dataset, idx, median, amp, retry, wait):
             
     except Exception as e:
         print(f"Error reading chunk {idx}: {e}")
-        return False
+        return None
     
-    mm = median
-
-    # Calculate vv
-    vv = int(mm // amp)  # Use integer division
-
-    # Generate masks for low intensity pixels
-    masks = (data_chunk < mm - vv)
+    if not data_chunk.flags.writeable:
+        data_chunk = data_chunk.copy()
+    data_chunk = padding(data_chunk, median, amp, seed=[seed, *idx])
 
-    # Set all low intensity pixels to zero
-    data_chunk = data_chunk * (~masks).astype(np.uint16)
-
-    white_noise = np.random.normal(0, 1.0, data_chunk.shape) * vv + mm
-    data_chunk += (white_noise * masks).astype(np.uint16)
-
-    done = False
     for i in range(0, retry):
         try:
-            out_dataset.write_chunk(idx, data_chunk)
-            chk = validate_chunk(out_dataset, idx)
-            if chk == True:
-                break
+            crc, size = write_chunk(out_path, idx, data_chunk, compression)
+            return idx, crc, size
         except Exception as e:
             print(f"Error writing chunk {idx}: {e}")
         print(f"retry to write chunk {idx}")
-        time.sleep(wait)
+        time.sleep(backoff(wait, i))
 
-    return True
+    return None
 
-def compute_histogram(chunk, bins, range):
-    hist, edges = np.histogram(chunk, bins=bins, range=range)
-    return hist
+def padding_inplace(in_dataset, dataset_path, compression, idx, median, amp, retry, wait, seed=0):
+    """
+    Pad one chunk and write it to a temporary file next to the original chunk.
+    The driver renames it over the original after recording it in the journal.
 
-def compute_histogram2(dataset, idx, bins, range):
+    :return: (idx, crc32, size) of the written chunk file, None on failure.
+    """
     try:
         # Attempt to read the chunk
-        data_chunk = dataset.read_chunk(idx)
+        data_chunk = in_dataset.read_chunk(idx)
         if data_chunk is None:
-            print(f"Chunk {idx} is missing. It will be ignored.")
-            data_chunk = np.array([])
-                
-        # Check for NaNs or infinite values
-        if np.isnan(data_chunk).any() or np.isinf(data_chunk).any():
-            print(f"Chunk {idx} contains NaNs or infinite values. It will be ignored.")
-            data_chunk = np.array([])
+            print(f"Chunk {idx} is missing.")
+        elif np.isnan(data_chunk).any() or np.isinf(data_chunk).any():
+            print(f"Chunk {idx} contains NaNs or infinite values. It will be ignored")
+            data_chunk = None
+
+        if data_chunk is None:
+            chunk_size = get_chunk_size_at_position(idx, in_dataset.chunks, in_dataset.shape)
+            data_chunk = np.zeros(chunk_size, dtype=in_dataset.dtype)
+            print(f"Empty chunk {idx} is created.")
 
-        hist, edges = np.histogram(data_chunk, bins=bins, range=range)
-        return hist
-                
     except Exception as e:
         print(f"Error reading chunk {idx}: {e}")
         return None
+
+    if not data_chunk.flags.writeable:
+        data_chunk = data_chunk.copy()
+    data_chunk = padding(data_chunk, median, amp, seed=[seed, *idx])
+
+    for i in range(0, retry):
+        try:
+            crc, size = write_chunk_tmp(dataset_path, idx, data_chunk, compression)
+            return idx, crc, size
+        except Exception as e:
+            print(f"Error writing chunk {idx}: {e}")
+        print(f"retry to write chunk {idx}")
+        time.sleep(backoff(wait, i))
+
     return None
 
-def find_median_from_histogram(histogram, range):
-    # Create an array representing the value of each bin
-    bin_edges = np.linspace(range[0], range[1], len(histogram) + 1)
-    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-    
-    # Calculate the cumulative sum of the histogram
-    cumulative_sum = np.cumsum(histogram)
-    total_count = cumulative_sum[-1]
-    
-    # Find the index where the cumulative sum reaches or exceeds half the total count
-    median_index = np.searchsorted(cumulative_sum, total_count / 2)
-    
-    # Return the bin center corresponding to the median index
-    median_value = bin_centers[median_index]
-    return int(median_value)
+def read_journal(journal_path):
+    """
+    Read a padding journal: a JSON header with the padding parameters followed by
+    one line per chunk that has been written ("z,y,x crc32 size;").
 
-def validate_chunk(dataset, idx):
-    try:
-        # Attempt to read the chunk
-        chunk = dataset.read_chunk(idx)
-        if chunk is None:
-            print(f"Chunk {idx} is missing.")
-            return False
-                
-        # Check for NaNs or infinite values
-        if np.isnan(chunk).any() or np.isinf(chunk).any():
-            print(f"Chunk {idx} contains NaNs or infinite values.")
-            return False
-                
-    except Exception as e:
-        print(f"Error reading chunk {idx}: {e}")
+    :return: (header, dictionary chunk index -> (crc32, size)), header is None
+             if it is empty or truncated.
+    """
+    done = {}
+    with open(journal_path, 'r') as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            return None, done
+        for line in f:
+            line = line.strip()
+            # the last line may be incomplete after a crash
+            if line.endswith(";"):
+                idx, crc, size = line[:-1].split(" ")
+                done[tuple(int(v) for v in idx.split(","))] = (int(crc), int(size))
+    return header, done
+
+def write_journal_header(journal_path, header):
+    """
+    Start a padding journal. The header is written to a temporary file and
+    renamed, so a journal never exists without a complete header.
+    """
+    with open(journal_path + ".tmp", 'w') as f:
+        f.write(json.dumps(header) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(journal_path + ".tmp", journal_path)
+
+def pad_dataset_inplace(client, n5input, base_path, g, amp=10, retry=10, wait=1, seed=0):
+    """
+    Pad a dataset by rewriting its chunk files in place.
+
+    Every padded chunk is written to <chunk>.tmp by a worker. The driver checks
+    the CRC-32 of the file, appends the chunk to padding.journal and then renames
+    the file over the original, so an interrupted run can be resumed by running
+    the same command again: recorded chunks are not padded twice and unrecorded
+    chunks are still the originals.
+
+    :param client: Dask client.
+    :param n5input: z5py file.
+    :param base_path: Path of the N5 container.
+    :param g: Dataset path inside the container.
+    :return: True if every chunk was padded.
+    """
+    dataset_path = os.path.join(base_path, g)
+    journal_path = os.path.join(dataset_path, "padding.journal")
+    attributes = read_dataset_attributes(dataset_path)
+    compression = get_compression(attributes)
+    if compression['type'] not in SUPPORTED_COMPRESSION:
+        print(g + ": " + compression['type'] + " compression cannot be rewritten in place. Run padding without --inplace.")
+        return False
+
+    header = None
+    done = {}
+    if os.path.exists(journal_path):
+        header, done = read_journal(journal_path)
+        if header is None:
+            # interrupted before the header was complete, no chunk has been replaced
+            print(g + ": " + journal_path + " has no valid header, starting over")
+            os.remove(journal_path)
+            done = {}
+    if header is not None:
+        median_value = header['median']
+        amp = header['amp']
+        seed = header.get('seed', seed)
+        # finish renames that were interrupted
+        for idx in done:
+            commit_chunk(dataset_path, idx)
+        print(g + ": resuming padding, " + str(len(done)) + " chunks already done")
+    elif 'padding' in attributes:
+        print(g + " is already padded")
+        return True
+    else:
+        median_value = get_intensity_stats(n5input, base_path, g)["median"]
+        write_journal_header(journal_path, {'median': median_value, 'amp': amp, 'seed': seed})
+    print(g + " median: " + str(median_value))
+
+    dataset = n5input[g]
+    num_chunks = [int(np.ceil(s / c)) for s, c in zip(dataset.shape, dataset.chunks)]
+    todo = [idx for idx in np.ndindex(*num_chunks) if idx not in done]
+
+    tasks = [dask.delayed(padding_inplace)(in_dataset=dataset, dataset_path=dataset_path, compression=compression, idx=idx, median=median_value, amp=amp, retry=retry, wait=wait, seed=seed) for idx in todo]
+    failed = 0
+    with open(journal_path, 'a') as journal:
+        for future in as_completed(client.compute(tasks)):
+            result = future.result()
+            if result is None:
+                failed += 1
+                continue
+            idx, crc, size = result
+            # the worker checked the file it wrote; check it again as the driver
+            # sees it before it is recorded and replaces the original chunk
+            error = verify_chunk_file(dataset_path, chunk_key(idx) + ".tmp", crc, size)
+            if error is not None:
+                print(f"Padded chunk {idx} does not match its checksum ({error}). It will be padded again on the next run.")
+                discard_chunk_tmp(dataset_path, idx)
+                failed += 1
+                continue
+            done[idx] = (crc, size)
+            journal.write(",".join(str(v) for v in idx) + " " + str(crc) + " " + str(size) + ";\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+            commit_chunk(dataset_path, idx)
+
+    if failed > 0:
+        print(g + ": " + str(failed) + " chunks failed. Run padding again to resume.")
         return False
+
+    write_manifest(dataset_path, done)
+
+    # the intensity statistics describe the unpadded data
+    invalidate_histogram(dataset_path)
+    s_attr = os.path.join(dataset_path, "attributes.json")
+    with open(s_attr, 'r+') as f:
+        data = json.load(f)
+        data.pop(STATS_KEY, None)
+        data['padding'] = {'median': median_value, 'amp': amp, 'seed': seed}
+        f.seek(0)
+        json.dump(data, f, indent=4)
+        f.truncate()
+    os.remove(journal_path)
     return True
 
 def main():
@@ -177,6 +296,8 @@ def main():
     parser.add_argument("-t", "--thread", dest="thread", type=int, default=0, help="number of threads")
     parser.add_argument("-c", "--ch", dest="ch", type=str, default=0, help="channel")
     parser.add_argument("-s", "--scale", dest="scale", type=str, default=0, help="scale")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="seed of the padding noise (each chunk uses the seed and its position)")
+    parser.add_argument("--inplace", dest="inplace", default=False, action="store_true", help="rewrite the chunks in place instead of writing a temporary dataset (resumable)")
     parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
 
     if not argv:
@@ -210,18 +331,25 @@ def main():
 
     n5input = z5py.File(base_path, use_zarr_format=False)
 
-    bins = 65534
-    range = (1, 65535)
-
     cluster = LocalCluster(n_workers=threadnum, threads_per_worker=1)
     client = Client(cluster)
     for g in group_paths:
+        if args.inplace:
+            if not pad_dataset_inplace(client, n5input, base_path, g, seed=args.seed):
+                client.close()
+                cluster.close()
+                sys.exit(1)
+            continue
+
         downsampling_factors = None
         pixel_resolution = None
         if os.path.exists(os.path.join(base_path, g)):
             s_attr = os.path.join(base_path, g+os.path.sep+"attributes.json")
             with open(s_attr, 'r+') as f:
                 data = json.load(f)
+                if 'padding' in data:
+                    print(g + " is already padded")
+                    continue
                 if 'downsamplingFactors' in data:
                     downsampling_factors = data['downsamplingFactors']
                 if 'pixelResolution' in data:
@@ -230,22 +358,26 @@ def main():
         shape = n5input[g].shape
         chunks = n5input[g].chunks
         num_chunks = [int(np.ceil(s / c)) for s, c in zip(shape, chunks)]
-        futures = []
-        for idx in np.ndindex(*num_chunks):
-            future = dask.delayed(compute_histogram2)(dataset=n5input[g], idx=idx, bins=bins, range=range)
-            futures.append(future)
-        histograms = dask.compute(futures)[0]
-        overall_histogram = np.sum(histograms, axis=0)
-        median_value = find_median_from_histogram(overall_histogram, range)
+        median_value = get_intensity_stats(n5input, base_path, g)["median"]
+        print(g + " median: " + str(median_value))
 
+        # the padded dataset keeps the compression of the input
+        compression = get_compression(read_dataset_attributes(os.path.join(base_path, g)))
+        if compression['type'] not in SUPPORTED_COMPRESSION:
+            compression = {'type': 'gzip'}
         new_dataset_path = 'tmp_'+ g
-        new_dataset = n5input.create_dataset(new_dataset_path, shape=n5input[g].shape, chunks=n5input[g].chunks, dtype=n5input[g].dtype)
-        
+        new_dataset = n5input.create_dataset(new_dataset_path, shape=n5input[g].shape, chunks=n5input[g].chunks, dtype=n5input[g].dtype, compression=compression['type'])
+        compression = get_compression(read_dataset_attributes(os.path.join(base_path, new_dataset_path)))
+
         futures = []
         for idx in np.ndindex(*num_chunks):
-            future = dask.delayed(padding2)(in_dataset=n5input[g], out_dataset=new_dataset, idx=idx, median=median_value, amp=10, retry=10, wait=5)
+            future = dask.delayed(padding2)(in_dataset=n5input[g], out_path=os.path.join(base_path, new_dataset_path), compression=compression, idx=idx, median=median_value, amp=10, retry=10, wait=1, seed=args.seed)
             futures.append(future)
         padding_results = dask.compute(futures)[0]
+        checksums = {r[0]: (r[1], r[2]) for r in padding_results if r is not None}
+        if len(checksums) < len(padding_results):
+            print(g + ": " + str(len(padding_results) - len(checksums)) + " chunks failed")
+        write_manifest(os.path.join(base_path, new_dataset_path), checksums)
 
         if os.path.exists(os.path.join(base_path, new_dataset_path)):
             s_attr = os.path.join(base_path, new_dataset_path+os.path.sep+"attributes.json")
@@ -255,6 +387,7 @@ def main():
                     data['downsamplingFactors'] = downsampling_factors
                 if pixel_resolution is not None:
                     data['pixelResolution'] = pixel_resolution
+                data['padding'] = {'median': median_value, 'amp': 10, 'seed': args.seed}
                 f.seek(0)
                 json.dump(data, f, indent=4)
                 f.truncate()
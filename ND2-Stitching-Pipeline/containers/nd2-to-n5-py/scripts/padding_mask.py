@@ -19,6 +19,8 @@ import shutil
 
 import time
 
+from intensity_stats import get_intensity_stats
+
 from scipy.ndimage import binary_fill_holes
 from skimage.filters import threshold_triangle, gaussian
 from skimage import io, transform, measure, morphology
@@ -46,26 +48,6 @@ def generate_mask(data_chunk, th):
     return data_chunk
 
 
-def compute_histogram(chunk, bins, range):
-    hist, edges = np.histogram(chunk, bins=bins, range=range)
-    return hist
-
-def find_median_from_histogram(histogram, range):
-    # Create an array representing the value of each bin
-    bin_edges = np.linspace(range[0], range[1], len(histogram) + 1)
-    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-    
-    # Calculate the cumulative sum of the histogram
-    cumulative_sum = np.cumsum(histogram)
-    total_count = cumulative_sum[-1]
-    
-    # Find the index where the cumulative sum reaches or exceeds half the total count
-    median_index = np.searchsorted(cumulative_sum, total_count / 2)
-    
-    # Return the bin center corresponding to the median index
-    median_value = bin_centers[median_index]
-    return int(median_value)
-
 def validate_chunk(dataset, idx):
     try:
         # Attempt to read the chunk
@@ -85,54 +67,6 @@ def validate_chunk(dataset, idx):
     return True
 
 
-def triangle_threshold(data):
-    """
-    Calculate the threshold value using the triangle method.
-
-    Parameters:
-    data (numpy array): Histogram data of the image.
-
-    Returns:
-    int: Calculated threshold value.
-    """
-    # Find the first and last non-zero bins in the histogram
-    min_val = np.nonzero(data)[0][0]
-    min2 = np.nonzero(data)[0][-1]
-    max_index = np.argmax(data)
-    dmax = data[max_index]
-
-    # Determine if we need to invert the histogram
-    inverted = False
-    if (max_index - min_val) < (min2 - max_index):
-        # Invert histogram by flipping it
-        data = data[::-1]
-        min_val, max_index = len(data) - min2 - 1, len(data) - max_index - 1
-        inverted = True
-
-    # Edge case: if min_val equals max_index, return min_val
-    if min_val == max_index:
-        return min_val
-
-    # Calculate normalized line parameters for the triangle
-    nx = dmax  # max value at the peak
-    ny = min_val - max_index
-    norm = np.sqrt(nx**2 + ny**2)
-    nx /= norm
-    ny /= norm
-    d = nx * min_val + ny * data[min_val]
-
-    # Compute distances from each histogram point to the line and find max distance
-    x_indices = np.arange(min_val, max_index + 1)
-    distances = nx * x_indices + ny * data[min_val:max_index + 1] - d
-    split = x_indices[np.argmax(distances)] - 1
-
-    # Adjust if inverted
-    if inverted:
-        return len(data) - split - 1
-    else:
-        return split
-
-
 def main():
 
     argv = sys.argv
@@ -177,17 +111,12 @@ def main():
 
     n5input = z5py.File(input, use_zarr_format=False)
 
-    bins = 65534
-    intensity_range = (1, 65535)
-
     cluster = LocalCluster(n_workers=threadnum, threads_per_worker=1)
     client = Client(cluster)
 
     dask_array = da.from_array(n5input[group_path], chunks=n5input[group_path].chunks)
-    futures = [dask.delayed(compute_histogram)(chunk=chunk, bins=bins, range=intensity_range) for chunk in dask_array.to_delayed().ravel()]
-    histograms = np.array(dask.compute(futures)[0])
-    overall_histogram = np.sum(histograms, axis=0)
-    threshold_val = triangle_threshold(overall_histogram)
+    threshold_val = get_intensity_stats(n5input, input, group_path)["triangle"]
+    print(group_path + " threshold: " + str(threshold_val))
     mask_array = dask_array.map_blocks(generate_mask, th=threshold_val, dtype=dask_array.dtype).compute()
 
     xy_scale = min(350 / mask_array.shape[1], 350 / mask_array.shape[2])
@@ -0,0 +1,377 @@
+import numpy as np
+import tifffile
+import z5py
+
+import os
+import sys
+import argparse
+
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Translation-only stitching of a BigStitcher XML without Fiji: pairwise phase
+# correlation of the tile overlaps on downsampled tiles, then a global
+# optimization with iterative dropping of bad links (as calc_stitch.py does
+# with BigStitcher, without the ICP refinement). The result is prepended to the
+# ViewRegistrations as a "Stitching Transform".
+
+def parse_affine(text):
+    a = np.eye(4)
+    a[:3, :] = np.array([float(v) for v in text.split()]).reshape(3, 4)
+    return a
+
+def get_model(registration):
+    """
+    Compose the ViewTransforms of a ViewRegistration (the first one is applied last).
+
+    :return: 4x4 matrix from pixel (x, y, z) to global coordinates.
+    """
+    model = np.eye(4)
+    for vt in registration.findall("./ViewTransform"):
+        model = model @ parse_affine(vt.find("affine").text)
+    return model
+
+def get_tiles(xml, channel=None):
+    """
+    Views used for stitching, one per tile and timepoint.
+
+    :param xml: Parsed XML (ElementTree).
+    :param channel: Channel id used for stitching, the lowest channel if None.
+    :return: Dictionary timepoint -> list of (tile id, setup id, size (x, y, z), model).
+    """
+    setups = {}
+    for item in xml.findall(".//ViewSetup"):
+        attr_item = item.find("./attributes")
+        setups[item.find("./id").text] = (
+            attr_item.find("./tile").text,
+            int(attr_item.find("./channel").text),
+            [int(v) for v in item.find("./size").text.split()],
+        )
+    if channel is None:
+        channel = min(ch for _, ch, _ in setups.values())
+    tiles = {}
+    for item in xml.findall(".//ViewRegistration"):
+        setup_id = item.attrib['setup']
+        tile_id, ch, size = setups[setup_id]
+        if ch != channel:
+            continue
+        tiles.setdefault(item.attrib['timepoint'], []).append((tile_id, setup_id, size, get_model(item)))
+    for t in tiles:
+        tiles[t].sort(key=lambda v: int(v[0]))
+    return tiles
+
+def get_image_paths(xml, xml_path):
+    """
+    Image of every view, from the ImageLoader of the XML.
+
+    :return: Dictionary (timepoint, setup id) -> ('tiff', path) or ('n5', (container path, dataset)).
+    """
+    base_dir = os.path.dirname(os.path.abspath(xml_path))
+    base_path = xml.find(".//BasePath")
+    if base_path is not None and base_path.attrib.get('type') == 'relative':
+        base_dir = os.path.join(base_dir, base_path.text)
+    paths = {}
+    n5 = xml.find(".//SequenceDescription/ImageLoader/n5")
+    if n5 is not None:
+        n5path = n5.text if n5.attrib.get('type') != 'relative' else os.path.join(base_dir, n5.text)
+        for item in xml.findall(".//ViewRegistration"):
+            t, setup_id = item.attrib['timepoint'], item.attrib['setup']
+            paths[(t, setup_id)] = ('n5', (n5path, "setup" + setup_id + "/timepoint" + t + "/s0"))
+    else:
+        for item in xml.findall(".//FileMapping"):
+            key = (item.attrib['timepoint'], item.attrib['view_setup'])
+            paths[key] = ('tiff', os.path.normpath(os.path.join(base_dir, item.find("./file").text)))
+    return paths
+
+def block_mean(arr, factors):
+    """
+    Downsample a (z, y, x) array by averaging blocks, the remainder is dropped.
+    """
+    dz, dy, dx = factors
+    nz, ny, nx = (s // f for s, f in zip(arr.shape, factors))
+    arr = arr[:nz * dz, :ny * dy, :nx * dx].astype(np.float32)
+    return arr.reshape(nz, dz, ny, dy, nx, dx).mean(axis=(1, 3, 5))
+
+def read_downsampled(source, factors):
+    """
+    Read a tile slab by slab and downsample it.
+
+    :param source: ('tiff', path) or ('n5', (container path, dataset)).
+    :param factors: Downsampling factors (z, y, x).
+    :return: float32 array (z, y, x).
+    """
+    kind, path = source
+    dz = factors[0]
+    slabs = []
+    if kind == 'n5':
+        dataset = z5py.File(path[0], use_zarr_format=False)[path[1]]
+        nz = dataset.shape[0]
+        for z in range(0, nz - nz % dz, dz):
+            slabs.append(block_mean(dataset[z:z + dz], factors))
+    else:
+        with tifffile.TiffFile(path) as tif:
+            nz = len(tif.pages)
+            for z in range(0, nz - nz % dz, dz):
+                slab = tif.asarray(key=range(z, z + dz))
+                slabs.append(block_mean(slab.reshape((dz,) + slab.shape[-2:]), factors))
+    return np.concatenate(slabs, axis=0)
+
+def get_overlap(tile_a, tile_b, factors):
+    """
+    Overlap of two tiles at their current positions, in downsampled pixels of each tile.
+
+    :return: (start in a (z, y, x), start in b, shape, fractional part of b - a start) or None.
+    """
+    factors_xyz = np.array(list(reversed(factors)), dtype=float)
+    lo, hi = [], []
+    for _, _, size, model in (tile_a, tile_b):
+        lo.append(model[:3, 3])
+        hi.append(model[:3, 3] + np.diag(model)[:3] * np.array(size))
+    box_lo = np.maximum(lo[0], lo[1])
+    box_hi = np.minimum(hi[0], hi[1])
+    if np.any(box_hi <= box_lo):
+        return None
+    starts = []
+    fracs = []
+    for _, _, size, model in (tile_a, tile_b):
+        start = (box_lo - model[:3, 3]) / np.diag(model)[:3] / factors_xyz
+        starts.append(np.floor(start).astype(int))
+        fracs.append(start - np.floor(start))
+    shape = np.floor((box_hi - box_lo) / np.diag(tile_a[3])[:3] / factors_xyz).astype(int)
+    if np.any(shape < 8):
+        return None
+    return tuple(reversed(starts[0])), tuple(reversed(starts[1])), tuple(reversed(shape)), tuple(reversed(fracs[1] - fracs[0]))
+
+def crop(image, start, shape):
+    start = [max(0, min(s, n - m)) for s, n, m in zip(start, image.shape, shape)]
+    return image[tuple(slice(s, s + m) for s, m in zip(start, shape))]
+
+def correlation(a, b, shift):
+    """
+    Pearson correlation of a(x) and b(x - shift) over their overlap.
+
+    :return: (r, number of voxels)
+    """
+    sa = tuple(slice(max(0, s), n + min(0, s)) for s, n in zip(shift, a.shape))
+    sb = tuple(slice(max(0, -s), n - max(0, s)) for s, n in zip(shift, b.shape))
+    va = a[sa].ravel()
+    vb = b[sb].ravel()
+    if va.size < 2:
+        return -1.0, 0
+    va = va - va.mean()
+    vb = vb - vb.mean()
+    denom = np.sqrt((va * va).sum() * (vb * vb).sum())
+    if denom == 0:
+        return -1.0, va.size
+    return float((va * vb).sum() / denom), va.size
+
+def subpixel(pcm, peak):
+    """
+    Quadratic fit of the phase correlation peak along each axis.
+    """
+    offset = []
+    for axis, n in enumerate(pcm.shape):
+        if n < 3:
+            offset.append(0.0)
+            continue
+        idx = list(peak)
+        c = pcm[tuple(idx)]
+        idx[axis] = (peak[axis] - 1) % n
+        l = pcm[tuple(idx)]
+        idx[axis] = (peak[axis] + 1) % n
+        r = pcm[tuple(idx)]
+        denom = l - 2 * c + r
+        offset.append(0.0 if denom == 0 else float(np.clip(0.5 * (l - r) / denom, -0.5, 0.5)))
+    return offset
+
+def phase_correlation(a, b, peaks=5, min_overlap=0.1):
+    """
+    Shift of b relative to a, a(x) = b(x - shift), from the phase correlation matrix.
+    The peaks are ambiguous modulo the image size, every interpretation is checked
+    with the cross correlation of the overlap.
+
+    :param peaks: Number of peaks checked.
+    :param min_overlap: Smallest overlap (fraction of the voxels) of an accepted shift.
+    :return: (shift (z, y, x) as floats, r)
+    """
+    # the window suppresses the edges, which are not periodic
+    window = np.ones(a.shape, dtype=np.float32)
+    for axis, n in enumerate(a.shape):
+        shape = [1] * a.ndim
+        shape[axis] = n
+        window = window * np.hanning(n + 2)[1:-1].astype(np.float32).reshape(shape)
+    fa = np.fft.rfftn((a - a.mean()) * window)
+    fb = np.fft.rfftn((b - b.mean()) * window)
+    cps = fa * np.conj(fb)
+    cps /= np.abs(cps) + 1e-12
+    pcm = np.fft.irfftn(cps, s=a.shape, axes=list(range(a.ndim)))
+
+    flat = pcm.ravel()
+    count = min(peaks, flat.size)
+    best = (None, -1.0)
+    for index in np.argpartition(flat, -count)[-count:]:
+        peak = np.unravel_index(index, pcm.shape)
+        candidates = [[0]]
+        for p, n in zip(peak, pcm.shape):
+            candidates = [c + [s] for c in candidates for s in ((p, p - n) if p > 0 else (p,))]
+        for c in candidates:
+            shift = c[1:]
+            r, voxels = correlation(a, b, shift)
+            if voxels >= min_overlap * a.size and r > best[1]:
+                best = (np.array(shift, dtype=float) + subpixel(pcm, peak), r)
+    return best
+
+def optimize(num_tiles, links, fixed=0, relative=2.5, absolute=3.5, prior=1e-3):
+    """
+    Translations of the tiles that agree best with the pairwise shifts.
+    The link with the largest error is dropped while it is larger than
+    absolute or relative times the mean error. Tiles that are not connected
+    to the fixed tile keep their metadata positions (weak prior towards 0).
+
+    :param links: List of (i, j, shift of j relative to i (x, y, z), weight).
+    :return: (translations (num_tiles, 3), links that were kept)
+    """
+    links = list(links)
+    while True:
+        rows = []
+        rhs = []
+        for i, j, shift, w in links:
+            row = np.zeros(num_tiles)
+            row[i] = -w
+            row[j] = w
+            rows.append(row)
+            rhs.append(w * np.asarray(shift))
+        for i in range(num_tiles):
+            row = np.zeros(num_tiles)
+            row[i] = 1e3 if i == fixed else prior
+            rows.append(row)
+            rhs.append(np.zeros(3))
+        solution = np.linalg.lstsq(np.array(rows), np.array(rhs), rcond=None)[0]
+        if not links:
+            return solution, links
+        errors = np.array([np.linalg.norm(solution[j] - solution[i] - np.asarray(shift)) for i, j, shift, _ in links])
+        worst = int(np.argmax(errors))
+        if errors[worst] <= absolute and errors[worst] <= relative * errors.mean():
+            return solution, links
+        # a link is only dropped if both tiles keep another link
+        degree = np.bincount([v for i, j, _, _ in links for v in (i, j)], minlength=num_tiles)
+        i, j = links[worst][:2]
+        if degree[i] < 2 or degree[j] < 2:
+            return solution, links
+        print("dropping link " + str(links[worst][:2]) + ", error " + str(round(float(errors[worst]), 3)))
+        links.pop(worst)
+
+def stitch_timepoint(tiles, images, factors, minr, max_shift, relative, absolute, threads):
+    """
+    :param tiles: List of (tile id, setup id, size (x, y, z), model) from get_tiles.
+    :param images: Downsampled images (z, y, x) in the same order.
+    :return: Translations (len(tiles), 3) in global coordinates.
+    """
+    pairs = []
+    for i in range(len(tiles)):
+        for j in range(i + 1, len(tiles)):
+            overlap = get_overlap(tiles[i], tiles[j], factors)
+            if overlap is not None:
+                pairs.append((i, j, overlap))
+
+    def run_pair(pair):
+        i, j, (start_a, start_b, shape, frac) = pair
+        shift, r = phase_correlation(crop(images[i], start_a, shape), crop(images[j], start_b, shape))
+        if shift is None:
+            return i, j, None, r
+        # a(x) = b(x - s): tile j has to move by s relative to tile i
+        shift = (shift + np.array(frac)) * np.array(factors)
+        scale = np.diag(tiles[j][3])[:3]
+        return i, j, np.array(list(reversed(shift))) * scale, r
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        results = list(executor.map(run_pair, pairs))
+
+    links = []
+    for i, j, shift, r in results:
+        name = "tile " + tiles[i][0] + " - tile " + tiles[j][0]
+        if shift is None or r < minr:
+            print(name + ": r " + str(round(r, 3)) + ", removed")
+            continue
+        if np.any(np.abs(shift) > max_shift):
+            print(name + ": shift " + str(np.round(shift, 2).tolist()) + ", removed")
+            continue
+        print(name + ": shift " + str(np.round(shift, 2).tolist()) + ", r " + str(round(r, 3)))
+        links.append((i, j, shift, r))
+
+    translations, kept = optimize(len(tiles), links, relative=relative, absolute=absolute)
+    print(str(len(kept)) + " of " + str(len(pairs)) + " links used")
+    return translations
+
+def apply_translations(xml, timepoint, tile_translations):
+    """
+    Prepend a Stitching Transform to every view of the stitched tiles.
+
+    :param tile_translations: Dictionary tile id -> translation (x, y, z).
+    """
+    tile_of_setup = {item.find("./id").text: item.find("./attributes/tile").text for item in xml.findall(".//ViewSetup")}
+    for item in xml.findall(".//ViewRegistration"):
+        if item.attrib['timepoint'] != timepoint:
+            continue
+        translation = tile_translations.get(tile_of_setup[item.attrib['setup']])
+        if translation is None:
+            continue
+        affine = np.eye(4)[:3]
+        affine[:, 3] = translation
+        vt = ET.Element("ViewTransform", {'type': 'affine'})
+        ET.SubElement(vt, "Name").text = "Stitching Transform"
+        ET.SubElement(vt, "affine").text = " ".join(str(float(v)) for v in affine.ravel())
+        item.insert(0, vt)
+
+def main():
+
+    argv = sys.argv
+    argv = argv[1:]
+
+    usage_text = ("Usage:" + "  py_stitch.py" + " [options]")
+    parser = argparse.ArgumentParser(description=usage_text)
+    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input XML, the tiles are read with its image loader (TIFF or N5)")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="XML that receives the stitching transforms (default: input), e.g. the resaved XML with the same views")
+    parser.add_argument("-c", "--channel", dest="channel", type=int, default=None, help="channel id used for stitching (default: lowest channel)")
+    parser.add_argument("-d", "--downsample", dest="downsample", type=str, default="8,8,4", help="downsampling (x,y,z)")
+    parser.add_argument("-r", "--minr", dest="minr", type=float, default=0.3, help="min r for link quality")
+    parser.add_argument("--max_shift", dest="max_shift", type=float, default=100.0, help="largest pairwise shift in each dimension (global coordinates)")
+    parser.add_argument("--relative", dest="relative", type=float, default=2.5, help="relative error threshold of the global optimization")
+    parser.add_argument("--absolute", dest="absolute", type=float, default=3.5, help="absolute error threshold of the global optimization")
+    parser.add_argument("-t", "--thread", dest="thread", type=int, default=4, help="number of threads")
+    parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
+
+    if not argv:
+        parser.print_help()
+        exit()
+
+    args = parser.parse_args(argv)
+
+    output = args.output if args.output is not None else args.input
+    factors = tuple(reversed([int(v) for v in args.downsample.split(",")]))
+
+    xml = ET.parse(args.input)
+    tiles = get_tiles(xml, args.channel)
+    paths = get_image_paths(xml, args.input)
+
+    out_xml = xml if output == args.input else ET.parse(output)
+    for t in sorted(tiles, key=int):
+        views = tiles[t]
+        print("timepoint " + t + ": " + str(len(views)) + " tiles")
+        with ThreadPoolExecutor(max_workers=max(1, args.thread)) as executor:
+            images = list(executor.map(lambda v: read_downsampled(paths[(t, v[1])], factors), views))
+        translations = stitch_timepoint(views, images, factors, args.minr, args.max_shift, args.relative, args.absolute, args.thread)
+        tile_translations = {}
+        for view, translation in zip(views, translations):
+            tile_translations[view[0]] = translation
+            if args.verbose:
+                print("tile " + view[0] + ": " + str(np.round(translation, 3).tolist()))
+        apply_translations(out_xml, t, tile_translations)
+
+    out_xml.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
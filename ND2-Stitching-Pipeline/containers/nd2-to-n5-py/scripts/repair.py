@@ -0,0 +1,262 @@
+import numpy as np
+import tifffile
+
+import os
+import sys
+import re
+import argparse
+
+import nd2
+import zarr
+import dask
+from distributed import LocalCluster, Client, as_completed
+
+import xml.etree.ElementTree as ET
+
+import json
+
+import time
+
+from intensity_stats import STATS_KEY
+from histogram import invalidate_histogram
+from padding import padding
+from n5_chunk import read_dataset_attributes, get_compression, write_chunk_tmp, commit_chunk, discard_chunk_tmp, read_manifest, write_manifest, backoff, DTYPES, SUPPORTED_COMPRESSION
+
+def get_source_files(xml_path):
+    """
+    Source TIFF of each view setup from the FileMapping of a BigStitcher XML
+    (the per-timepoint XML written by nd2tiffxml.py).
+
+    :param xml_path: Path of the XML.
+    :return: Dictionary setup id -> absolute path of the TIFF.
+    """
+    xml = ET.parse(xml_path)
+    xmldir = os.path.dirname(os.path.abspath(xml_path))
+    files = {}
+    for item in xml.findall(".//FileMapping"):
+        file = item.find("./file")
+        path = file.text.strip()
+        if file.attrib.get('type', 'relative') == 'relative':
+            path = os.path.normpath(os.path.join(xmldir, path))
+        files[int(item.attrib['view_setup'])] = path
+    return files
+
+def get_tile_ids(tiff_path):
+    """
+    Tile, channel and timepoint of a tiff_<tile>_<ch>_<time>.tif file.
+    """
+    numbers = re.findall(r'\d+', os.path.basename(tiff_path))
+    return int(numbers[-3]), int(numbers[-2]), int(numbers[-1])
+
+def read_tiff_region(tiff_path, region):
+    """
+    Read a region of a TIFF stack without decoding the other planes.
+
+    :param region: Tuple of slices (z, y, x).
+    """
+    with tifffile.imread(tiff_path, aszarr=True) as store:
+        return zarr.open(store, mode='r')[region]
+
+def read_nd2_region(nd2_path, tile_id, ch_id, time_id, crop_percentages, region):
+    """
+    Read a region of one tile from the ND2 source, cropped like nd2tiff.py.
+
+    :param region: Tuple of slices (z, y, x) in the cropped tile.
+    """
+    # one handle per call, closed before returning; only the planes of the
+    # region are read through the lazy array
+    with nd2.ND2File(nd2_path) as nd2file:
+        sizes = dict(nd2file.sizes)
+        darray = nd2file.to_dask()
+
+        w = sizes['X']
+        h = sizes['Y']
+        st_x = int(crop_percentages[2] * 0.01 * w + 0.5)
+        st_y = int(crop_percentages[0] * 0.01 * h + 0.5)
+
+        index = []
+        for key in sizes:
+            if key == 'T':
+                index.append(time_id)
+            elif key == 'P':
+                index.append(tile_id)
+            elif key == 'C':
+                index.append(ch_id)
+            elif key == 'Z':
+                index.append(region[0])
+            elif key == 'Y':
+                index.append(slice(st_y + region[1].start, st_y + region[1].stop))
+            elif key == 'X':
+                index.append(slice(st_x + region[2].start, st_x + region[2].stop))
+            else:
+                index.append(0)
+        data = np.asarray(darray[tuple(index)])
+    if 'Z' not in sizes:
+        data = data[np.newaxis]
+    return data
+
+def repair_chunk(dataset_path, idx, shape, chunks, dtype, compression, tiff_path, nd2_path, crop_percentages, pad, retry, wait):
+    """
+    Regenerate one chunk from its source and write it to a temporary file next to the chunk.
+
+    :param idx: Chunk position (z, y, x).
+    :param pad: Padding parameters of the dataset {median, amp, seed}, or None.
+    :return: (idx, crc32, size) of the written chunk file, None on failure.
+    """
+    region = tuple(slice(i * c, min((i + 1) * c, s)) for i, c, s in zip(idx, chunks, shape))
+    try:
+        if tiff_path is not None and os.path.exists(tiff_path):
+            data_chunk = read_tiff_region(tiff_path, region)
+        elif nd2_path is not None:
+            tile_id, ch_id, time_id = get_tile_ids(tiff_path)
+            data_chunk = read_nd2_region(nd2_path, tile_id, ch_id, time_id, crop_percentages, region)
+        else:
+            print(f"Chunk {idx}: {tiff_path} not found and no ND2 source given")
+            return None
+        data_chunk = np.array(data_chunk, dtype=dtype)
+        expected = tuple(r.stop - r.start for r in region)
+        if data_chunk.shape != expected:
+            print(f"Chunk {idx}: source region {data_chunk.shape} != {expected}")
+            return None
+    except Exception as e:
+        print(f"Error reading the source of chunk {idx}: {e}")
+        return None
+
+    if pad is not None:
+        data_chunk = padding(data_chunk, pad['median'], pad['amp'], seed=[pad.get('seed', 0), *idx])
+
+    for i in range(0, retry):
+        try:
+            crc, size = write_chunk_tmp(dataset_path, idx, data_chunk, compression)
+            return idx, crc, size
+        except Exception as e:
+            print(f"Error writing chunk {idx}: {e}")
+        print(f"retry to write chunk {idx}")
+        time.sleep(backoff(wait, i))
+
+    discard_chunk_tmp(dataset_path, idx)
+    return None
+
+def repair_dataset(client, base_path, g, chunk_ids, files, nd2_path, crop_percentages, retry=10, wait=1):
+    """
+    Rewrite the listed chunks of a dataset from the source of its view setup.
+    Every chunk is written to <chunk>.tmp and renamed over the original.
+
+    :param client: Dask client.
+    :param base_path: Path of the N5 container.
+    :param g: Dataset path inside the container (setup<id>/timepoint0/s0).
+    :param chunk_ids: Chunk positions (z, y, x) to rewrite.
+    :param files: Dictionary setup id -> source TIFF (get_source_files).
+    :return: Number of chunks that could not be repaired.
+    """
+    match = re.fullmatch(r'setup(\d+)/timepoint\d+/s0', g.strip("/"))
+    if match is None:
+        print(g + ": only full resolution datasets of a resaved N5 (setup<id>/timepoint<t>/s0) map to source tiles. Regenerate it with fusion/downsampling instead.")
+        return len(chunk_ids)
+    setup_id = int(match.group(1))
+    if setup_id not in files:
+        print(g + ": setup " + str(setup_id) + " is not in the FileMapping of the XML")
+        return len(chunk_ids)
+    tiff_path = files[setup_id]
+
+    dataset_path = os.path.join(base_path, g)
+    attributes = read_dataset_attributes(dataset_path)
+    compression = get_compression(attributes)
+    if compression['type'] not in SUPPORTED_COMPRESSION:
+        print(g + ": " + compression['type'] + " compression cannot be rewritten in place.")
+        return len(chunk_ids)
+    shape = tuple(reversed(attributes['dimensions']))
+    chunks = tuple(reversed(attributes['blockSize']))
+    dtype = np.dtype(DTYPES[attributes['dataType']])
+    pad = attributes.get('padding')
+    print(g + ": repairing " + str(len(chunk_ids)) + " chunks from " + tiff_path + (" with padding " + json.dumps(pad) if pad is not None else ""))
+
+    tasks = [dask.delayed(repair_chunk)(dataset_path, idx, shape, chunks, dtype, compression, tiff_path, nd2_path, crop_percentages, pad, retry, wait) for idx in chunk_ids]
+    repaired = {}
+    for future in as_completed(client.compute(tasks)):
+        result = future.result()
+        if result is None:
+            continue
+        idx, crc, size = result
+        commit_chunk(dataset_path, idx)
+        repaired[idx] = (crc, size)
+
+    manifest = read_manifest(dataset_path)
+    if manifest is not None:
+        checksums = {tuple(reversed([int(v) for v in key.split("/")])): entry for key, entry in manifest.items()}
+        checksums.update(repaired)
+        write_manifest(dataset_path, checksums)
+
+    # cached statistics may have been computed over the corrupt chunks
+    invalidate_histogram(dataset_path)
+    s_attr = os.path.join(dataset_path, "attributes.json")
+    with open(s_attr, 'r+') as f:
+        data = json.load(f)
+        if STATS_KEY in data:
+            data.pop(STATS_KEY)
+            f.seek(0)
+            json.dump(data, f, indent=4)
+            f.truncate()
+
+    return len(chunk_ids) - len(repaired)
+
+def main():
+
+    argv = sys.argv
+    argv = argv[1:]
+
+    usage_text = ("Usage:" + "  repair.py" + " [options]")
+    parser = argparse.ArgumentParser(description=usage_text)
+    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input file path (.n5 or the .xml next to it), default: the n5 of the report")
+    parser.add_argument("-r", "--report", dest="report", type=str, default=None, help="report of validate.py (.json)")
+    parser.add_argument("-x", "--xml", dest="xml", type=str, default=None, help="XML with the FileMapping to the tiff_* files (output of nd2tiffxml.py)")
+    parser.add_argument("-n", "--nd2", dest="nd2", type=str, default=None, help="ND2 source, used when a tiff_* file no longer exists")
+    parser.add_argument("-c", "--crop", dest="crop", type=str, default="0,0,0,0", help="cropping percentage used by nd2tiff (top,bottom,left,right)")
+    parser.add_argument("-t", "--thread", dest="thread", type=int, default=0, help="number of threads")
+    parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
+
+    if not argv:
+        parser.print_help()
+        exit()
+
+    args = parser.parse_args(argv)
+
+    with open(args.report, 'r') as f:
+        report = json.load(f)
+
+    if args.input is not None:
+        dataname = os.path.basename(args.input.rstrip("/"))
+        indirpath = os.path.dirname(args.input.rstrip("/"))
+        stem = os.path.splitext(dataname)[0]
+        base_path = os.path.join(indirpath, stem + ".n5")
+    else:
+        base_path = report['n5']
+
+    crop_percentages = [float(num) if '.' in num else int(num) for num in args.crop.split(',')]
+    files = get_source_files(args.xml)
+
+    cluster = LocalCluster(n_workers=args.thread, threads_per_worker=1)
+    client = Client(cluster)
+
+    failed = 0
+    for dataset_report in report['datasets']:
+        g = dataset_report['dataset']
+        chunk_ids = [tuple(b['chunk']) for b in dataset_report['bad']]
+        if not chunk_ids:
+            continue
+        if args.verbose:
+            for b in dataset_report['bad']:
+                print("  " + b['path'] + ": " + b['error'])
+        n = repair_dataset(client, base_path, g, chunk_ids, files, args.nd2, crop_percentages)
+        print(g + " repaired: " + str(len(chunk_ids) - n) + ", failed: " + str(n))
+        failed += n
+
+    client.close()
+    cluster.close()
+
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,168 +1,257 @@
 import numpy as np
-import tifffile
 
 import os
 import sys
-import re
 import argparse
 
-import z5py
 import dask
-import dask.array as da
-from distributed import LocalCluster, Client, Variable
-
-from pathlib import Path
+from distributed import LocalCluster, Client
 
 import json
 
-import shutil
-
-import time
-
-import io
-
-import gzip
-
-def padding(data_chunk, median, amp):
-    mm = median
-
-    # Calculate vv
-    vv = int(mm // amp)  # Use integer division
-
-    # Generate masks for low intensity pixels
-    masks = (data_chunk < mm - vv)
-
-    # Set all low intensity pixels to zero
-    data_chunk = data_chunk * (~masks).astype(np.uint16)
-
-    white_noise = np.random.normal(0, 1.0, data_chunk.shape) * vv + mm
-    data_chunk += (white_noise * masks).astype(np.uint16)
-
-    return data_chunk
-
+import zlib
+import bz2
+import lzma
+import struct
+
+from n5_chunk import read_dataset_attributes, get_compression, parse_chunk_header, read_manifest, DTYPES
+
+try:
+    from numcodecs import Blosc, Zstd
+except ImportError:
+    Blosc = None
+    Zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_SIZE = 1 << 20
+
+def expected_dims(pos, block_size, dimensions):
+    """
+    Size of the chunk at a grid position (all in x/y/z order).
+    """
+    return tuple(min(b, d - p * b) for p, b, d in zip(pos, block_size, dimensions))
+
+def stream_decompress(f, decompressor, crc):
+    """
+    Decompress the rest of a file block by block without keeping the output.
+
+    :return: (number of decompressed bytes, crc32 of the compressed bytes)
+    """
+    total = 0
+    while True:
+        block = f.read(READ_SIZE)
+        if not block:
+            break
+        crc = zlib.crc32(block, crc)
+        total += len(decompressor.decompress(block))
+    if not decompressor.eof:
+        raise ValueError("truncated stream")
+    if decompressor.unused_data:
+        raise ValueError("trailing data after the compressed stream")
+    return total, crc
+
+def check_gzip_fast(f, payload_offset, file_size, expected_nbytes, use_zlib):
+    magic = f.read(2)
+    if use_zlib:
+        if len(magic) < 2 or magic[0] & 0x0f != 8 or (magic[0] * 256 + magic[1]) % 31 != 0:
+            return 'bad zlib header'
+        return None
+    if magic != b'\x1f\x8b':
+        return 'bad gzip header'
+    if file_size - payload_offset < 18:
+        return 'truncated'
+    # gzip trailer: CRC32 and ISIZE (uncompressed size mod 2^32), little endian
+    f.seek(file_size - 4)
+    isize = struct.unpack('<I', f.read(4))[0]
+    if isize != expected_nbytes % (1 << 32):
+        return 'size: gzip ISIZE ' + str(isize) + ' != ' + str(expected_nbytes)
+    return None
 
-def padding2(in_dataset, out_dataset, idx, median, amp, retry, wait):
+def check_blosc_fast(header, payload_size, expected_nbytes):
+    if len(header) < 16:
+        return 'truncated'
+    # blosc header: version, versionlz, flags, typesize, nbytes, blocksize, cbytes
+    nbytes, blocksize, cbytes = struct.unpack('<III', header[4:16])
+    if cbytes != payload_size:
+        return 'size: blosc cbytes ' + str(cbytes) + ' != ' + str(payload_size)
+    if nbytes != expected_nbytes:
+        return 'size: blosc nbytes ' + str(nbytes) + ' != ' + str(expected_nbytes)
+    return None
 
-    try:
-        # Attempt to read the chunk
-        data_chunk = in_dataset.read_chunk(idx)
-        if data_chunk is None:
-            print(f"Chunk {idx} is missing.")
-            return False
-                    
-        # Check for NaNs or infinite values
-        if np.isnan(data_chunk).any() or np.isinf(data_chunk).any():
-            print(f"Chunk {idx} contains NaNs or infinite values.")
-            return False
-                    
-    except Exception as e:
-        print(f"Error reading chunk {idx}: {e}")
-        return False
-    
-    mm = median
-
-    # Calculate vv
-    vv = int(mm // amp)  # Use integer division
-
-    # Generate masks for low intensity pixels
-    masks = (data_chunk < mm - vv)
-
-    # Set all low intensity pixels to zero
-    data_chunk = data_chunk * (~masks).astype(np.uint16)
-
-    white_noise = np.random.normal(0, 1.0, data_chunk.shape) * vv + mm
-    data_chunk += (white_noise * masks).astype(np.uint16)
-
-    done = False
-    for i in range(0, retry):
-        try:
-            out_dataset.write_chunk(idx, data_chunk)
-            chk = validate_chunk(out_dataset, idx)
-            if chk == True:
-                break
-        except Exception as e:
-            print(f"Error writing chunk {idx}: {e}")
-        print(f"retry to write chunk {idx}")
-        time.sleep(wait)
-
-    return True
-
-def compute_histogram(chunk, bins, range):
-    hist, edges = np.histogram(chunk, bins=bins, range=range)
-    return hist
-
-def compute_histogram2(dataset, idx, bins, range):
-    try:
-        # Attempt to read the chunk
-        data_chunk = dataset.read_chunk(idx)
-        if data_chunk is None:
-            print(f"Chunk {idx} is missing.")
-            return None
-                
-        # Check for NaNs or infinite values
-        if np.isnan(data_chunk).any() or np.isinf(data_chunk).any():
-            print(f"Chunk {idx} contains NaNs or infinite values.")
-            return None
-
-        hist, edges = np.histogram(data_chunk, bins=bins, range=range)
-        return hist
-                
-    except Exception as e:
-        print(f"Error reading chunk {idx}: {e}")
+def check_zstd_fast(header, expected_nbytes):
+    if len(header) < 6 or struct.unpack('<I', header[:4])[0] != 0xFD2FB528:
+        return 'bad zstd header'
+    descriptor = header[4]
+    fcs_flag = descriptor >> 6
+    single_segment = (descriptor >> 5) & 1
+    offset = 5 + (0 if single_segment else 1) + [0, 1, 2, 4][descriptor & 3]
+    fcs_size = [1 if single_segment else 0, 2, 4, 8][fcs_flag]
+    if fcs_size == 0:
+        # the content size is not stored in the frame
         return None
+    if len(header) < offset + fcs_size:
+        return 'truncated'
+    content_size = int.from_bytes(header[offset:offset + fcs_size], 'little')
+    if fcs_size == 2:
+        content_size += 256
+    if content_size != expected_nbytes:
+        return 'size: zstd content size ' + str(content_size) + ' != ' + str(expected_nbytes)
     return None
 
-def find_median_from_histogram(histogram, range):
-    # Create an array representing the value of each bin
-    bin_edges = np.linspace(range[0], range[1], len(histogram) + 1)
-    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-    
-    # Calculate the cumulative sum of the histogram
-    cumulative_sum = np.cumsum(histogram)
-    total_count = cumulative_sum[-1]
-    
-    # Find the index where the cumulative sum reaches or exceeds half the total count
-    median_index = np.searchsorted(cumulative_sum, total_count / 2)
-    
-    # Return the bin center corresponding to the median index
-    median_value = bin_centers[median_index]
-    return int(median_value)
-
-def validate_chunk(n5_path, dataset_name, idx):
-    chunk_subpath = os.path.join(*[str(id) for id in reversed(idx)])
-    absolute_chunk_path = os.path.join(n5_path, dataset_name, chunk_subpath)
-
+def scan_chunk(dataset_path, pos, block_size, dimensions, itemsize, compression, fast, manifest_entry):
+    """
+    Check one chunk file.
+
+    :param pos: Grid position of the chunk (x/y/z order).
+    :param manifest_entry: (crc32, size) from checksums.tsv, or None.
+    :return: None if the chunk is valid, otherwise a short description of the error.
+    """
+    path = os.path.join(dataset_path, *[str(p) for p in pos])
+    if not os.path.exists(path):
+        return 'missing'
+    file_size = os.path.getsize(path)
+    if manifest_entry is not None and file_size != manifest_entry[1]:
+        return 'size: ' + str(file_size) + ' != ' + str(manifest_entry[1]) + ' in manifest'
+
+    ctype = compression['type']
     try:
-        with open(absolute_chunk_path, 'rb') as f:
-            # Skip the first 16 bytes
-            f.seek(16)
-            
-            # Read the rest of the file
-            remaining_data = f.read()
-
-            # Use a BytesIO buffer to decompress the remaining data
-            buffer = io.BytesIO(remaining_data)
-            with gzip.GzipFile(fileobj=buffer) as g:
-                # Try to read the decompressed data
-                while g.read(8192):
-                    pass
-
-        return True
+        with open(path, 'rb') as f:
+            mode, dims, num_elements = parse_chunk_header(f)
+            if mode == 0:
+                # border chunks are either truncated (N5 Java) or full blocks (zarr)
+                expected = expected_dims(pos, block_size, dimensions)
+                if len(dims) != len(expected) or any(d != e and d != b for d, e, b in zip(dims, expected, block_size)):
+                    return 'header: dims ' + str(list(dims)) + ' != ' + str(list(expected))
+                expected_nbytes = int(np.prod(dims)) * itemsize
+            elif mode == 1:
+                expected_nbytes = num_elements * itemsize
+            else:
+                expected_nbytes = None
+            payload_offset = f.tell()
+            payload_size = file_size - payload_offset
+
+            if ctype == 'raw':
+                if expected_nbytes is not None and payload_size != expected_nbytes:
+                    return 'size: ' + str(payload_size) + ' != ' + str(expected_nbytes)
+                if fast or manifest_entry is None:
+                    return None
+
+            if fast:
+                if ctype == 'gzip':
+                    return check_gzip_fast(f, payload_offset, file_size, expected_nbytes, compression.get('useZlib', False)) if expected_nbytes is not None else None
+                header = f.read(64)
+                if ctype == 'blosc':
+                    return check_blosc_fast(header, payload_size, expected_nbytes) if expected_nbytes is not None else None
+                if ctype == 'zstd':
+                    return check_zstd_fast(header, expected_nbytes) if expected_nbytes is not None else None
+                if ctype == 'bzip2' and header[:3] != b'BZh':
+                    return 'bad bzip2 header'
+                if ctype == 'xz' and header[:6] != b'\xfd7zXZ\x00':
+                    return 'bad xz header'
+                return None
+
+            f.seek(0)
+            crc = zlib.crc32(f.read(payload_offset))
+            if ctype == 'raw':
+                total = payload_size
+                while True:
+                    block = f.read(READ_SIZE)
+                    if not block:
+                        break
+                    crc = zlib.crc32(block, crc)
+            elif ctype == 'gzip':
+                wbits = 15 if compression.get('useZlib', False) else 31
+                total, crc = stream_decompress(f, zlib.decompressobj(wbits), crc)
+            elif ctype == 'bzip2':
+                total, crc = stream_decompress(f, bz2.BZ2Decompressor(), crc)
+            elif ctype == 'xz':
+                total, crc = stream_decompress(f, lzma.LZMADecompressor(), crc)
+            elif ctype == 'zstd' and zstandard is not None:
+                total, crc = stream_decompress(f, zstandard.ZstdDecompressor().decompressobj(), crc)
+            elif ctype in ('blosc', 'zstd') and Blosc is not None:
+                # blosc frames cannot be streamed
+                codec = Blosc() if ctype == 'blosc' else Zstd()
+                payload = f.read()
+                crc = zlib.crc32(payload, crc)
+                total = len(codec.decode(payload))
+            else:
+                return 'unsupported compression: ' + ctype
+
+            if expected_nbytes is not None and total != expected_nbytes:
+                return 'size: decompressed ' + str(total) + ' != ' + str(expected_nbytes)
+            if manifest_entry is not None and crc != manifest_entry[0]:
+                return 'crc: ' + format(crc, '08x') + ' != ' + format(manifest_entry[0], '08x') + ' in manifest'
+
     except Exception as e:
-        print(f"The GZIP file is invalid after the first 16 bytes: {e}")
-        return False
+        return 'corrupt: ' + str(e)
+    return None
+
+def scan_chunks(dataset_path, positions, block_size, dimensions, itemsize, compression, fast, manifest):
+    """
+    Check a batch of chunks.
+
+    :return: List of (position, error) of the invalid chunks.
+    """
+    bad = []
+    for pos in positions:
+        key = "/".join(str(p) for p in pos)
+        entry = manifest.get(key) if manifest is not None else None
+        error = scan_chunk(dataset_path, pos, block_size, dimensions, itemsize, compression, fast, entry)
+        if error is not None:
+            bad.append((pos, error))
+    return bad
+
+def scan_dataset(base_path, g, fast=False, batch_size=256):
+    """
+    Check every chunk of a dataset in parallel.
+
+    :param base_path: Path of the N5 container.
+    :param g: Dataset path inside the container.
+    :param fast: Only check headers, sizes and the gzip trailer instead of decompressing.
+    :param batch_size: Number of chunks checked by one task.
+    :return: Report dictionary of the dataset.
+    """
+    dataset_path = os.path.join(base_path, g)
+    attributes = read_dataset_attributes(dataset_path)
+    compression = get_compression(attributes)
+    dimensions = attributes['dimensions']
+    block_size = attributes['blockSize']
+    itemsize = np.dtype(DTYPES[attributes['dataType']]).itemsize
+    manifest = read_manifest(dataset_path)
+
+    num_chunks = [int(np.ceil(d / b)) for d, b in zip(dimensions, block_size)]
+    # np.ndindex in reversed order keeps the x index fastest, like the files on disk
+    positions = [tuple(reversed(idx)) for idx in np.ndindex(*reversed(num_chunks))]
+    tasks = [dask.delayed(scan_chunks)(dataset_path, positions[i:i + batch_size], block_size, dimensions, itemsize, compression, fast, manifest) for i in range(0, len(positions), batch_size)]
+    bad = [b for batch in dask.compute(tasks)[0] for b in batch]
+
+    return {
+        'dataset': g,
+        'compression': compression['type'],
+        'mode': 'fast' if fast else 'full',
+        'manifest': manifest is not None,
+        'chunks': len(positions),
+        'bad': [{'path': "/".join(str(p) for p in pos), 'chunk': list(reversed(pos)), 'error': error} for pos, error in bad],
+    }
 
 def main():
 
     argv = sys.argv
     argv = argv[1:]
 
-    usage_text = ("Usage:" + "  padding.py" + " [options]")
+    usage_text = ("Usage:" + "  validate.py" + " [options]")
     parser = argparse.ArgumentParser(description=usage_text)
-    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input file path (.n5)")
+    parser.add_argument("-i", "--input", dest="input", type=str, default=None, help="input file path (.n5 or the .xml next to it)")
     parser.add_argument("-t", "--thread", dest="thread", type=int, default=0, help="number of threads")
     parser.add_argument("-c", "--ch", dest="ch", type=str, default=0, help="channel")
     parser.add_argument("-s", "--scale", dest="scale", type=str, default=0, help="scale")
+    parser.add_argument("-d", "--dataset", dest="dataset", type=str, default=None, help="comma separated dataset paths, instead of -c and -s (e.g. c0/s0,c1/s0)")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, help="report file path (.json) listing missing and corrupt chunks")
+    parser.add_argument("--fast", dest="fast", default=False, action="store_true", help="check headers, sizes and gzip trailers only, without decompressing")
     parser.add_argument("--verbose", dest="verbose", default=False, action="store_true", help="enable verbose logging")
 
     if not argv:
@@ -172,54 +261,35 @@ def main():
     args = parser.parse_args(argv)
 
     input = args.input
-    ch = args.ch
-    scales = args.scale.split(",")
     threadnum = args.thread
 
-    dataname = os.path.basename(input)
-    indirpath = os.path.dirname(input)
+    dataname = os.path.basename(input.rstrip("/"))
+    indirpath = os.path.dirname(input.rstrip("/"))
     stem = os.path.splitext(dataname)[0]
 
     base_path = os.path.join(indirpath, stem + ".n5")
 
-    with open(os.path.join(base_path, "attributes.json"), 'w') as f:
-        data = {}
-        data['n5'] = "2.2.0"
-        f.seek(0)
-        json.dump(data, f, indent=4)
-        f.truncate()
-
-    group_paths = []
-    for scale in scales:
-        group_path = 'setup' + ch + '/timepoint0/' + scale
-        group_paths.append(group_path)
-
-    n5input = z5py.File(base_path, use_zarr_format=False)
-
-    bins = 65536
-    range = (0, 65535)
+    if args.dataset is not None:
+        group_paths = args.dataset.split(",")
+    else:
+        group_paths = ['setup' + args.ch + '/timepoint0/' + scale for scale in args.scale.split(",")]
 
     cluster = LocalCluster(n_workers=threadnum, threads_per_worker=1)
     client = Client(cluster)
+
+    reports = []
     for g in group_paths:
+        report = scan_dataset(base_path, g, fast=args.fast)
+        reports.append(report)
+        print(g + " error: " + str(len(report['bad'])))
+        if args.verbose:
+            for b in report['bad']:
+                print("  " + b['path'] + ": " + b['error'])
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'n5': base_path, 'datasets': reports}, f, indent=4)
 
-        shape = n5input[g].shape
-        chunks = n5input[g].chunks
-        num_chunks = [int(np.ceil(s / c)) for s, c in zip(shape, chunks)]
-        futures = []
-        for idx in np.ndindex(*num_chunks):
-            future = dask.delayed(validate_chunk)(n5_path=base_path, dataset_name=g, idx=idx)
-            futures.append(future)
-        isvalid = dask.compute(futures)[0]
-        
-        sum = 0
-        for r in isvalid:
-            if r == False:
-                sum += 1
-
-        print("error: " + str(sum))
-
-    
     client.close()
     cluster.close()
 
@@ -0,0 +1,52 @@
+import numpy as np
+
+# ViewTransform affines of a BigStitcher XML as one (n, 3, 4) array, so that
+# offsets and flips are applied to all views at once and every affine string is
+# written once.
+
+def get_affines(registrations, name=None, first_only=False):
+    """
+    Affines of the ViewTransforms of ViewRegistrations.
+
+    :param registrations: ViewRegistration elements, e.g. xml.findall(".//ViewRegistration").
+    :param name: Only ViewTransforms with this Name (e.g. Translation).
+    :param first_only: Only the first ViewTransform of each ViewRegistration.
+    :return: (list of (setup id, affine element), array (n, 3, 4))
+    """
+    elements = []
+    for registration in registrations:
+        transforms = registration.findall("./ViewTransform")
+        if first_only:
+            transforms = transforms[:1]
+        for item in transforms:
+            if name is not None and item.find("./Name").text != name:
+                continue
+            elements.append((registration.attrib['setup'], item.find("affine")))
+    if not elements:
+        return elements, np.zeros((0, 3, 4))
+    affines = np.array([[float(v) for v in element.text.split()] for _, element in elements]).reshape(-1, 3, 4)
+    return elements, affines
+
+def set_affines(elements, affines):
+    """
+    Write the affines back to their elements.
+    """
+    for (_, element), affine in zip(elements, affines.reshape(-1, 12).tolist()):
+        element.text = " ".join(str(v) for v in affine)
+
+def offset_translations(affines, offsets):
+    """
+    Add offsets to the translations.
+
+    :param offsets: Array (n, k), added to the first k translation components (x, y, z).
+    """
+    offsets = np.asarray(offsets, dtype=float)
+    affines[:, :offsets.shape[1], 3] += offsets
+    return affines
+
+def flip_translations(affines, axis):
+    """
+    Negate one translation component (0: x, 1: y, 2: z).
+    """
+    affines[:, axis, 3] *= -1.0
+    return affines
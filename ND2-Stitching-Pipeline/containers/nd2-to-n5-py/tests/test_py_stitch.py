@@ -0,0 +1,34 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+sys.modules.setdefault('z5py', types.ModuleType('z5py'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import py_stitch
+
+FACTORS = (1, 4, 4)
+TILE = (16, 128, 320)
+
+def make_tile(tile_id, x):
+    model = np.eye(4)
+    model[0, 3] = x
+    return (str(tile_id), str(tile_id), list(reversed(TILE)), model)
+
+@pytest.mark.parametrize("metadata_x, true_x", [(202, 202), (203, 205), (201, 198)])
+def test_stitch_non_aligned_origins(metadata_x, true_x):
+    # tile b starts between two downsampled pixels of tile a
+    rng = np.random.default_rng(0)
+    volume = gaussian_filter(rng.random((TILE[0], TILE[1], 600)).astype(np.float32), (1, 6, 6))
+    images = [py_stitch.block_mean(volume[:, :, x:x + TILE[2]], FACTORS) for x in (0, true_x)]
+    tiles = [make_tile(0, 0), make_tile(1, metadata_x)]
+
+    translations = py_stitch.stitch_timepoint(tiles, images, FACTORS, 0.3, 100, 2.5, 3.5, 1)
+
+    # the sub-pixel fit is good to a fraction of a downsampled pixel
+    error = translations[1] - translations[0] - [true_x - metadata_x, 0, 0]
+    assert np.abs(error).max() < FACTORS[2] / 4
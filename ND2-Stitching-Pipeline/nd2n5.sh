@@ -15,6 +15,11 @@ usage() {
     echo "  -p, --prestitch	    do not perform image fusion"
     echo "  -f, --fusionOnly	perform only image fusion"
 	echo "  --oneTileWins		use the one-tile-wins strategy for stitching"
+	echo "  --singleOpenExtract	extract all tiles with one process that opens the nd2 file once"
+	echo "  --directN5		write the tiles from the nd2 file to n5 directly (no tiff extraction and resaving)"
+	echo "  --stitchCache		directory of stitching solutions reused for the same tile layout"
+	echo "  --pyStitch		stitch with phase correlation in python instead of fiji (small and medium tile grids)"
+	echo "  --stitchWorker		stitch all timepoints in one task on a single long-lived fiji"
     echo "  -r, --resume    	resume a workflow execution"
 	echo "  -h, --help		    display this help and exit"
 	exit 1
@@ -111,6 +116,31 @@ do
 			ONETILEWINS="--oneTileWins"
 			shift 1
 			;;
+		'--singleOpenExtract' )
+			SINGLEOPEN="--singleOpenExtract"
+			shift 1
+			;;
+		'--directN5' )
+			DIRECTN5="--directN5"
+			shift 1
+			;;
+		'--pyStitch' )
+			PYSTITCH="--pyStitch"
+			shift 1
+			;;
+		'--stitchWorker' )
+			STITCHWORKER="--stitchWorker"
+			shift 1
+			;;
+		'--stitchCache' )
+			if [[ -z "$2" ]] || [[ "$2" =~ ^-+ ]]; then
+				echo "$PROGNAME: option requires an argument -- $1" 1>&2
+				exit 1
+			fi
+			mkdir -p "$2"
+			STITCHCACHE="--stitchCache $(realpath "$2")"
+			shift 2
+			;;
         '-r'|'--resume' )
 			RESUME="-resume"
 			shift 1
@@ -159,7 +189,7 @@ export TMPDIR="$NXFTMPDIR"
 export NXF_TEMP="$NXFTMPDIR"
 cd $BASEDIR 
 
-nextflow run $BASEDIR/nd2n5/nd2n5.nf -c $BASEDIR/nextflow.config -profile standard $RESUME --runtime_opts "--env TMPDIR=$NXFTMPDIR -B $INPUTDIR -B /tmp -B $OUTDIR -B $BASEDIR" --dapi_channel \"$DAPI\" --inputPath "$INPUTND2" --outputPath "$OUTDIR" $PRESTITCH $FUSIONONLY $ONETILEWINS $THREADNUM $WORKERNUM $CORENUM $CORENUM2 $CROP
+nextflow run $BASEDIR/nd2n5/nd2n5.nf -c $BASEDIR/nextflow.config -profile standard $RESUME --runtime_opts "--env TMPDIR=$NXFTMPDIR -B $INPUTDIR -B /tmp -B $OUTDIR -B $BASEDIR" --dapi_channel \"$DAPI\" --inputPath "$INPUTND2" --outputPath "$OUTDIR" $PRESTITCH $FUSIONONLY $ONETILEWINS $SINGLEOPEN $DIRECTN5 $STITCHCACHE $PYSTITCH $STITCHWORKER $THREADNUM $WORKERNUM $CORENUM $CORENUM2 $CROP
 
 rm -rf "$BASEDIR/spark"
 rm -rf "$BASEDIR/work"
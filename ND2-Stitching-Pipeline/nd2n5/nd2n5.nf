@@ -22,6 +22,24 @@ params.fusionOnly = false
 
 params.oneTileWins = false
 
+// extract all TIFFs with one process that opens the ND2 once
+params.singleOpenExtract = false
+params.extractThreads = 4
+
+// write the per-tile N5 directly from the ND2 instead of TIFF extraction and SparkResaveN5
+params.directN5 = false
+
+// directory of stitching solutions reused by timepoints and batches with the same tile layout;
+// timepoints stitched in parallel wait for the first of them and verify its solution
+params.stitchCache = ""
+
+// stitch with py_stitch.py (phase correlation in NumPy, no Fiji) for small and medium tile grids
+params.pyStitch = false
+
+// stitch all timepoints in one task on a single long-lived Fiji (fiji_worker.py)
+// instead of starting Fiji for every timepoint
+params.stitchWorker = false
+
 // path to the output dataset
 params.outputDataset = "/s0"
 
@@ -87,7 +105,7 @@ process define_dataset {
 process fix_n5xml {
     scratch true
 
-    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.7'
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
     containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
 
     memory { "4 GB" }
@@ -129,8 +147,8 @@ process calc_stitching_resume {
 process calc_stitching {
     scratch true
 
-    container 'ghcr.io/janeliascicomp/nd2-to-n5-fiji:0.0.4'
-    containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-fiji:0.0.6'
+    containerOptions { getOptions([getParent(params.inputPath), params.outputPath] + (params.stitchCache ? [params.stitchCache] : [])) }
 
     memory { "${params.mem_gb} GB" }
     cpus { params.cpus }
@@ -144,8 +162,66 @@ process calc_stitching {
     
     script:
     inxml = meta.resave_outxml
+    cache = params.stitchCache ? "-c ${params.stitchCache}" : ""
+    """
+    /entrypoint.sh calc_stitch -i $inxml -m ${params.mem_gb}G -t ${params.cpus} -d 8,8,4 -r 0.3 $cache 2>&1
+    """
+}
+
+process calc_stitching_batch {
+    scratch true
+
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-fiji:0.0.6'
+    containerOptions { getOptions([getParent(params.inputPath), params.outputPath] + (params.stitchCache ? [params.stitchCache] : [])) }
+
+    memory { "${params.mem_gb} GB" }
+    cpus { params.cpus }
+
+    input:
+    val(acquisitions)
+    val(done)
+
+    output:
+    val(xmls)
+
+    script:
+    xmls = acquisitions.collect { it[1] }
+    inxmls = acquisitions.collect { it[0].resave_outxml }.join(' ')
+    queue = "${acquisitions[0][0].tmpdir}/fiji_worker"
+    cache = params.stitchCache ? "-c ${params.stitchCache}" : ""
     """
-    /entrypoint.sh calc_stitch -i $inxml -m ${params.mem_gb}G -t ${params.cpus} -d 8,8,4 -r 0.3  > /dev/null 2>&1
+    /entrypoint.sh fiji_worker start -q $queue -m ${params.mem_gb}G
+    rc=0
+    for inxml in $inxmls; do
+        /entrypoint.sh calc_stitch -i \$inxml -w $queue -t ${params.cpus} -d 8,8,4 -r 0.3 $cache || rc=1
+        if [ \$rc -ne 0 ]; then break; fi
+    done
+    /entrypoint.sh fiji_worker stop -q $queue
+    exit \$rc
+    """
+}
+
+process py_stitching {
+    scratch true
+
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
+    containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
+
+    memory { "${params.mem_gb} GB" }
+    cpus { params.cpus }
+
+    input:
+    tuple val(meta), path(files), val(spark)
+    val(done)
+
+    output:
+    path(files)
+
+    script:
+    // the TIFFs are not extracted with directN5, the tiles are read from the N5 then
+    inxml = params.directN5 ? meta.resave_outxml : meta.resave_inxml
+    """
+    /entrypoint.sh py_stitch -i $inxml -o ${meta.resave_outxml} -t ${params.cpus} -d 8,8,4 -r 0.3
     """
 }
 
@@ -173,7 +249,7 @@ process gen_csv {
 process split_xml {
     scratch true
 
-    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.12'
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
     containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
 
     memory { "4 GB" }
@@ -195,7 +271,7 @@ process split_xml {
 process nd2tiff {
     scratch true
 
-    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.11'
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
     containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
 
     memory { "16 GB" }
@@ -213,10 +289,31 @@ process nd2tiff {
     """
 }
 
+process nd2tiff_all {
+    scratch true
+
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
+    containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
+
+    memory { "${16 * params.extractThreads} GB" }
+    cpus { params.extractThreads }
+
+    input:
+    tuple val(src), val(csv), val(bg), val(crop)
+
+    output:
+    val("process_complete"), emit: control_1
+
+    script:
+    """
+    /entrypoint.sh nd2tiff -i $src -l $csv -c $crop -t ${params.extractThreads}
+    """
+}
+
 process padding {
     scratch true
 
-    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.10'
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
     containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
 
     memory { "${params.mem_gb} GB" }
@@ -244,7 +341,7 @@ process padding {
 process padding_single {
     scratch true
 
-    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.10'
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
     containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
 
     memory { "${params.mem_gb} GB" }
@@ -272,7 +369,7 @@ process padding_single {
 process padding_mask {
     scratch true
 
-    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.12'
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
     containerOptions { getOptions([getParent(params.inputPath), getParent(params.outputPath)]) }
 
     memory { "${params.mem_gb} GB" }
@@ -293,7 +390,7 @@ process padding_mask {
 process padding_mask_single {
     scratch true
 
-    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.12'
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
     containerOptions { getOptions([getParent(params.inputPath), getParent(params.outputPath)]) }
 
     memory { "${params.mem_gb} GB" }
@@ -429,6 +526,48 @@ process SPARK_RESAVE_SINGLE {
     """ 
 }
 
+process DIRECT_N5 {
+    scratch true
+
+    tag "${meta.id}"
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
+    containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
+    memory { "${params.mem_gb} GB" }
+    cpus { params.cpus }
+
+    input:
+    tuple val(meta), path(xml), val(spark)
+
+    output:
+    tuple val(meta), path(xml), val(spark), emit: acquisitions
+
+    script:
+    """
+    /entrypoint.sh nd2n5_direct -i ${params.inputPath} -x ${meta.resave_inxml} -o ${meta.resave_outxml} -c ${params.crop} -b ${params.blockSize} -t ${params.cpus}
+    """
+}
+
+process DIRECT_N5_SINGLE {
+    scratch true
+
+    tag "${meta.id}"
+    container 'ghcr.io/janeliascicomp/nd2-to-n5-py:0.0.13'
+    containerOptions { getOptions([getParent(params.inputPath), params.outputPath]) }
+    memory { "${params.mem_gb} GB" }
+    cpus { params.cpus }
+
+    input:
+    tuple val(meta), path(xml), val(spark)
+
+    output:
+    tuple val(meta), path(xml), val(spark), emit: acquisitions
+
+    script:
+    """
+    /entrypoint.sh nd2n5_direct -i ${params.inputPath} -x ${meta.resave_inxml} -o ${meta.resave_outxml} -c ${params.crop} -b ${params.blockSize} -t ${params.cpus}
+    """
+}
+
 process SPARK_DOWNSAMPLE {
     scratch true
 
@@ -758,16 +897,26 @@ workflow {
         .map { file(it) }
         .set { csvfile }
 
-        csvfile
-        .splitCsv(header:false, sep: '\t')
-        .map { row-> row[0] }
-        .set { flist }
-
-        param_tif = flist.map{ tuple("${infile}", "${it}", "${bgpath}", "${params.crop}") }
-        tiff1 = nd2tiff(param_tif)
+        if ( params.directN5 ) {
+            // the tiles are read from the ND2 by DIRECT_N5
+            tiff_done = csv
+        } else if ( params.singleOpenExtract ) {
+            param_tif = csv.map{ tuple("${infile}", "${it}", "${bgpath}", "${params.crop}") }
+            nd2tiff_all(param_tif)
+            tiff_done = nd2tiff_all.out.control_1
+        } else {
+            csvfile
+            .splitCsv(header:false, sep: '\t')
+            .map { row-> row[0] }
+            .set { flist }
+
+            param_tif = flist.map{ tuple("${infile}", "${it}", "${bgpath}", "${params.crop}") }
+            tiff1 = nd2tiff(param_tif)
+            tiff_done = nd2tiff.out.control_1
+        }
 
         param_t = fixedxml.map{ tuple("$it", "${tmpdir}/${file(it).baseName}_tiff.xml", "${tmpdir}/${file(it).baseName}_tiff.csv", "${params.crop}") }
-        csv2 = split_xml(param_t, nd2tiff.out.control_1.collect())
+        csv2 = split_xml(param_t, tiff_done.collect())
         csv2.subscribe { println "csv2: $it" }
 
         csv2
@@ -817,13 +966,21 @@ workflow {
             multi: file(it[0].single_tile).exists() == false
         }.set{ sp_start_branching }
 
-        SPARK_RESAVE(sp_start_branching.multi)
-        done = SPARK_STOP(SPARK_RESAVE.out.acquisitions)
-
-        SPARK_RESAVE_SINGLE(sp_start_branching.single)
-        done_single = SPARK_STOP_SINGLE(SPARK_RESAVE_SINGLE.out.acquisitions)
+        if ( params.directN5 ) {
+            DIRECT_N5(sp_start_branching.multi)
+            resaved = DIRECT_N5.out.acquisitions
+            DIRECT_N5_SINGLE(sp_start_branching.single)
+            resaved_single = DIRECT_N5_SINGLE.out.acquisitions
+        } else {
+            SPARK_RESAVE(sp_start_branching.multi)
+            resaved = SPARK_RESAVE.out.acquisitions
+            SPARK_RESAVE_SINGLE(sp_start_branching.single)
+            resaved_single = SPARK_RESAVE_SINGLE.out.acquisitions
+        }
+        done = SPARK_STOP(resaved)
+        done_single = SPARK_STOP_SINGLE(resaved_single)
 
-        padding_single(SPARK_RESAVE_SINGLE.out.acquisitions, SPARK_STOP_SINGLE.out.collect())
+        padding_single(resaved_single, SPARK_STOP_SINGLE.out.collect())
 
         param_single = padding_single.out.acquisitions.map{ tuple("${it[0].resave_outxml}", "${outdir}", "${it[0].resave_outxml}") }
         fix_res_single(param_single, SPARK_STOP_SINGLE.out.collect())
@@ -863,8 +1020,14 @@ workflow {
         remove_dir(tmpdir_ch, SPARK_STOP.out.collect())
     }
     else {
-        if ( !params.fusionOnly ) {
-            calc_results = calc_stitching(SPARK_RESAVE.out.acquisitions, done)
+        if ( !params.fusionOnly && params.pyStitch ) {
+            calc_results = py_stitching(resaved, done)
+        }
+        else if ( !params.fusionOnly && params.stitchWorker ) {
+            calc_results = calc_stitching_batch(resaved.toList().filter { it.size() > 0 }, done.collect()).flatten()
+        }
+        else if ( !params.fusionOnly ) {
+            calc_results = calc_stitching(resaved, done)
         }
         else {
             calc_results = calc_stitching_resume(param_resaved)